@@ -0,0 +1,138 @@
+"""benchmark html extraction on a corpus of saved pages
+
+pass a directory of saved .html pages, without one a synthetic corpus is used.
+run from the repository root:
+
+    python -m benchmarks.html_extract_bench [directory] [rounds]
+
+besides the parse time per page this shows the longest event loop stall while
+the corpus is extracted inline and through the worker pools.
+"""
+
+import asyncio
+import pathlib
+import random
+import string
+import sys
+import time
+
+import bs4
+
+from plugins import htmlextract
+
+
+def legacy_extract(content: str):
+    """what download_webpage used to do"""
+    soup = bs4.BeautifulSoup(content, "html.parser")
+    if not soup.find():
+        return None
+    for tag in ["script", "style", "noscript"]:
+        for match in soup.find_all(tag):
+            match.decompose()
+    links = " | ".join(f"{link.get('href')} {link.text}" for link in soup.find_all("a"))
+    title = soup.title.string if soup.title else ""
+    text = soup.body.get_text(separator=" ", strip=True)
+    return {"links": links, "title": title, "text": text, "text_full": soup.body.get_text()}
+
+
+def words(count: int) -> str:
+    """random text"""
+    return " ".join(
+        "".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9)))
+        for _ in range(count)
+    )
+
+
+def synthetic_page(paragraphs: int) -> str:
+    """an article like page with navigation, scripts and links"""
+    nav = "".join(f'<li><a href="/section/{i}">{words(2)}</a></li>' for i in range(40))
+    body = "".join(
+        f'<div class="p"><p>{words(60)} <a href="/article/{i}">{words(3)}</a> {words(40)}</p>'
+        f"<script>window.ad{i} = {{slot: {i}}};</script></div>"
+        for i in range(paragraphs)
+    )
+    return (
+        f"<html><head><title>{words(6)}</title><style>{'p{margin:0}' * 200}</style></head>"
+        f"<body><nav><ul>{nav}</ul></nav><article>{body}</article>"
+        f"<noscript>{words(20)}</noscript><footer>{words(50)}</footer></body></html>"
+    )
+
+
+def load_corpus(directory: str | None) -> list:
+    """saved pages, or synthetic ones of growing size"""
+    if directory:
+        paths = sorted(pathlib.Path(directory).glob("*.htm*"))
+        return [path.read_text(encoding="utf-8", errors="replace") for path in paths]
+    random.seed(1)
+    return [synthetic_page(size) for size in (10, 50, 200, 1000, 3000)]
+
+
+def bench_parsers(corpus: list, rounds: int):
+    """parse time of every backend over the corpus"""
+    size = sum(len(page) for page in corpus)
+    print(f"{len(corpus)} pages, {size / 1024 / 1024:.1f} MiB")
+    print(f"{'parser':<16}{'ms/page':>10}{'MiB/s':>10}")
+    candidates = {"bs4 (before)": legacy_extract}
+    for name in htmlextract.available_parsers():
+        candidates[name] = htmlextract.get_parser(name)
+    for name, extract in candidates.items():
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for page in corpus:
+                extract(page)
+        elapsed = (time.perf_counter() - start) / rounds
+        print(f"{name:<16}{elapsed / len(corpus) * 1000:>10.2f}{size / 1024 / 1024 / elapsed:>10.1f}")
+
+
+async def longest_stall(work) -> float:
+    """the longest gap between ticks of a 1 ms timer while work runs"""
+    stall = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal stall
+        last = time.perf_counter()
+        while not done:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            stall = max(stall, now - last)
+            last = now
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    await work()
+    done = True
+    await task
+    return stall
+
+
+async def bench_stalls(corpus: list):
+    """how long the event loop is blocked while extracting"""
+
+    async def inline():
+        for page in corpus:
+            htmlextract.extract(page, "html.parser")
+
+    async def pooled(kind):
+        await asyncio.gather(*(htmlextract.extract_async(page, "html.parser", kind) for page in corpus))
+
+    # start the pools before measuring
+    for kind in ("thread", "process"):
+        await htmlextract.extract_async("<p></p>", "html.parser", kind)
+    print(f"\n{'extraction':<16}{'longest stall ms':>18}")
+    print(f"{'inline':<16}{await longest_stall(inline) * 1000:>18.1f}")
+    for kind in ("thread", "process"):
+        print(f"{kind + ' pool':<16}{await longest_stall(lambda k=kind: pooled(k)) * 1000:>18.1f}")
+
+
+def main():
+    """run the benchmarks"""
+    directory = sys.argv[1] if len(sys.argv) > 1 else None
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    corpus = load_corpus(directory)
+    bench_parsers(corpus, rounds)
+    asyncio.run(bench_stalls(corpus))
+
+
+if __name__ == "__main__":
+    main()
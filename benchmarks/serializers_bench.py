@@ -0,0 +1,117 @@
+"""micro-benchmark of the valkey message codecs on chat thread shaped data
+
+run from the repository root:
+
+    python -m benchmarks.serializers_bench
+"""
+
+import base64
+import json
+import os
+import random
+import string
+import timeit
+
+import jsonpickle
+
+from plugins.serializers import Serializer
+
+
+def words(count: int) -> str:
+    """random text"""
+    return " ".join(
+        "".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9)))
+        for _ in range(count)
+    )
+
+
+def chat_thread(turns: int = 20) -> list:
+    """plain user and assistant turns"""
+    messages = []
+    for _ in range(turns):
+        messages.append({"role": "user", "content": f"@someone: {words(30)}"})
+        messages.append({"role": "assistant", "content": words(150)})
+    return messages
+
+
+def tool_thread() -> list:
+    """a thread with a web search tool call and a downloaded page"""
+    return [
+        {"role": "user", "content": f"@someone: {words(20)}"},
+        {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {
+                    "id": "call_abc123",
+                    "type": "function",
+                    "function": {
+                        "name": "web_search_and_download",
+                        "arguments": json.dumps({"searchterm": words(4)}),
+                    },
+                }
+            ],
+        },
+        {
+            "role": "tool",
+            "tool_call_id": "call_abc123",
+            "name": "web_search_and_download",
+            "content": f"links:{words(200)}|title:{words(8)}|body:{words(1500)}",
+        },
+        {"role": "assistant", "content": words(250)},
+    ]
+
+
+def image_thread() -> list:
+    """a vision request with a base64 encoded image"""
+    image = base64.b64encode(os.urandom(96 * 1024) + bytes(96 * 1024)).decode()
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": f"@someone: {words(15)}"},
+                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image}"}},
+            ],
+        },
+        {"role": "assistant", "content": words(120)},
+    ]
+
+
+def legacy_encode(messages):
+    """what the plugins used to do"""
+    return [jsonpickle.encode(m, unpicklable=False) for m in messages]
+
+
+def legacy_decode(entries):
+    """what the plugins used to do"""
+    return [jsonpickle.decode(e) for e in entries]
+
+
+def bench(name: str, messages: list, number: int):
+    """print encode/decode throughput and size for each codec"""
+    print(f"\n{name}: {len(messages)} messages")
+    print(f"{'codec':<16}{'encode/s':>12}{'decode/s':>12}{'bytes':>12}")
+    candidates = {"jsonpickle": (legacy_encode, legacy_decode)}
+    for codec in ("json", "msgpack"):
+        for threshold, suffix in ((0, ""), (4096, "+zstd")):
+            serializer = Serializer(codec, compress_threshold=threshold)
+            candidates[codec + suffix] = (
+                lambda m, s=serializer: [s.encode(x) for x in m],
+                serializer.decode_list,
+            )
+    for label, (encode, decode) in candidates.items():
+        entries = encode(messages)
+        size = sum(len(e) for e in entries)
+        encode_time = timeit.timeit(lambda: encode(messages), number=number)
+        decode_time = timeit.timeit(lambda: decode(entries), number=number)
+        print(
+            f"{label:<16}{number / encode_time:>12.0f}"
+            f"{number / decode_time:>12.0f}{size:>12}"
+        )
+
+
+if __name__ == "__main__":
+    random.seed(1)
+    bench("chat thread", chat_thread(), 500)
+    bench("tool thread", tool_thread(), 500)
+    bench("image thread", image_thread(), 50)
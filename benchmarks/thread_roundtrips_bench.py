@@ -0,0 +1,125 @@
+"""count valkey round trips per chat turn, before and after batching
+
+needs a running valkey, VALKEY_HOST / VALKEY_DB pick the server. run from the
+repository root:
+
+    python -m benchmarks.thread_roundtrips_bench [turns] [tools per turn]
+"""
+
+import sys
+import time
+import uuid
+
+import valkey
+from environs import Env
+
+from plugins.serializers import Serializer
+from plugins.threadcache import ThreadCache
+
+env = Env()
+
+VALKEY_HOST = env.str("VALKEY_HOST", "localhost")
+VALKEY_DB = env.int("VALKEY_DB", 0)
+EXPIRY = 60 * 60 * 24 * 7
+
+
+class CountingConnection(valkey.Connection):
+    """counts every packet sent, a pipeline is sent as one packet"""
+
+    round_trips = 0
+
+    def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        return super().send_packed_command(command, check_health)
+
+
+def user_message(turn: int) -> dict:
+    """a user turn"""
+    return {"role": "user", "content": f"@someone: question number {turn}"}
+
+
+def tool_messages(turn: int, tool: int) -> tuple:
+    """a tool call and its result"""
+    call_id = f"call_{turn}_{tool}"
+    call = {
+        "role": "assistant",
+        "tool_calls": [
+            {"id": call_id, "type": "function", "function": {"name": "web_search", "arguments": "{}"}}
+        ],
+    }
+    result = {"role": "tool", "tool_call_id": call_id, "name": "web_search", "content": "result " * 200}
+    return call_id, call, result
+
+
+def turn_before(client, serializer, key, turn, tools):
+    """the pattern chat() used: one command per append and a full reread"""
+    if client.exists(key):
+        serializer.decode_list(client.lrange(key, 0, -1))
+    client.rpush(key, serializer.encode(user_message(turn)))
+    for tool in range(tools):
+        call_id, call, result = tool_messages(turn, tool)
+        client.hexists(f"{key}_call", call_id)
+        for msg in (call, result):
+            client.rpush(key, serializer.encode(msg))
+            client.expire(key, EXPIRY)
+            serializer.decode_list(client.lrange(key, 0, -1))
+        client.hset(f"{key}_call", call_id, "true")
+    if tools:
+        if client.exists(key):
+            serializer.decode_list(client.lrange(key, 0, -1))
+    client.rpush(key, serializer.encode({"role": "assistant", "content": "answer " * 100}))
+
+
+def turn_after(client, cache, key, turn, tools):
+    """the pattern chat() uses now: cached reads and one batch per turn"""
+    cache.get(key)
+    batch = cache.batch(key, expiry=EXPIRY)
+    batch.append(user_message(turn))
+    if tools:
+        calls = [tool_messages(turn, tool) for tool in range(tools)]
+        client.hmget(f"{key}_call", [call_id for call_id, _, _ in calls])
+        for _, call, result in calls:
+            batch.append(call, result)
+        client.hset(f"{key}_call", mapping={call_id: "true" for call_id, _, _ in calls})
+        cache.get(key) + batch.pending  # pylint: disable=expression-not-assigned
+    batch.append({"role": "assistant", "content": "answer " * 100})
+    batch.flush()
+
+
+def run(name, turn, turns, tools):
+    """run a number of turns on a fresh thread and print the cost"""
+    key = f"bench_thread_{uuid.uuid4().hex}"
+    CountingConnection.round_trips = 0
+    start = time.perf_counter()
+    for i in range(turns):
+        turn(key, i, tools)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:<8}{CountingConnection.round_trips / turns:>16.1f}"
+        f"{elapsed / turns * 1000:>14.2f}"
+    )
+    return key
+
+
+def main():
+    """compare both patterns"""
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    tools = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    pool = valkey.ConnectionPool(
+        host=VALKEY_HOST, port=6379, db=VALKEY_DB, connection_class=CountingConnection
+    )
+    client = valkey.Valkey(connection_pool=pool)
+    serializer = Serializer()
+    cache = ThreadCache(client, serializer.encode, serializer.decode)
+    print(f"{turns} turns, {tools} tool calls per turn")
+    print(f"{'':<8}{'round trips/turn':>16}{'ms/turn':>14}")
+    keys = [
+        run("before", lambda k, i, t: turn_before(client, serializer, k, i, t), turns, tools),
+        run("after", lambda k, i, t: turn_after(client, cache, k, i, t), turns, tools),
+    ]
+    for key in keys:
+        client.delete(key, f"{key}_call")
+
+
+if __name__ == "__main__":
+    main()
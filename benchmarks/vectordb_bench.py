@@ -0,0 +1,156 @@
+"""recall and latency of the memory searches on the hnsw index
+
+loads seeded random vectors into a scratch table per size, builds the indexes
+of rag_content and runs the search query of VectorDb with and without the
+owner filter at a few ef_search values. recall is measured against an exact
+search done with numpy. needs a postgres with pgvector, the POSTGRES_*
+variables pick the server. run from the repository root:
+
+    python -m benchmarks.vectordb_bench [rows ...]
+
+VECTOR_BENCH_DIMENSIONS sets the vector size (default 256, rag_content uses
+1536 which makes the 1m table about 6gb).
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import psycopg
+from environs import Env
+from pgvector.psycopg import register_vector
+from psycopg.sql import SQL, Identifier, Literal
+
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+# pylint: disable=wrong-import-position
+from plugins.vectordb import VECTOR_ITERATIVE_SCAN, VectorDb, connection_kwargs, supports_iterative_scan
+
+env = Env()
+
+DIMENSIONS = env.int("VECTOR_BENCH_DIMENSIONS", 256)
+USERS = env.int("VECTOR_BENCH_USERS", 100)
+QUERIES = env.int("VECTOR_BENCH_QUERIES", 100)
+K = 5
+CHUNK = 10_000
+EF_SEARCH = (40, 100, 200)
+SEED = 42
+
+
+def chunk_vectors(index: int, rows: int) -> np.ndarray:
+    """the normalized vectors of a chunk, the same on every call"""
+    rng = np.random.default_rng([SEED, index])
+    vectors = rng.standard_normal((rows, DIMENSIONS), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def chunks(rows: int):
+    """(first row, vectors) of every chunk of a table"""
+    for index, first in enumerate(range(0, rows, CHUNK)):
+        yield first, chunk_vectors(index, min(CHUNK, rows - first))
+
+
+def owner(row: int) -> str:
+    """the user a row belongs to"""
+    return f"user{row % USERS}"
+
+
+def load(conn, table: str, rows: int):
+    """fill the table with binary copy"""
+    with conn.cursor() as cur:
+        with cur.copy(
+            SQL("COPY {} (source_type, source, created_by, embedding) FROM STDIN WITH (FORMAT BINARY)").format(
+                Identifier(table)
+            )
+        ) as copy:
+            copy.set_types(["varchar", "varchar", "varchar", "vector"])
+            for first, vectors in chunks(rows):
+                for offset, vector in enumerate(vectors):
+                    copy.write_row(("user", "bench", owner(first + offset), vector))
+    conn.execute(SQL("VACUUM ANALYZE {}").format(Identifier(table)))
+
+
+def exact(rows: int, queries: np.ndarray, users: list) -> tuple:
+    """the ids of the k nearest rows, overall and of the query's user"""
+    best = [np.empty((len(queries), 0)), np.empty((len(queries), 0))]
+    best_ids = [np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.int64)]
+    for first, vectors in chunks(rows):
+        distances = 1 - queries @ vectors.T
+        ids = np.arange(first, first + len(vectors)) + 1
+        filtered = distances.copy()
+        for i, user in enumerate(users):
+            filtered[i, (ids - 1) % USERS != user] = np.inf
+        for n, chunk in enumerate((distances, filtered)):
+            merged = np.hstack([best[n], chunk])
+            merged_ids = np.hstack([best_ids[n], np.broadcast_to(ids, chunk.shape)])
+            top = np.argsort(merged, axis=1)[:, :K]
+            best[n] = np.take_along_axis(merged, top, axis=1)
+            best_ids[n] = np.take_along_axis(merged_ids, top, axis=1)
+    return best_ids[0], best_ids[1]
+
+
+def measure(conn, vectordb, table: str, queries: np.ndarray, users: list, truth: np.ndarray, filtered: bool) -> tuple:
+    """recall@k and latencies in ms of the search query"""
+    found = 0
+    latencies = []
+    for i, query in enumerate(queries):
+        if filtered:
+            sql, params = vectordb._build_search_query(table, ["created_by = %s"], [query, f"user{users[i]}", K])
+        else:
+            sql, params = vectordb._build_search_query(table, [], [query, K])
+        start = time.perf_counter()
+        rows = conn.execute(sql, params).fetchall()
+        latencies.append((time.perf_counter() - start) * 1000)
+        found += len({row["id"] for row in rows} & set(truth[i].tolist()))
+    return found / truth.size, np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+
+def run(conn, rows: int):
+    """benchmark one table size"""
+    table = f"bench_rag_content_{rows}"
+    vectordb = VectorDb.__new__(VectorDb)
+    vectordb.conn = conn
+    # filtered searches are built the way the plugin builds them for this server
+    version = conn.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'").fetchone()["extversion"]
+    vectordb.iterative_scan = VECTOR_ITERATIVE_SCAN not in ("", "off") and supports_iterative_scan(version)
+    if vectordb.iterative_scan:
+        conn.execute(SQL("SET hnsw.iterative_scan = {}").format(Literal(VECTOR_ITERATIVE_SCAN)))
+    print(f"pgvector {version}, filtered searches {'scan iteratively' if vectordb.iterative_scan else 'are exact'}")
+    vectordb.drop_table(table)
+    vectordb.create_table(table, DIMENSIONS, indexes=False)
+    start = time.perf_counter()
+    load(conn, table, rows)
+    print(f"{rows} rows, {DIMENSIONS} dimensions: loaded in {time.perf_counter() - start:.1f}s")
+    start = time.perf_counter()
+    vectordb.create_indexes(table)
+    conn.execute(SQL("ANALYZE {}").format(Identifier(table)))
+    print(f"indexes built in {time.perf_counter() - start:.1f}s")
+
+    rng = np.random.default_rng([SEED, -1])
+    queries = rng.standard_normal((QUERIES, DIMENSIONS), dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    users = rng.integers(0, USERS, QUERIES).tolist()
+    truth, truth_filtered = exact(rows, queries, users)
+
+    print(f"{'ef_search':<12}{'filter':<8}{'recall@' + str(K):>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for ef_search in EF_SEARCH:
+        conn.execute(SQL("SET hnsw.ef_search = {}").format(Literal(ef_search)))
+        for filtered, expected in ((False, truth), (True, truth_filtered)):
+            recall, p50, p95 = measure(conn, vectordb, table, queries, users, expected, filtered)
+            print(f"{ef_search:<12}{'user' if filtered else 'none':<8}{recall:>10.3f}{p50:>10.2f}{p95:>10.2f}")
+    vectordb.drop_table(table)
+
+
+def main():
+    """benchmark every size"""
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    with psycopg.connect(**connection_kwargs()) as conn:
+        conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        register_vector(conn)
+        for rows in sizes:
+            run(conn, rows)
+
+
+if __name__ == "__main__":
+    main()
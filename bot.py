@@ -38,38 +38,46 @@ else:
 with open("version", encoding="utf-8") as f:
     version = f.read().strip()
 
-bot = Bot(
-    settings=Settings(
-        MATTERMOST_URL=env.str("MM_URL"),
-        MATTERMOST_PORT=env.int("MM_PORT", 443),
-        MATTERMOST_API_PATH=env.str("MM_API_PATH", "/api/v4"),
-        BOT_TOKEN=env.str("MM_BOT_TOKEN"),
-        BOT_TEAM=env.str("MM_BOT_TEAM"),
-        SSL_VERIFY=env.bool("MM_SSL_VERIFY", True),
-        DEBUG=debug,
-    ),  # Either specify your settings here or as environment variables.
-    # Add your own plugins here.
-    plugins=[
-        Users(),
-        ChatGPT(),
-        Xai(),
-        #        Docker(),
-        Anthropic(),
-        Pushups(),
-        TTS(),
-        ShellCmds(),
-        ValkeyTool(),
-        # Ollama(),
-        HIPB(),
-        Calc(),
-        Giphy(),
-        Ntp(),
-        Jira(),
-        VectorDb(),
-        IntervalsIcu(),
-        LogManager(),
-        Version(),
-    ],
-    enable_logging=True,
-)
-bot.run()
+
+def main():
+    """start the bot"""
+    bot = Bot(
+        settings=Settings(
+            MATTERMOST_URL=env.str("MM_URL"),
+            MATTERMOST_PORT=env.int("MM_PORT", 443),
+            MATTERMOST_API_PATH=env.str("MM_API_PATH", "/api/v4"),
+            BOT_TOKEN=env.str("MM_BOT_TOKEN"),
+            BOT_TEAM=env.str("MM_BOT_TEAM"),
+            SSL_VERIFY=env.bool("MM_SSL_VERIFY", True),
+            DEBUG=debug,
+        ),  # Either specify your settings here or as environment variables.
+        # Add your own plugins here.
+        plugins=[
+            Users(),
+            ChatGPT(),
+            Xai(),
+            #        Docker(),
+            Anthropic(),
+            Pushups(),
+            TTS(),
+            ShellCmds(),
+            ValkeyTool(),
+            # Ollama(),
+            HIPB(),
+            Calc(),
+            Giphy(),
+            Ntp(),
+            Jira(),
+            VectorDb(),
+            IntervalsIcu(),
+            LogManager(),
+            Version(),
+        ],
+        enable_logging=True,
+    )
+    bot.run()
+
+
+# plugins may start worker processes that import this module again
+if __name__ == "__main__":
+    main()
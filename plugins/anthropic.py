@@ -1,10 +1,8 @@
 """ChatGPT plugin for mmpy_bot"""
 
-import time
 import json
 from re import DOTALL as re_DOTALL
 from pprint import pformat
-import jsonpickle
 
 from environs import Env
 from anthropic import (
@@ -24,6 +22,8 @@ from mmpy_bot.settings import Settings
 from mmpy_bot.wrappers import Message
 
 from plugins.base import PluginLoader
+from plugins.streamrenderer import StreamRenderer, reply_with_files
+from plugins.threadcache import ThreadCache
 
 env = Env()
 
@@ -86,6 +86,12 @@ AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
         settings: Settings,
     ):
         super().initialize(driver, plugin_manager, settings)
+        self.thread_cache = ThreadCache(
+            self.helper.valkey_bytes,
+            self.helper.valkey_serialize,
+            self.helper.valkey_deserialize,
+            async_valkey=lambda: self.helper.avalkey_bytes,
+        )
         # Fetch available models from Anthropic API on startup
         try:
             self.fetch_available_models()
@@ -237,24 +243,30 @@ AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
             value = self.ANTHROPIC_DEFAULTS[key]
         return value
 
-    def thread_append(self, thread_id, message) -> None:
+    async def async_get_anthropic_setting(self, key: str):
+        """awaitable version of get_anthropic_setting"""
+        value = await self.helper.avalkey.hget(self.SETTINGS_KEY, key)
+        if value is None and key in self.ANTHROPIC_DEFAULTS:
+            value = self.ANTHROPIC_DEFAULTS[key]
+        return value
+
+    async def thread_append(self, thread_id, message) -> None:
         """append a message to a chatlog"""
         thread_key = VALKEY_PREPEND + thread_id
-        self.valkey.rpush(thread_key, self.helper.valkey_serialize_json(message))
+        await self.thread_cache.async_append(thread_key, message)
 
-    def get_thread_messages(self, thread_id: str, force_fetch: bool = False):
+    async def get_thread_messages(self, thread_id: str, force_fetch: bool = False):
         """get the message thread from the thread_id"""
         messages = []
         thread_key = VALKEY_PREPEND + thread_id
-        if not force_fetch and self.valkey.exists(thread_key):
-            # the thread exists in valkey and we are running a tool.
-            messages = self.get_thread_messages_from_valkey(thread_id)
-        else:
+        if not force_fetch:
+            # use the cached thread if it exists in valkey
+            messages = await self.thread_cache.async_get(thread_key)
+        if not messages:
             # thread does not exist, fetch all posts in thread
-            thread = self.driver.get_post_thread(thread_id)
+            posts = await self.helper.get_thread_posts(thread_id)
             user_message_content = ""
-            for thread_index in thread["order"]:
-                thread_post = thread["posts"][thread_index]
+            for thread_post in posts:
                 # turn the thread post into a Message object
                 thread_post = Message.create_message(thread_post)
                 # self.helper.slog(f"Processing post: {thread_post.text[:50]}...")  # Log first 50 chars
@@ -285,21 +297,21 @@ AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
                             "content": user_message_content.strip(),
                         }
                         messages.append(user_message)
-                        self.thread_append(thread_id, user_message)
                         user_message_content = ""
 
                     # create message object for the assistant message
                     assistant_message = {"role": role,
                                          "content": thread_post.text}
                     messages.append(assistant_message)
-                    self.thread_append(thread_id, assistant_message)
 
             # if there are any remaining user messages, create a message object and append it
             if user_message_content:
                 user_message = {"role": "user",
                                 "content": user_message_content.strip()}
                 messages.append(user_message)
-                self.thread_append(thread_id, user_message)
+            if messages:
+                # write the whole thread to valkey in one go
+                await self.thread_cache.async_append(thread_key, *messages)
 
         return messages
 
@@ -347,10 +359,10 @@ AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
         if model is None:
             model = self.get_latest_model("claude-3-7-sonnet-")
         if model is None:
-            model = self.get_anthropic_setting("model") or self.DEFAULT_MODEL
+            model = await self.async_get_anthropic_setting("model") or self.DEFAULT_MODEL
         # if message is not from a user, ignore
         # await self.helper.log(f"chat from {message.sender_name} to {model}")
-        if not self.users.is_user(message.sender_name):
+        if not await self.users.async_is_user(message.sender_name):
             return
 
         # message text exceptions. bail if message starts with any of these
@@ -362,7 +374,7 @@ AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
         # fetches all posts in the thread and adds them to valkey
         thread_id = message.reply_id
         messages = []
-        messages = self.get_thread_messages(thread_id)
+        messages = await self.get_thread_messages(thread_id)
         if len(messages) != 1:
             # remove mentions of self
             message.text = self.helper.strip_self_username(message.text)
@@ -382,7 +394,7 @@ AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
                 message_append = {"role": "user", "content": message.text}
                 # append to messages and valkey
                 messages.append(message_append)
-                self.thread_append(thread_id, message_append)
+                await self.thread_append(thread_id, message_append)
 
         # add thought balloon to show assistant is thinking
         self.driver.react_to(message, "thought_balloon")
@@ -397,13 +409,17 @@ AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
         reply_msg_id = self.driver.reply_to(message, full_message)["id"]
 
         # self.helper.debug(f"reply_msg_id: {reply_msg_id}")
-        # get current time and set that as last_update_time
-        last_update_time = time.time()
         # get the setting for how often to update the message
         stream_update_delay_ms = float(
-            self.get_anthropic_setting("stream_update_delay_ms")
+            await self.async_get_anthropic_setting("stream_update_delay_ms")
+        )
+        renderer = StreamRenderer(
+            self.driver,
+            reply_msg_id,
+            post_prefix,
+            delay_ms=stream_update_delay_ms,
+            helper=self.helper,
         )
-        i = 0
         try:
             # await self.helper.log("Messages being sent to Anthropic API:")
             # for idx, msg in enumerate(messages):
@@ -411,9 +427,9 @@ AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
             async with aclient.with_options(max_retries=5).messages.stream(
                 max_tokens=self.MAX_TOKENS_PER_MODEL[model],
                 messages=messages,
-                system=self.get_anthropic_setting("system").replace("\n", " "),
+                system=(await self.async_get_anthropic_setting("system")).replace("\n", " "),
                 model=model,
-                temperature=float(self.get_anthropic_setting("temperature")),
+                temperature=float(await self.async_get_anthropic_setting("temperature")),
             ) as stream:
                 async for text in stream.text_stream:
                     # await self.helper.debug(text)
@@ -421,43 +437,7 @@ AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
                     # if the message has content, add it to the full message
                     if text:
                         full_message += text
-                        # if full message begins with ``` or any other mattermost markdown append a \
-                        # newline to the post_prefix so it renders correctly
-                        markdown = [
-                            ">",
-                            "*",
-                            "_",
-                            "-",
-                            "+",
-                            "1",
-                            "~",
-                            "!",
-                            "`",
-                            "|",
-                            "#",
-                            "@",
-                            "•",
-                        ]
-                        if (
-                            i == 0
-                            and post_prefix[-1] != "\n"
-                            and full_message[0] in markdown
-                        ):
-                            post_prefix += "\n"
-                            i += 1
-
-                        # await self.helper.debug((time.time() - last_update_time) * 1000)
-                        if (
-                            time.time() - last_update_time
-                        ) * 1000 > stream_update_delay_ms:
-                            # await self.helper.debug("updating message")
-                            # update the message
-                            self.driver.posts.patch_post(
-                                reply_msg_id,
-                                {"message": f"{post_prefix}{full_message}"},
-                            )
-                            # update last_update_time
-                            last_update_time = time.time()
+                        renderer.append(text)
         except (
             BadRequestError,
             APIStatusError,
@@ -469,14 +449,12 @@ AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
             await self.helper.debug(
                 f"Exception {exception_type}: {pformat(anthropic_exception)}"
             )
-            # update the message to show the error
-            self.driver.posts.patch_post(
-                reply_msg_id,
-                {
-                    "message": f"{post_prefix}{full_message}\n\
-Exception {exception_type}: {pformat(anthropic_exception)}"
-                },
+            # update the message to show the error, a long one goes in a file
+            files = await renderer.finish(
+                f"{full_message}\nException {exception_type}: {pformat(anthropic_exception)}"
             )
+            if files:
+                reply_with_files(self.driver, self.helper, message, files)
             # post reaction to message
             self.driver.reactions.delete_reaction(
                 self.driver.user_id, message.id, "thought_balloon"
@@ -489,14 +467,17 @@ Exception {exception_type}: {pformat(anthropic_exception)}"
             # bail out of the function so we don't append to
             # the chatlog
             return
+        finally:
+            # make sure no frame lands after we are done
+            await renderer.stop()
 
         # update the message a final time to make sure we have the full message
-        self.driver.posts.patch_post(
-            reply_msg_id, {"message": f"{post_prefix}{full_message}"}
-        )
+        files = await renderer.finish()
+        if files:
+            reply_with_files(self.driver, self.helper, message, files)
 
         # add response to chatlog
-        self.thread_append(
+        await self.thread_append(
             thread_id, {"role": "assistant", "content": full_message})
 
         # remove thought balloon after successful response
@@ -506,40 +487,21 @@ Exception {exception_type}: {pformat(anthropic_exception)}"
 
         await self.helper.log(f"User: {message.sender_name} used {model}")
 
-    def append_thread_and_get_messages(self, thread_id, msg):
+    async def append_thread_and_get_messages(self, thread_id, msg):
         """append a message to a chatlog"""
         # self.helper.slog(f"append_chatlog {thread_id} {msg}")
         expiry = 60 * 60 * 24 * 7
         thread_key = VALKEY_PREPEND + thread_id
-        self.valkey.rpush(thread_key, self.valkey_serialize_json(msg))
-        self.valkey.expire(thread_key, expiry)
-        messages = self.helper.valkey_deserialize_json(
-            self.valkey.lrange(thread_key, 0, -1)
-        )
+        await self.thread_cache.async_append(thread_key, msg, expiry=expiry)
+        messages = await self.thread_cache.async_get(thread_key)
         return messages
 
     def get_thread_messages_from_valkey(self, thread_id):
         """get a chatlog"""
         thread_key = VALKEY_PREPEND + thread_id
-        messages = self.helper.valkey_deserialize_json(
-            self.valkey.lrange(thread_key, 0, -1)
-        )
+        messages = self.thread_cache.get(thread_key)
         return messages
 
-    @staticmethod
-    def valkey_serialize_json(msg):
-        """serialize a message to json, using a custom serializer for types not
-        handled by the default json serialization"""
-        # return json.dumps(msg)
-        return jsonpickle.encode(msg, unpicklable=False)
-
-    @staticmethod
-    def valkey_deserialize_json(msg):
-        """deserialize a message from json"""
-        if isinstance(msg, list):
-            return [jsonpickle.decode(m) for m in msg]
-        return jsonpickle.decode(msg)
-
 
 if __name__ == "__main__":
     Anthropic()
@@ -5,7 +5,6 @@ from mmpy_bot.plugins.base import PluginManager
 from mmpy_bot.settings import Settings
 from plugins.base import PluginLoader
 from redis_rate_limit import RateLimit, TooManyRequests
-import requests
 
 
 class Calc(PluginLoader):
@@ -49,7 +48,7 @@ class Calc(PluginLoader):
                     # urlencode the text
                     urlencoded_text = self.helper.urlencode_text(text)
                     # get the result from mathjs api https://api.mathjs.org/v4/?expr=<text>
-                    response = requests.get(
+                    response = await self.helper.fetch(
                         f"https://api.mathjs.org/v4/?expr={urlencoded_text}"
                     )
                     # format the result in mattermost markdown
@@ -12,7 +12,6 @@ import schedule
 import aiodocker
 import aiodocker.types
 import aiohttp.client_exceptions as aiohttp_client_exceptions
-import jsonpickle
 import magic
 import openai
 from environs import Env
@@ -26,6 +25,9 @@ from .vectordb import VectorDb, UsageContext
 from PIL import Image
 
 from .base import PluginLoader
+from .streamrenderer import StreamRenderer, reply_with_files
+from .threadcache import ThreadBatch, ThreadCache
+from .contextwindow import ContextWindow
 from .tools import Tool, ToolsManager
 from .users import UserIsSystem
 
@@ -44,6 +46,8 @@ aclient = AsyncOpenAI(api_key=env.str("OPENAI_API_KEY"))
 
 MODEL = "gpt-4-1106-preview"
 VALKEY_PREPEND = "thread_"
+# threads expire a week after the last turn
+THREAD_EXPIRY = 60 * 60 * 24 * 7
 
 # Custom Exceptions
 
@@ -86,6 +90,27 @@ class ChatGPT(PluginLoader):
         "gpt-4-turbo": 7000,
         "gpt-4-0125-preview": 7000,
     }
+    # context windows in tokens, the longest matching prefix of a model wins
+    CONTEXT_TOKENS_PER_MODEL = {
+        "gpt-3.5-turbo": 16385,
+        "gpt-3.5-turbo-0301": 4096,
+        "gpt-4": 8192,
+        "gpt-4-32k": 32768,
+        "gpt-4-turbo": 128000,
+        "gpt-4-1106-preview": 128000,
+        "gpt-4-0125-preview": 128000,
+        "gpt-4-vision": 128000,
+        "gpt-4o": 128000,
+        "gpt-4.1": 1047576,
+        "gpt-4.5": 128000,
+        # the input limit, the rest of the window is for the output
+        "gpt-5": 272000,
+        "o1": 200000,
+        "o1-mini": 128000,
+        "o1-preview": 128000,
+        "o3": 200000,
+        "o4-mini": 200000,
+    }
     ChatGPT_DEFAULTS = {
         "temperature": 1.0,
         "system": (
@@ -107,6 +132,16 @@ class ChatGPT(PluginLoader):
         "chatgpt_memories_channel": "true",
         "chatgpt_memories_direct": "true",
         "chatgpt_memories_any": "true",
+        # context window of models missing from CONTEXT_TOKENS_PER_MODEL
+        "context_max_tokens": 16000,
+        # tokens of the context window kept free for the completion
+        "context_output_reserve": 4096,
+        "tool_concurrency": 4,
+        "tool_timeout": 120,
+        # web_search_and_download: pages to return, downloads in flight and seconds per page
+        "search_download_count": 2,
+        "search_download_parallel": 3,
+        "search_download_timeout": 15,
     }
     SETTINGS_KEY = "chatgpt_settings"
 
@@ -129,6 +164,12 @@ class ChatGPT(PluginLoader):
         settings: Settings,
     ):
         super().initialize(driver, plugin_manager, settings)
+        self.thread_cache = ThreadCache(
+            self.helper.valkey_bytes,
+            self.helper.valkey_serialize,
+            self.helper.valkey_deserialize,
+            async_valkey=lambda: self.helper.avalkey_bytes,
+        )
         # Apply default model to valkey if not set and set self.model
         self.model = self.valkey.hget(self.SETTINGS_KEY, "model")
         if self.model is None:
@@ -138,7 +179,9 @@ class ChatGPT(PluginLoader):
         for key, value in self.ChatGPT_DEFAULTS.items():
             if self.valkey.hget(self.SETTINGS_KEY, key) is None:
                 self.valkey.hset(self.SETTINGS_KEY, key, value)
-        self.vectordb = VectorDb()
+        # one pool and one schema check for the whole bot
+        self.vectordb = self.helper.plugins.get("vectordb") or VectorDb.shared()
+        self.context_window = ContextWindow()
         self.usage_context = UsageContext
         # emulate a browser and set all the relevant headers
         self.headers = {
@@ -182,7 +225,7 @@ class ChatGPT(PluginLoader):
         )
 
         web_search_and_download_tool = Tool(
-            function=self.helper.web_search_and_download,
+            function=self.web_search_and_download,
             description="Search the web AND download content from the best matching webpage. Use this when you need detailed information about a topic and want to provide accurate quotes and sources. IMPORTANT: Only use this when you need in-depth information, not for quick facts or simple searches.",
             parameters=["searchterm"],
             privilege_level="user",
@@ -229,6 +272,7 @@ class ChatGPT(PluginLoader):
                 },
             ],
             privilege_level="user",
+            timeout=300,
         )
         text_to_speech_tool = Tool(
             function=self.text_to_speech_tool,
@@ -365,6 +409,8 @@ class ChatGPT(PluginLoader):
                 },
             ],
             privilege_level="admin",
+            # the container itself may run for 10 minutes
+            timeout=900,
         )
 
         self.tools_manager = ToolsManager()
@@ -420,11 +466,11 @@ class ChatGPT(PluginLoader):
         if mode.lower() == "id":
             if memory_id is None:
                 return "Error: memory_id must be set when mode is id"
-            self.vectordb.user_delete_memory_by_id(memory_id, message.user_id, usage_context, source_type, source)
+            await self.vectordb.user_delete_memory_by_id(memory_id, message.user_id, usage_context, source_type, source)
         elif mode.lower() == "all":
-            self.vectordb.user_delete_all_memories(message.user_id)
+            await self.vectordb.user_delete_all_memories(message.user_id)
         else:
-            self.vectordb.user_delete_all_memories_in_context(message.user_id, usage_context, source_type, source)
+            await self.vectordb.user_delete_all_memories_in_context(message.user_id, usage_context, source_type, source)
         return f"Memory or memories deleted for {mode} mode"
     @listen_to("^.gpt memories get")
     async def get_user_memories(self, message: Message, tool_run=False):
@@ -437,7 +483,7 @@ class ChatGPT(PluginLoader):
             usage_context = self.usage_context.CHANNEL
             source_type = "channel"
             source = message.channel_id
-        memories = self.vectordb.get_all_memories_for_user_for_context(message.user_id, usage_context, source_type, source)
+        memories = await self.vectordb.get_all_memories_for_user_for_context(message.user_id, usage_context, source_type, source)
         # Convert datetime objects to strings
         for memory in memories:
             if 'created_at' in memory:
@@ -454,7 +500,7 @@ class ChatGPT(PluginLoader):
             usage_context = self.usage_context.CHANNEL
             source_type = "channel"
             source = message.channel_id
-        memories = self.vectordb.get_memories(user=message.user_id, usage_context=usage_context, query=search, source_type=source_type, source=source)
+        memories = await self.vectordb.get_memories(user=message.user_id, usage_context=usage_context, query=search, source_type=source_type, source=source)
         # Convert datetime objects to strings
         for memory in memories:
             if 'created_at' in memory:
@@ -478,7 +524,7 @@ class ChatGPT(PluginLoader):
             usage_context = self.usage_context.CHANNEL
             source_type = "channel"
             source = message.channel_id
-        self.vectordb.store_memory(usage_context=usage_context, content=memory, user=message.user_id, source_type=source_type, source=source, tags=tags)
+        await self.vectordb.store_memory(usage_context=usage_context, content=memory, user=message.user_id, source_type=source_type, source=source, tags=tags)
         return "Memory saved"
     async def enable_disable_memories_user(self, message: Message, action: str, context: str = "any", tool_run=False):
         """Enable/Disable memories for the user"""
@@ -912,10 +958,51 @@ if files:
         self.helper.slog(models_msg)
         return available_models
 
-    def return_last_x_messages(self, messages):
-        """return last x messages from list of messages limited by max_length_in_tokens"""
-        # fuck this bs
-        return messages
+    def context_tokens(self, model: str) -> int | None:
+        """the context window of a model, None if it is not known"""
+        prefixes = [prefix for prefix in self.CONTEXT_TOKENS_PER_MODEL if model.startswith(prefix)]
+        if not prefixes:
+            return None
+        return self.CONTEXT_TOKENS_PER_MODEL[max(prefixes, key=len)]
+
+    async def return_last_x_messages(self, messages, model=None, thread_id=None, digests=None, tools=None):
+        """return the newest messages that fit inside the context window of the model
+
+        the window is shared with the completion and the tool definitions so
+        context_output_reserve and the tokens of tools are kept free. digests
+        maps the id of messages read from the thread cache to the digest the
+        cache took of them, other messages are hashed here.
+        """
+        if model is None:
+            model = self.model
+        if digests is None:
+            digests = {}
+        context_tokens = self.context_tokens(model)
+        if context_tokens is None:
+            context_tokens = int(await self.async_get_chatgpt_setting("context_max_tokens"))
+        max_tokens = (
+            context_tokens
+            - int(await self.async_get_chatgpt_setting("context_output_reserve"))
+            - self.context_window.count_tools(tools, model)
+        )
+        known_counts = {}
+        tokens_key = f"{VALKEY_PREPEND}_tokens_{thread_id}"
+        keys = [self.context_window.message_key(m, model, digests.get(id(m))) for m in messages]
+        if thread_id is not None and keys:
+            # token counts are persisted per thread so restarts don't recount
+            cached = await self.helper.avalkey.hmget(tokens_key, keys)
+            known_counts = {
+                key: count for key, count in zip(keys, cached) if count is not None
+            }
+        counts, _, new_counts = self.context_window.count_messages(
+            messages, model, known_counts, keys
+        )
+        if thread_id is not None and new_counts:
+            pipe = self.helper.avalkey.pipeline(transaction=False)
+            pipe.hset(tokens_key, mapping=new_counts)
+            pipe.expire(tokens_key, 60 * 60 * 24 * 7)
+            await pipe.execute()
+        return self.context_window.fit(messages, model, max_tokens, counts)
 
     @listen_to(r"^\.gpt model available")
     async def get_available_models(self, message: Message):
@@ -983,7 +1070,7 @@ if files:
             # self.helper.slog(f"image_url: {image_url}")
             revised_prompt = response.data[0].revised_prompt
             # self.helper.slog(f"revised_prompt: {revised_prompt}")
-            filename = self.helper.download_file_to_tmp(image_url, "png")
+            filename = await self.helper.download_file_to_tmp(image_url, "png")
             # self.helper.slog(f"filename: {filename}")
             return f"revised prompt: {revised_prompt}", filename
         # pylint: disable=broad-except
@@ -1062,6 +1149,13 @@ if files:
             value = self.ChatGPT_DEFAULTS[key]
         return value
 
+    async def async_get_chatgpt_setting(self, key: str):
+        """awaitable version of get_chatgpt_setting"""
+        value = await self.helper.avalkey.hget(self.SETTINGS_KEY, key)
+        if value is None and key in self.ChatGPT_DEFAULTS:
+            value = self.ChatGPT_DEFAULTS[key]
+        return value
+
     def extract_file_details(self, message: Message, use_preview_image=False):
         """Extract file details from a post and return a list of objects with their filename, type, and content."""
         data = message.body["data"]
@@ -1219,40 +1313,44 @@ if files:
 
         return files
 
-    def thread_append(self, thread_id, message) -> None:
+    async def thread_append(self, thread_id, message) -> None:
         """append a message to a thread"""
         thread_key = VALKEY_PREPEND + thread_id
-        self.valkey.rpush(thread_key, self.helper.valkey_serialize_json(message))
+        await self.thread_cache.async_append(thread_key, message)
 
     def update_system_prompt_in_thread(self, thread_id: str, prompt: str):
         """update the system prompt in the thread in valkey"""
         thread_key = VALKEY_PREPEND + thread_id
         # find the message with the role = system and update it
         messages = self.get_thread_messages_from_valkey(thread_id)
-        for message in messages:
+        for index, message in enumerate(messages):
             if message["role"] == "system":
                 # update the valkey message with the new prompt
                 message["content"] = prompt
-                self.valkey.set(thread_key, self.helper.valkey_serialize_json(messages))
+                self.helper.valkey_bytes.lset(
+                    thread_key, index, self.helper.valkey_serialize(message)
+                )
+                # the thread was rewritten in place, drop it from the cache
+                self.thread_cache.invalidate(thread_key)
                 break
-    def get_thread_messages(self, thread_id: str, force_fetch: bool = False):
+
+    async def get_thread_messages(self, thread_id: str, force_fetch: bool = False):
         """get the message thread from the thread_id"""
         messages = []
         thread_key = VALKEY_PREPEND + thread_id
-        if not force_fetch and self.valkey.exists(thread_key):
-            # the thread exists in valkey and we are running a tool.
-            messages = self.get_thread_messages_from_valkey(thread_id)
-        else:
+        if not force_fetch:
+            # use the cached thread if it exists in valkey
+            messages = await self.thread_cache.async_get(thread_key)
+        if not messages:
             # thread does not exist, fetch all posts in thread
-            thread = self.driver.get_post_thread(thread_id)
-            i = 0
-            thread_post_count = len(thread["posts"])
-            for thread_index in thread["order"]:
-                i += 1
-                # skip the last post
-                if i == thread_post_count:
-                    continue
-                thread_post = thread["posts"][thread_index]
+            posts = await self.helper.get_thread_posts(thread_id)
+            # skip the last post
+            posts = posts[:-1]
+            # look up the authors of the thread at once
+            usernames = await self.users.async_ids_to_usernames(
+                [post["user_id"] for post in posts]
+            )
+            for thread_post in posts:
                 # turn the thread post into a Message object
                 thread_post = Message.create_message(thread_post)
 
@@ -1270,15 +1368,16 @@ if files:
                     # post is from user, set role to user
                     role = "user"
                     # get the username from the user_id from the thread_post
-                    username = self.users.id2u(thread_post.user_id)
+                    username = usernames.get(thread_post.user_id)
                     # if the username is not None prepend it to the message
                     if username:
                         thread_post.text = f"@{username}: {thread_post.text}"
 
-                # create message object and append it to messages and valkey
-                message = {"role": role, "content": thread_post.text}
-                messages.append(message)
-                self.thread_append(thread_id, message)
+                # create message object and append it to messages
+                messages.append({"role": role, "content": thread_post.text})
+            if messages:
+                # write the whole thread to valkey in one go
+                await self.thread_cache.async_append(thread_key, *messages)
         # messages = self.get_formatted_messages(messages)
         return messages
 
@@ -1385,28 +1484,47 @@ if files:
                 )
         return response
     # function to get the custom prompt for a channel if it exists otherwise return the default prompt
-    def get_custom_system_prompt(self, channel_id):
+    async def get_custom_system_prompt(self, channel_id):
         """get the custom prompt for a channel if it exists otherwise return the default prompt"""
-        custom_prompt = self.valkey.hget("custom_system_prompts", channel_id)
+        custom_prompt = await self.helper.avalkey.hget("custom_system_prompts", channel_id)
         if custom_prompt:
             return custom_prompt
         # try and get the custom prompt configured in valkey before returning the default prompt from the class
-        prompt = self.get_chatgpt_setting("system")
+        prompt = await self.async_get_chatgpt_setting("system")
         if prompt:
             return prompt
         return self.ChatGPT_DEFAULTS["system"]
     async def is_memories_enabled(self, message: Message):
         it_is_true = ["true", "True", "", None, True]
-        if self.get_chatgpt_setting("chatgpt_memories_direct") and message.is_direct_message:
-            if self.get_chatgpt_setting(f"chatgpt_memories_{message.user_id}_direct") in it_is_true:
+        if await self.async_get_chatgpt_setting("chatgpt_memories_direct") and message.is_direct_message:
+            if await self.async_get_chatgpt_setting(f"chatgpt_memories_{message.user_id}_direct") in it_is_true:
                 # await self.helper.log(f"memories_enabled: {True} for {message.user_id} in direct")
                 return True
-        if self.get_chatgpt_setting("chatgpt_memories_channel") and not message.is_direct_message :
-            if self.get_chatgpt_setting(f"chatgpt_memories_{message.user_id}_channel_{message.channel_id}") in it_is_true:
+        if await self.async_get_chatgpt_setting("chatgpt_memories_channel") and not message.is_direct_message :
+            if await self.async_get_chatgpt_setting(f"chatgpt_memories_{message.user_id}_channel_{message.channel_id}") in it_is_true:
                 # await self.helper.log(f"memories_enabled: {True} for {message.user_id} in channel {message.channel_id}")
                 return True
         # await self.helper.log(f"memories_enabled: {False} for {message.user_id} in channel {message.channel_id} and direct is {message.is_direct_message}")
         return False
+    async def get_thread_memories(self, message: Message, usage_context, source_type: str, source: str):
+        """get the memories of the user that are not loaded in the thread yet"""
+        # the ids of the memories already loaded in this thread are kept in valkey
+        memkey = f"memories_loaded_{message.reply_id}"
+        loaded_ids = {int(memory_id) for memory_id in await self.helper.avalkey.lrange(memkey, 0, -1)}
+        memories = await self.vectordb.get_new_memories(
+            query=message.text,
+            usage_context=usage_context,
+            user=message.user_id,
+            source_type=source_type,
+            source=source,
+            loaded_ids=loaded_ids,
+        )
+        if memories:
+            new_memory_ids = [memory["id"] for memory in memories]
+            await self.helper.log(f"new_memory_ids: {new_memory_ids}")
+            await self.helper.avalkey.rpush(memkey, *new_memory_ids)
+        return memories
+
     # soon to be deprecated
     # @listen_to(".+", needs_mention=True)
     # async def chat_moved(self, message: Message):
@@ -1418,8 +1536,113 @@ if files:
     #    await self.chat(message)
     async def chat(self, message: Message, model: str = None):
         """listen to everything and respond when mentioned"""
+        # every thread write of the turn goes to valkey in one MULTI when it ends
+        batch = self.thread_cache.batch(
+            VALKEY_PREPEND + message.reply_id, expiry=THREAD_EXPIRY
+        )
+        try:
+            await self.chat_turn(message, model, batch)
+        finally:
+            await batch.async_flush()
+
+    async def web_search_and_download(self, searchterm):
+        """search the web and download the top results using the search_download settings"""
+        return await self.helper.web_search_and_download(
+            searchterm,
+            wanted=int(await self.async_get_chatgpt_setting("search_download_count")),
+            parallel=int(await self.async_get_chatgpt_setting("search_download_parallel")),
+            deadline=float(await self.async_get_chatgpt_setting("search_download_timeout")),
+        )
+
+    async def run_tool_call(
+        self, message: Message, tool_function: dict, update_status, timeout: float
+    ):
+        """run one tool call, returns the tool result message and the files it created"""
+        function_name = tool_function["function_name"]
+        # get function name from the tool manager
+        tool = self.tools_manager.get_tool(function_name)
+        if not tool:
+            await self.helper.log(f"Error: function not found: {function_name}")
+            return None
+        try:
+            arguments = json.loads(tool_function["arguments"])
+        except json.JSONDecodeError:
+            await self.helper.log(f"Error parsing arguments: {tool_function['arguments']}")
+            arguments = {}
+        # format the arguments as key: value for the status msg
+        status_args = " | ".join([f"{k}:{v}" for k, v in arguments.items()])
+        update_status(f"Running tool: {function_name}: {status_args}")
+        # if the tool has "needs_message_object" set to True, pass the message object to the function with the args
+        if tool.needs_message_object:
+            arguments["message"] = message
+        if tool.needs_self:
+            arguments["self"] = self
+        if tool.timeout is not None:
+            timeout = tool.timeout
+        files = []
+        try:
+            # Execute the function
+            function_result = await asyncio.wait_for(tool.function(**arguments), timeout)
+            if tool.returns_files:
+                function_result, filename = function_result
+                if isinstance(filename, list):
+                    files.extend(filename)
+                if isinstance(filename, str):
+                    files.append(filename)
+        except asyncio.TimeoutError:
+            function_result = f"Error: {function_name} timed out after {timeout:g} seconds"
+            update_status(function_result)
+        # pylint: disable=broad-except
+        except Exception as error:
+            await self.helper.log(f"Error running tool {function_name}: {error}")
+            function_result = f"Error: {error}"
+            update_status(function_result)
+
+        if function_result is None:
+            function_result = "Error: function returned None"
+            update_status(f"Error: {function_result}")
+        elif not isinstance(function_result, str):
+            try:
+                function_result = json.dumps(function_result)
+            except (TypeError, ValueError):
+                function_result = "Error: could not serialize function result"
+                update_status(f"Error: {function_result}")
+
+        update_status(f"Completed: {function_name}")
+        return {
+            "tool_call_id": tool_function["tool_call_id"],
+            "role": "tool",
+            "name": function_name,
+            "content": function_result[:20000],
+        }, files
+
+    async def run_tool_calls(
+        self,
+        message: Message,
+        tool_calls: dict,
+        update_status,
+        concurrency: int,
+        timeout: float,
+    ) -> list:
+        """run independent tool calls concurrently, results are in tool call order"""
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def run(index, tool_function):
+            async with semaphore:
+                return await self.run_tool_call(
+                    message,
+                    tool_function,
+                    lambda status_msg: update_status(index, status_msg),
+                    timeout,
+                )
+
+        return await asyncio.gather(
+            *(run(index, tool_function) for index, tool_function in tool_calls.items())
+        )
+
+    async def chat_turn(self, message: Message, model: str, batch: ThreadBatch):
+        """answer a message, thread writes are collected in batch"""
         # set some variables
-        max_message_length = 14000
         files = []
         if model is None:
             model = self.model
@@ -1430,13 +1653,13 @@ if files:
             tool_run = True
         try:
             # if message is not from a user, ignore
-            if not self.users.is_user(message.sender_name):
+            if not await self.users.async_is_user(message.sender_name):
                 return
         except UserIsSystem:
             return
 
         # check if the user is and admin and set tools accordingly
-        if self.users.is_admin(message.sender_name):
+        if await self.users.async_is_admin(message.sender_name):
             # pylint: disable=attribute-defined-outside-init
             self.tools = self.admin_tools
         else:
@@ -1458,70 +1681,46 @@ if files:
             rag_usage_context = UsageContext.CHANNEL
             rag_source_type = "channel"
             rag_source = message.channel_id
-        memories_enabled = False
-        if await self.is_memories_enabled(message):
-            memories_enabled = True
-            memories = []
-            # get memories from vectordb
-            if self.vectordb.user_has_memories(
-                user=message.user_id, usage_context=rag_usage_context, source=rag_source, source_type=rag_source_type
-            ):
-                # lets check if we already have any memories loaded in this thread_id
-                memkey = f"memories_loaded_{message.reply_id}"
-                memory_ids = self.valkey.lrange(memkey, 0, -1)
-                # convert them all into integers
-                memory_ids = [int(memory_id) for memory_id in memory_ids]
-                await self.helper.log(f"memory_ids: {memory_ids}")
-                if memory_ids:
-                    # fetch the memories from vectordb with a not_ids filter
-                    memories = self.vectordb.get_memories(
-                        query=message.text, user=message.user_id, usage_context=rag_usage_context, source=rag_source, source_type=rag_source_type, not_ids=memory_ids
-                    )
-                    # we have memories in this thread_id lets filter out the ones we already have
-                    memories = [memory for memory in memories if memory["id"] not in memory_ids]
-                    # we have memories after excluding the ones we already have
-                    if memories:
-                        # lets store the id's of the memories in a list so we can make sure we don't load them in next time save them in valkey for the thread_id in a list
-                        new_memory_ids = [memory["id"] for memory in memories]
-                        await self.helper.log(f"new_memory_ids: {new_memory_ids}")
-                        # save them with the thread_id as the key
-                        self.valkey.rpush(memkey, *new_memory_ids)
-                else:
-                    memories = self.vectordb.get_memories(
-                        query=message.text, user=message.user_id, usage_context=rag_usage_context, source=rag_source, source_type=rag_source_type
-                    )
-                    # we don't have any memories in this thread_id so lets save all the memory id's that we get
-                    memory_ids = [memory['id'] for memory in memories]
-                    if memory_ids:
-                        await self.helper.log(f"memory_ids (first time pushing): {memory_ids}")
-                        self.valkey.rpush(memkey, *memory_ids)
-
-            # TODO: search shared memories. this is scary allows users to inject context into the model for other users.
-            # shared_content = self.vectordb.search_shared(
-            #    query=message.text
-            # )
-            # await self.helper.log(f"memories: {memories}")
-
-            # TODO: maybe store the automaticly might not be a good idea. it could result in a lot of noise
-            # store memory in vectordb
-            # self.vectordb.store_memory(
-            #    content=message.text,
-            #    user=message.user_id,
-            #    usage_context=rag_usage_context,
-            # )
+        memories_enabled = await self.is_memories_enabled(message)
+        memories = []
+        # the memories are looked up while the thread is loaded
+        thread_id = message.reply_id
+        if memories_enabled:
+            messages, memories = await asyncio.gather(
+                self.get_thread_messages(thread_id),
+                self.get_thread_memories(
+                    message, rag_usage_context, rag_source_type, rag_source
+                ),
+            )
+        else:
+            messages = await self.get_thread_messages(thread_id)
+        # the thread cache hashed its entries once, the token counts are keyed by those
+        digests = {}
+        if not model.startswith("o1"):
+            # o1 rewrites the messages below so their digests would not match
+            digests = self.thread_cache.digests(VALKEY_PREPEND + thread_id, messages)
+        # TODO: search shared memories. this is scary allows users to inject context into the model for other users.
+        # shared_content = self.vectordb.search_shared(
+        #    query=message.text
+        # )
+        # await self.helper.log(f"memories: {memories}")
+
+        # TODO: maybe store the automaticly might not be a good idea. it could result in a lot of noise
+        # store memory in vectordb
+        # self.vectordb.store_memory(
+        #    content=message.text,
+        #    user=message.user_id,
+        #    usage_context=rag_usage_context,
+        # )
         # await self.helper.log(f"memories_enabled: {memories_enabled}")
         # add memories context just before the user message
-        # This function checks if the thread exists in valkey and if not, fetches all posts in the thread and adds them to valkey
-        thread_id = message.reply_id
         # keep a log of all status messages ( for tools )
         status_msgs = []
-        messages = []
-        messages = self.get_thread_messages(thread_id)
         # add memories to the messages if enabled. important that this is done before the user message
         # as we don't want the memories to be the last message in the thread
         # TODO: this is hidden from the user, maybe we could show it to the user somehow. maybe inject it as a message in the post thread before the response.
         if memories_enabled and memories:
-            memory_string = f"{self.users.get_user_by_user_id(message.user_id)['username']}'s Memories:\n"
+            memory_string = f"{await self.users.async_id2u(message.user_id)}'s Memories:\n"
             m = {"role": "user"}
             for memory in memories:
                 if "created_at" in memory:
@@ -1529,7 +1728,7 @@ if files:
             memory_string += json.dumps(memories, indent=4)
             m["content"] = memory_string
             messages.append(m)
-            self.thread_append(thread_id, m)
+            batch.append(m)
         if True or not tool_run and len(messages) != 1:
             # we don't need to append if length = 1 because then it is already fetched via the mattermost api so we don't need to append it to the thread
             # append message to threads
@@ -1542,7 +1741,7 @@ if files:
             #    )
             m = {"role": "user"}
             # get username from user_id
-            username = self.users.id2u(message.user_id)
+            username = await self.users.async_id2u(message.user_id)
             # if the username is not None prepend it to the message
             if username:
                 user_text = f"@{username}: {user_text}"
@@ -1564,7 +1763,7 @@ if files:
                         },
                     ]
                     messages.append(m)
-                    self.thread_append(thread_id, m)
+                    batch.append(m)
                 context_from_text_files = ""
                 for file in txt_files:
                     context_from_text_files += (
@@ -1573,19 +1772,19 @@ if files:
                 if context_from_text_files:
                     m["content"] = user_text + "\n" + context_from_text_files
                     messages.append(m)
-                    self.thread_append(thread_id, m)
+                    batch.append(m)
             else:
                 m["content"] = user_text
                 # append to messages and valkey
                 messages.append(m)
-                self.thread_append(thread_id, m)
+                batch.append(m)
 
         # add system message
         current_date = time.strftime("%Y-%m-%d %H:%M:%S")
         date_template_string = "<date>"
         # model o1-preview does not support system messages
         if not model.startswith("o1"):
-            system_message = self.get_custom_system_prompt(message.channel_id)
+            system_message = await self.get_custom_system_prompt(message.channel_id)
             messages.insert(
                 0,
                 {
@@ -1632,9 +1831,15 @@ if files:
             reply_msg_id = message.reply_msg_id
 
         # fetch the previous messages in the thread
-        messages = self.return_last_x_messages(messages)
-        temperature = float(self.get_chatgpt_setting("temperature"))
-        top_p = float(self.get_chatgpt_setting("top_p"))
+        messages = await self.return_last_x_messages(
+            messages,
+            model,
+            thread_id,
+            digests,
+            tools=None if model.startswith("o1") else self.tools,
+        )
+        temperature = float(await self.async_get_chatgpt_setting("temperature"))
+        top_p = float(await self.async_get_chatgpt_setting("top_p"))
 
         try:
             request_object = {
@@ -1658,13 +1863,17 @@ if files:
             self.driver.react_to(message, "x")
             return
 
-        # get current time and set that as last_update_time
-        last_update_time = time.time()
         # get the setting for how often to update the message
         stream_update_delay_ms = float(
-            self.get_chatgpt_setting("stream_update_delay_ms")
+            await self.async_get_chatgpt_setting("stream_update_delay_ms")
+        )
+        renderer = StreamRenderer(
+            self.driver,
+            reply_msg_id,
+            post_prefix,
+            delay_ms=stream_update_delay_ms,
+            helper=self.helper,
         )
-        i = 0
         try:
             functions_to_call = {}
             async for chunk in response:
@@ -1686,37 +1895,7 @@ if files:
 
                 if chunk_message.content:
                     full_message += chunk_message.content
-                    # if full message begins with ``` or any other mattermost markdown append a \
-                    # newline to the post_prefix so it renders correctly
-                    markdown = [
-                        ">",
-                        "*",
-                        "_",
-                        "-",
-                        "+",
-                        "1",
-                        "~",
-                        "!",
-                        "`",
-                        "|",
-                        "#",
-                        "@",
-                        "•",
-                    ]
-                    if (
-                        i == 0
-                        and post_prefix[-1] != "\n"
-                        and full_message[0] in markdown
-                    ):
-                        post_prefix += "\n"
-                        i += 1
-
-                    if (time.time() - last_update_time) * 1000 > stream_update_delay_ms:
-                        self.driver.posts.patch_post(
-                            reply_msg_id,
-                            {"message": f"{post_prefix}{full_message}"},
-                        )
-                        last_update_time = time.time()
+                    renderer.append(chunk_message.content)
                 function_name = ""
                 if chunk_message.tool_calls and chunk_message.content is None:
                     index = 0
@@ -1747,106 +1926,59 @@ if files:
             # Process all tool calls and collect results
             if functions_to_call:
 
-                def update_status(status_msg):
-                    status_msgs.append(status_msg)
+                # status lines are kept per tool call so they stay in call order
+                tool_status = {index: [] for index in functions_to_call}
+
+                def update_status(index, status_msg):
+                    tool_status[index].append(status_msg)
+                    status_msgs[:] = [line for lines in tool_status.values() for line in lines]
                     # update the thread with the status messages so the user can see the progress
-                    self.driver.posts.patch_post(
-                        reply_msg_id,
-                        {"message": "```\n" + "\n".join(status_msgs) + "\n```\n"},
-                    )
+                    renderer.set_status(status_msgs)
 
                 call_key = f"{VALKEY_PREPEND}_call_{thread_id}"
                 tool_results = []
-
-                for index, tool_function in functions_to_call.items():
-                    if self.valkey.hexists(call_key, tool_function["tool_call_id"]):
-                        continue
-                    function_name = tool_function["function_name"]
-                    # await self.helper.log(f"function_name: {function_name}")
-                    tool_call_id = tool_function["tool_call_id"]
-                    # self.helper.slog(f"function_name: {function_name}")
-                    # get function name from the tool manager
-                    tool = self.tools_manager.get_tool(function_name)
-                    function = tool.function
-                    # await self.helper.log(f"tool: {tool}")
-                    if not tool:
-                        await self.helper.log(
-                            f"Error: function not found: {function_name}"
-                        )
+                # look up which tool calls already ran in one round trip
+                tool_call_ids = [f["tool_call_id"] for f in functions_to_call.values()]
+                already_called = await self.helper.avalkey.hmget(call_key, tool_call_ids)
+                already_called = {
+                    tool_call_id
+                    for tool_call_id, called in zip(tool_call_ids, already_called)
+                    if called
+                }
+                pending_calls = {
+                    index: tool_function
+                    for index, tool_function in functions_to_call.items()
+                    if tool_function["tool_call_id"] not in already_called
+                }
+                results = await self.run_tool_calls(
+                    message,
+                    pending_calls,
+                    update_status,
+                    int(await self.async_get_chatgpt_setting("tool_concurrency")),
+                    float(await self.async_get_chatgpt_setting("tool_timeout")),
+                )
+                for tool_function, result in zip(pending_calls.values(), results):
+                    if result is None:
                         continue
-                    # format the arguments as a pretty string for the status msg it is an dict with a arg and value pair
-                    # format it as key: value
-                    status_args = json.loads(tool_function["arguments"])
-                    status_args = " | ".join(
-                        [f"{k}:{v}" for k, v in status_args.items()]
-                    )
-                    status_msg = f"Running tool: {function_name}: {status_args}"
-                    update_status(status_msg)
-
-                    try:
-                        arguments = json.loads(tool_function["arguments"])
-                    except json.JSONDecodeError:
-                        await self.helper.log(
-                            "Error parsing arguments: %s", tool_function["arguments"]
-                        )
-                        arguments = {}
-                    # if the tool has "needs_message_object" set to True, pass the message object to the function with the args
-                    if tool.needs_message_object:
-                        arguments["message"] = message
-                    if tool.needs_self:
-                        arguments["self"] = self
-                        # await self.helper.log(f"tool: {tool}")
-                        # await self.helper.log(f"a: {arguments}")
-                    if tool.returns_files:
-                        # Execute the function
-                        function_result, filename = await function(**arguments)
-                        if isinstance(filename, list):
-                            for file in filename:
-                                files.append(file)
-                        if isinstance(filename, str):
-                            files.append(filename)
-                    else:
-                        # Execute the function
-                        function_result = await function(**arguments)
-
-                    if function_result is None:
-                        function_result = "Error: function returned None"
-                        update_status(f"Error: {function_result}")
-                    elif not isinstance(function_result, str):
-                        try:
-                            function_result = json.dumps(function_result)
-                        except json.JSONDecodeError:
-                            function_result = (
-                                "Error: could not serialize function result"
-                            )
-                            update_status(f"Error: {function_result}")
-
-                    function_result = function_result[:20000]
-
-                    # Store tool result
-                    tool_result = {
-                        "tool_call_id": tool_call_id,
-                        "role": "tool",
-                        "name": function_name,
-                        "content": function_result,
-                    }
+                    tool_result, tool_files = result
+                    files.extend(tool_files)
                     tool_results.append(tool_result)
                     # append role to tool_function tool call message
                     tool_function["tool_call_message"]["role"] = "assistant"
                     # Update thread with tool call and result
-                    # await self.helper.log(f"tool_result: {tool_function['tool_call_message']}")
-                    self.append_thread_and_get_messages(
-                        thread_id, tool_function["tool_call_message"]
-                    )
-                    self.append_thread_and_get_messages(thread_id, tool_result)
-                    self.valkey.hset(call_key, tool_call_id, "true")
-
-                    status_msg = f"Completed: {function_name}"
-                    update_status(status_msg)
+                    batch.append(tool_function["tool_call_message"], tool_result)
 
                 # Make final call with all results
                 if tool_results:
-                    messages = self.get_thread_messages(thread_id)
+                    # mark the tool calls as done
+                    await self.helper.avalkey.hset(
+                        call_key,
+                        mapping={result["tool_call_id"]: "true" for result in tool_results},
+                    )
+                    # the thread as stored plus what this turn has not written yet
+                    messages = await self.thread_cache.async_get(VALKEY_PREPEND + thread_id)
+                    digests = self.thread_cache.digests(VALKEY_PREPEND + thread_id, messages)
+                    messages = messages + batch.pending
                     # Ensure all messages have the required 'role' field and proper tool call structure
                     formatted_messages = messages
 
@@ -1865,6 +1997,9 @@ if files:
                     try:
                         # Debug log to see the formatted messages
                         # await self.helper.log(f"Formatted messages: {json.dumps(formatted_messages, indent=2)}")
+                        formatted_messages = await self.return_last_x_messages(
+                            formatted_messages, model, thread_id, digests
+                        )
 
                         final_response = await aclient.chat.completions.create(
                             model=model,
@@ -1875,116 +2010,35 @@ if files:
                         )
 
                         full_message = ""
-                        status_str = ""
-                        if status_msgs:
-                            status_str = "```" + "\n".join(status_msgs) + "\n```\n"
-                        have_notified_user_about_long_message = False
+                        renderer.clear()
                         async for chunk in final_response:
                             if chunk.choices[0].delta.content:
                                 full_message += chunk.choices[0].delta.content
-                                message_length = len(full_message)
-                                if message_length < max_message_length:
-                                    if (
-                                        time.time() - last_update_time
-                                    ) * 1000 > stream_update_delay_ms:
-                                        self.driver.posts.patch_post(
-                                            reply_msg_id,
-                                            {
-                                                "message": f"{status_str}{post_prefix}{full_message[:max_message_length]}"
-                                            },
-                                        )
-                                        last_update_time = time.time()
-                                else:
-                                    # message to long so save the message to a file and add to files
-                                    if not have_notified_user_about_long_message:
-                                        self.driver.posts.patch_post(
-                                            reply_msg_id,
-                                            {
-                                                "message": f"{status_str}{post_prefix}{full_message[:13000]}\n\n# Warning Message too long, i'll attach a file with the full response when done receiving it."
-                                            },
-                                        )
-                                        have_notified_user_about_long_message = True
+                                renderer.append(chunk.choices[0].delta.content)
                         # Store final response
                         if full_message:
-                            self.thread_append(
-                                thread_id,
-                                {"role": "assistant", "content": full_message},
+                            batch.append(
+                                {"role": "assistant", "content": full_message}
                             )
                     # pylint: disable=broad-except
                     except Exception as e:
-                        # if "Invalid Message." the message is to long so trim the message and save the full result to a files and add to files
-                        if "Invalid Message." in str(e):
-                            filename = self.helper.save_content_to_tmp_file(
-                                full_message, "txt"
-                            )
-                            files.append(filename)
-                            self.driver.posts.patch_post(
-                                reply_msg_id,
-                                {
-                                    "message": f"{post_prefix}{full_message[:14000]}\nMessage too long, see attached file"
-                                },
-                            )
-                            # limit of 5 files per message so loop through the files and send them in batches of 5
-                            if len(files) > 5:
-                                for i in range(0, len(files), 5):
-                                    self.driver.reply_to(
-                                        message, "Files:", file_paths=files[i : i + 5]
-                                    )
-                            else:
-                                self.driver.reply_to(
-                                    message, "Files:", file_paths=files
-                                )
-                            for file in files:
-                                self.helper.delete_downloaded_file(file)
-                            await self.helper.log(f"Error in final response: {e}")
-                            await self.helper.log(
-                                f"Last formatted messages: {json.dumps(formatted_messages[-3:], indent=2)}"
-                            )
-                            return
                         await self.helper.log(f"Error in final response: {e}")
                         await self.helper.log(
                             f"Last formatted messages: {json.dumps(formatted_messages[-3:], indent=2)}"
                         )
-                        self.driver.posts.patch_post(
-                            reply_msg_id,
-                            {
-                                "message": f"{post_prefix}Error processing tool results: {str(e)}"
-                            },
-                        )
+                        # the files of the tool results are posted or removed too
+                        files += await renderer.finish(f"Error processing tool results: {str(e)}")
+                        if files:
+                            reply_with_files(self.driver, self.helper, message, files)
                         return
             elif full_message:  # No tools were called, store the regular response
-                self.thread_append(
-                    thread_id, {"role": "assistant", "content": full_message}
-                )
+                batch.append({"role": "assistant", "content": full_message})
 
-            # Final message update
-            # if status_msgs are set then update the message with the status messages prepended to the final message
-            status_str = ""
-            if status_msgs:
-                status_str = "```\n" + "\n".join(status_msgs) + "\n```\n"
-            final_message = f"{status_str}{post_prefix}{full_message}"
-            if len(final_message) > max_message_length:
-                # save the full message to a file and add to files
-                filename = self.helper.save_content_to_tmp_file(final_message, "txt")
-                files.append(filename)
-                final_message = (
-                    final_message[:max_message_length]
-                    + "\nMessage too long, see attached file"
-                )
-            self.driver.posts.patch_post(
-                reply_msg_id,
-                {"message": final_message[:max_message_length]},
-            )
-            if files and len(files) > 0:
-                if len(files) > 5:
-                    for i in range(0, len(files), 5):
-                        self.driver.reply_to(
-                            message, "Files:", file_paths=files[i : i + 5]
-                        )
-                else:
-                    self.driver.reply_to(message, "Files:", file_paths=files)
-                for file in files:
-                    self.helper.delete_downloaded_file(file)
+            # Final message update, with the status messages above it
+            # the full message goes in a file if it is too long for a post
+            files += await renderer.finish()
+            if files:
+                reply_with_files(self.driver, self.helper, message, files)
 
         except aiohttp_client_exceptions.ClientPayloadError as error:
             self.driver.reply_to(message, f"Error: {error}")
@@ -1993,6 +2047,9 @@ if files:
             )
             self.driver.react_to(message, "x")
             return
+        finally:
+            # make sure no frame lands after we are done
+            await renderer.stop()
 
         # remove thought balloon after successful response
         self.driver.reactions.delete_reaction(
@@ -2167,51 +2224,22 @@ if files:
             txt = "\n".join(commands_admin)
             self.driver.reply_to(message, f"\n\n{txt}\n", direct=True)
 
-    def append_thread_and_get_messages(self, thread_id, msg):
+    async def append_thread_and_get_messages(self, thread_id, msg):
         """append a message to a chatlog"""
         # self.helper.slog(f"append_chatlog {thread_id} {msg}")
-        expiry = 60 * 60 * 24 * 7
         thread_key = VALKEY_PREPEND + thread_id
-        self.valkey.rpush(thread_key, self.valkey_serialize_json(msg))
-        self.valkey.expire(thread_key, expiry)
-        messages = self.helper.valkey_deserialize_json(
-            self.valkey.lrange(thread_key, 0, -1)
-        )
+        await self.thread_cache.async_append(thread_key, msg, expiry=THREAD_EXPIRY)
+        messages = await self.thread_cache.async_get(thread_key)
         # messages = self.get_formatted_messages(messages)
         return messages
 
     def get_thread_messages_from_valkey(self, thread_id:str):
         """get a chatlog"""
         thread_key = VALKEY_PREPEND + thread_id
-        messages = self.helper.valkey_deserialize_json(
-            self.valkey.lrange(thread_key, 0, -1)
-        )
+        messages = self.thread_cache.get(thread_key)
         # messages = self.get_formatted_messages(messages)
         return messages
 
-    def valkey_serialize_json(self, msg):
-        """serialize a message to json, using a custom serializer for types not
-        handled by the default json serialization"""
-        # return json.dumps(msg)
-        return self.valkey_serialize_jsonpickle(msg)
-
-    def valkey_deserialize_json(self, msg):
-        """deserialize a message from json"""
-        return self.valkey_deserialize_jsonpickle(msg)
-
-    def valkey_serialize_jsonpickle(self, msg):
-        """serialize a message to json, using a custom serializer for types not
-        handled by the default json serialization"""
-
-        return jsonpickle.encode(msg, unpicklable=False)
-
-    def valkey_deserialize_jsonpickle(self, msg):
-        """deserialize a message from json"""
-
-        if isinstance(msg, list):
-            return [jsonpickle.decode(m) for m in msg]
-        return jsonpickle.decode(msg)
-
 
 if __name__ == "__main__":
     ChatGPT()
@@ -0,0 +1,216 @@
+"""token budgeted context window for chat completions"""
+
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+import tiktoken
+
+log = logging.getLogger(__name__)
+
+
+class ContextWindow:
+    """fit a list of chat messages into a per model token budget
+
+    messages are grouped into units that are never split: an assistant message
+    with tool_calls always stays together with the tool results that follow it.
+    the leading system prompt and the latest user turn are always kept, the rest
+    of the history is filled in newest first until the budget is used up.
+    """
+
+    # rough cost of a high detail image tile, we never count the base64 payload
+    IMAGE_TOKENS = 765
+    # per message overhead and reply priming from the openai cookbook
+    TOKENS_PER_MESSAGE = 3
+    TOKENS_PER_NAME = 1
+    REPLY_PRIMING_TOKENS = 3
+    FALLBACK_ENCODING = "o200k_base"
+
+    def __init__(self, cache_size: int = 8192, token_counter=None):
+        self.cache_size = cache_size
+        # digest -> token count for messages we have already counted
+        self._counts = OrderedDict()
+        self._encodings = {}
+        # optional callable(text, model) -> int used instead of tiktoken
+        self.token_counter = token_counter
+
+    def get_encoding(self, model: str):
+        """get the tiktoken encoding for a model or None if it can't be loaded"""
+        if model in self._encodings:
+            return self._encodings[model]
+        encoding = None
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            try:
+                encoding = tiktoken.get_encoding(self.FALLBACK_ENCODING)
+            # pylint: disable=broad-except
+            except Exception as error:
+                log.warning("could not load encoding %s: %s", self.FALLBACK_ENCODING, error)
+        # pylint: disable=broad-except
+        except Exception as error:
+            # the bpe files are downloaded on first use, that may fail offline
+            log.warning("could not load encoding for %s: %s", model, error)
+        self._encodings[model] = encoding
+        return encoding
+
+    def encoding_name(self, model: str) -> str:
+        """name of the encoding used for a model, part of the cache key"""
+        if self.token_counter is not None:
+            return "custom"
+        encoding = self.get_encoding(model)
+        return encoding.name if encoding else "approx"
+
+    def count_text(self, text: str, model: str) -> int:
+        """count the tokens in a string"""
+        if not text:
+            return 0
+        if self.token_counter is not None:
+            return self.token_counter(text, model)
+        encoding = self.get_encoding(model)
+        if encoding is None:
+            # no encoding available, roughly 4 characters per token
+            return len(text) // 4 + 1
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def message_key(self, message: dict, model: str, digest: str | None = None) -> str:
+        """stable cache key for a message under the encoding used by the model
+
+        digest is a hash of the message taken when it was stored, messages
+        without one are serialized and hashed here.
+        """
+        if digest is None:
+            serialized = json.dumps(message, sort_keys=True, default=str)
+            digest = hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+        return f"{self.encoding_name(model)}:{digest}"
+
+    def count_message(self, message: dict, model: str) -> int:
+        """count the tokens of a single message without using the cache"""
+        tokens = self.TOKENS_PER_MESSAGE
+        for key, value in message.items():
+            if key == "content":
+                if isinstance(value, list):
+                    for part in value:
+                        if not isinstance(part, dict):
+                            tokens += self.count_text(str(part), model)
+                        elif part.get("type") == "image_url":
+                            tokens += self.IMAGE_TOKENS
+                        else:
+                            tokens += self.count_text(part.get("text", ""), model)
+                elif value is not None:
+                    tokens += self.count_text(str(value), model)
+            elif key == "tool_calls":
+                tokens += self.count_text(json.dumps(value, default=str), model)
+            elif key == "name":
+                tokens += self.TOKENS_PER_NAME + self.count_text(str(value), model)
+            elif isinstance(value, str):
+                tokens += self.count_text(value, model)
+        return tokens
+
+    def count_tools(self, tools: list | None, model: str) -> int:
+        """count the tokens of the tool definitions sent with a request"""
+        if not tools:
+            return 0
+        key = self.message_key({"tools": tools}, model)
+        count = self.cached_count(key)
+        if count is None:
+            count = self.count_text(json.dumps(tools, default=str), model)
+            self.remember(key, count)
+        return count
+
+    def cached_count(self, key: str):
+        """return a cached count or None"""
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts.move_to_end(key)
+        return count
+
+    def remember(self, key: str, count: int):
+        """store a count in the in-process cache"""
+        self._counts[key] = count
+        self._counts.move_to_end(key)
+        while len(self._counts) > self.cache_size:
+            self._counts.popitem(last=False)
+
+    def count_messages(
+        self, messages: list, model: str, known_counts: dict | None = None, keys: list | None = None
+    ):
+        """count all messages, returns (counts, keys, new_counts)
+
+        known_counts is a mapping of message key -> count from an external
+        store. new_counts holds the counts that had to be computed.
+        """
+        if known_counts is None:
+            known_counts = {}
+        if keys is None:
+            keys = [self.message_key(message, model) for message in messages]
+        counts = []
+        new_counts = {}
+        for key, message in zip(keys, messages):
+            count = self.cached_count(key)
+            if count is None and key in known_counts:
+                count = int(known_counts[key])
+                self.remember(key, count)
+            if count is None:
+                count = self.count_message(message, model)
+                self.remember(key, count)
+                new_counts[key] = count
+            counts.append(count)
+        return counts, keys, new_counts
+
+    @staticmethod
+    def group_turns(messages: list) -> list:
+        """group message indexes so tool calls and their results are never split"""
+        groups = []
+        for index, message in enumerate(messages):
+            role = message.get("role")
+            if role == "tool" and groups:
+                # tool results belong to the assistant message that called them
+                groups[-1].append(index)
+                continue
+            groups.append([index])
+        return groups
+
+    def fit(self, messages: list, model: str, max_tokens: int, counts: list | None = None) -> list:
+        """return the messages that fit inside max_tokens"""
+        if not messages:
+            return messages
+        if counts is None:
+            counts, _, _ = self.count_messages(messages, model)
+        groups = self.group_turns(messages)
+
+        # the system prompt is pinned
+        pinned_head = []
+        if messages[0].get("role") == "system":
+            pinned_head = groups.pop(0)
+
+        # the latest user turn is pinned, together with anything that follows it
+        pinned_tail = []
+        for group_index in range(len(groups) - 1, -1, -1):
+            if any(messages[i].get("role") == "user" for i in groups[group_index]):
+                for group in groups[group_index:]:
+                    pinned_tail.extend(group)
+                groups = groups[:group_index]
+                break
+
+        used = self.REPLY_PRIMING_TOKENS
+        used += sum(counts[i] for i in pinned_head)
+        used += sum(counts[i] for i in pinned_tail)
+
+        # fill in history newest first and stop at the first turn that does not fit
+        kept = []
+        for group in reversed(groups):
+            group_tokens = sum(counts[i] for i in group)
+            if used + group_tokens > max_tokens:
+                break
+            used += group_tokens
+            kept = group + kept
+
+        indexes = pinned_head + kept + pinned_tail
+        if len(indexes) < len(messages):
+            log.debug(
+                "context window trimmed %s of %s messages (%s tokens, budget %s)",
+                len(messages) - len(indexes), len(messages), used, max_tokens,
+            )
+        return [messages[i] for i in indexes]
@@ -0,0 +1,248 @@
+"""async dns lookups cached for their ttl, with the verdict on the addresses"""
+
+import asyncio
+import ipaddress
+import logging
+import socket
+import time
+from collections import OrderedDict
+
+import aiohttp
+import dns.asyncresolver
+import dns.resolver
+from aiohttp.abc import AbstractResolver
+from environs import Env
+from yarl import URL
+
+env = Env()
+
+log = logging.getLogger(__name__)
+
+DNS_CACHE_SIZE = env.int("DNS_CACHE_SIZE", 4096)
+# record ttls are clamped to this range
+DNS_CACHE_MIN_TTL = env.int("DNS_CACHE_MIN_TTL", 30)
+DNS_CACHE_MAX_TTL = env.int("DNS_CACHE_MAX_TTL", 60 * 60)
+# names that don't exist or have no records are remembered this long
+DNS_CACHE_NEGATIVE_TTL = env.int("DNS_CACHE_NEGATIVE_TTL", 60)
+DNS_TIMEOUT = env.float("DNS_TIMEOUT", 5.0)
+
+# checked in this order, the first match is the verdict
+ADDRESS_CHECKS = (
+    ("private", "is_private"),
+    ("reserved", "is_reserved"),
+    ("multicast", "is_multicast"),
+    ("unspecified", "is_unspecified"),
+    ("loopback", "is_loopback"),
+    ("link local", "is_link_local"),
+)
+
+
+def address_error(address, resolved: bool = True) -> str | None:
+    """why an address may not be used, None if it is public"""
+    ip = ipaddress.ip_address(address)
+    for name, check in ADDRESS_CHECKS:
+        if getattr(ip, check):
+            return f"{name} ip (resolved from dns)" if resolved else f"{name} ip"
+    if ip.version == 6:
+        # verify the ipv4 address inside the ipv6 address is not private
+        for embedded in (ip.sixtofour, ip.ipv4_mapped):
+            if embedded is None:
+                continue
+            for name, check in ADDRESS_CHECKS:
+                if getattr(embedded, check):
+                    return f"{name} ip (nice try though)"
+    return None
+
+
+def url_error(url) -> str | None:
+    """why a url may not be fetched before its host is resolved, None if it may"""
+    url = URL(str(url))
+    if url.scheme not in ("http", "https"):
+        return f"unsupported scheme: {url.scheme}"
+    if not url.host:
+        return "no host in url"
+    try:
+        return address_error(url.host.strip("[]"), resolved=False)
+    except ValueError:
+        # a name, checked by the resolver when connecting
+        return None
+
+
+class BlockedAddressError(aiohttp.ClientError, OSError):
+    """a url or host points at an address we may not connect to"""
+
+
+class DnsAnswer:
+    """the records of a name and what we think of them"""
+
+    __slots__ = ("name", "addresses", "cnames", "error", "address_error", "expires")
+
+    def __init__(self, name, addresses=(), cnames=(), error=None, expires=0.0):
+        self.name = name
+        # ipv6 addresses first like the old lookup order
+        self.addresses = list(addresses)
+        self.cnames = list(cnames)
+        # the lookup failed or found nothing
+        self.error = error
+        # the first address that may not be used
+        self.address_error = next(
+            (e for e in map(address_error, self.addresses) if e is not None), None
+        )
+        self.expires = expires
+
+
+class DnsCache:
+    """resolve A, AAAA and CNAME records concurrently and cache the answer
+
+    answers are kept for the lowest record ttl, clamped to min/max ttl. names
+    that don't exist or have no records are cached for negative_ttl, timeouts
+    and server failures are not cached. concurrent lookups of a name share one
+    query.
+    """
+
+    RDTYPES = ("CNAME", "AAAA", "A")
+
+    def __init__(
+        self,
+        resolver=None,
+        max_entries: int = DNS_CACHE_SIZE,
+        min_ttl: int = DNS_CACHE_MIN_TTL,
+        max_ttl: int = DNS_CACHE_MAX_TTL,
+        negative_ttl: int = DNS_CACHE_NEGATIVE_TTL,
+        clock=time.monotonic,
+    ):
+        self._resolver = resolver
+        self.max_entries = max_entries
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    @property
+    def resolver(self):
+        """the system resolver, read on first use"""
+        if self._resolver is None:
+            self._resolver = dns.asyncresolver.Resolver()
+            self._resolver.lifetime = DNS_TIMEOUT
+        return self._resolver
+
+    def get(self, name: str) -> DnsAnswer | None:
+        """a cached answer that has not expired"""
+        answer = self._entries.get(name)
+        if answer is None:
+            return None
+        if answer.expires <= self.clock():
+            del self._entries[name]
+            return None
+        self._entries.move_to_end(name)
+        return answer
+
+    def _store(self, answer: DnsAnswer):
+        """cache an answer and evict the least recently used ones"""
+        self._entries[answer.name] = answer
+        self._entries.move_to_end(answer.name)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def lookup(self, name: str) -> DnsAnswer:
+        """resolve a name, from the cache if we can"""
+        name = name.rstrip(".").lower()
+        answer = self.get(name)
+        if answer is not None:
+            return answer
+        pending = self._pending.get(name)
+        if pending is None or pending.get_loop() is not asyncio.get_running_loop():
+            pending = self._pending[name] = asyncio.ensure_future(self._resolve(name))
+            pending.add_done_callback(lambda done: self._forget(name, done))
+        # shield so one caller giving up does not cancel the others
+        return await asyncio.shield(pending)
+
+    def _forget(self, name: str, done):
+        """drop a finished query unless a newer one took its place"""
+        if self._pending.get(name) is done:
+            del self._pending[name]
+
+    async def _resolve(self, name: str) -> DnsAnswer:
+        """query all record types at once"""
+        results = await asyncio.gather(
+            *(self.resolver.resolve(name, rdtype) for rdtype in self.RDTYPES),
+            return_exceptions=True,
+        )
+        records = {}
+        ttls = []
+        for rdtype, result in zip(self.RDTYPES, results):
+            if isinstance(result, dns.resolver.NoAnswer):
+                records[rdtype] = []
+                continue
+            if isinstance(result, dns.resolver.NXDOMAIN):
+                return self._negative(name, f"error resolving domain: {result}")
+            if isinstance(result, BaseException):
+                # timeouts and server failures may be gone on the next try
+                return DnsAnswer(name, error=f"error resolving domain: {result}")
+            ttls.append(result.rrset.ttl)
+            if rdtype == "CNAME":
+                records[rdtype] = [str(rdata.target).rstrip(".") for rdata in result]
+            else:
+                records[rdtype] = [rdata.address for rdata in result]
+        if not any(records.values()):
+            return self._negative(name, f"no dns records found for {name}")
+        ttl = min(max(min(ttls), self.min_ttl), self.max_ttl)
+        answer = DnsAnswer(
+            name,
+            addresses=records["AAAA"] + records["A"],
+            cnames=records["CNAME"],
+            expires=self.clock() + ttl,
+        )
+        self._store(answer)
+        return answer
+
+    def _negative(self, name: str, error: str) -> DnsAnswer:
+        """cache a name that does not resolve"""
+        answer = DnsAnswer(name, error=error, expires=self.clock() + self.negative_ttl)
+        self._store(answer)
+        return answer
+
+
+class GuardedResolver(AbstractResolver):
+    """aiohttp resolver that refuses hosts resolving to private addresses
+
+    the connection is made to the addresses that were checked, so a name can't
+    be pointed somewhere else between the check and the connect.
+    """
+
+    def __init__(self, cache: DnsCache):
+        self.cache = cache
+
+    async def resolve(self, host: str, port: int = 0, family=socket.AF_INET) -> list:
+        """the checked addresses of a host"""
+        answer = await self.cache.lookup(host)
+        if answer.error:
+            raise OSError(answer.error)
+        if answer.address_error:
+            raise BlockedAddressError(f"{host}: {answer.address_error}")
+        hosts = []
+        for address in answer.addresses:
+            if ipaddress.ip_address(address).version == 6:
+                address_family = socket.AF_INET6
+            else:
+                address_family = socket.AF_INET
+            if family not in (socket.AF_UNSPEC, address_family):
+                continue
+            hosts.append(
+                {
+                    "hostname": host,
+                    "host": address,
+                    "port": port,
+                    "family": address_family,
+                    "proto": 0,
+                    "flags": socket.AI_NUMERICHOST | socket.AI_NUMERICSERV,
+                }
+            )
+        if not hosts:
+            raise OSError(f"no usable addresses for {host}")
+        return hosts
+
+    async def close(self):
+        """the cache is shared, nothing to release"""
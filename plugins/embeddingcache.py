@@ -0,0 +1,113 @@
+"""cache of text embeddings in process and in valkey"""
+
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+from environs import Env
+
+env = Env()
+
+log = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_SIZE = env.int("EMBEDDING_CACHE_SIZE", 4096)
+# an embedding of a text never changes for a model, the ttl only bounds valkey memory
+EMBEDDING_CACHE_TTL = env.int("EMBEDDING_CACHE_TTL", 30 * 24 * 60 * 60)
+EMBEDDING_CACHE_PREFIX = "embedding:"
+
+
+def normalize_text(text: str) -> str:
+    """the text that is embedded, whitespace and unicode forms don't change the key"""
+    return unicodedata.normalize("NFC", " ".join(text.split()))
+
+
+class EmbeddingCache:
+    """lru of embeddings keyed by model and normalized text, backed by valkey
+
+    vectors are kept as read only float32 arrays and stored in valkey as their
+    raw bytes, 6kb for a 1536 dimension embedding. lookups check the lru first
+    and fetch the misses with one MGET. cache errors are logged and treated as
+    misses so embedding never depends on valkey.
+    """
+
+    def __init__(
+        self,
+        async_valkey=None,
+        max_entries: int = EMBEDDING_CACHE_SIZE,
+        ttl: int = EMBEDDING_CACHE_TTL,
+    ):
+        # callable returning the asyncio client for bytes, None keeps the cache in process
+        self.async_valkey = async_valkey
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        """key of the embedding of a text, the text must be normalized"""
+        return f"{EMBEDDING_CACHE_PREFIX}{model}:{hashlib.sha256(text.encode()).hexdigest()}"
+
+    @staticmethod
+    def freeze(vector) -> np.ndarray:
+        """a read only float32 copy of a vector"""
+        vector = np.array(vector, dtype=np.float32)
+        vector.setflags(write=False)
+        return vector
+
+    def _store(self, key: str, vector: np.ndarray):
+        """cache a vector and evict the least recently used ones"""
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_many(self, model: str, texts: list) -> list:
+        """the cached embeddings of normalized texts, None for the misses"""
+        keys = [self.key(model, text) for text in texts]
+        vectors = []
+        for key in keys:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+            vectors.append(vector)
+        missing = list(dict.fromkeys(key for key, vector in zip(keys, vectors) if vector is None))
+        if not missing or self.async_valkey is None:
+            return vectors
+        try:
+            values = await self.async_valkey().mget(missing)
+        # pylint: disable=broad-except
+        except Exception as error:
+            log.warning("embedding cache read failed: %s", error)
+            return vectors
+        found = {}
+        for key, value in zip(missing, values):
+            if value is None or len(value) % 4:
+                continue
+            vector = np.frombuffer(value, dtype=np.float32)
+            self._store(key, vector)
+            found[key] = vector
+        return [found.get(key) if vector is None else vector for key, vector in zip(keys, vectors)]
+
+    async def put_many(self, model: str, embeddings: dict) -> dict:
+        """cache the embeddings of normalized texts, returns them as read only float32"""
+        frozen = {}
+        for text, vector in embeddings.items():
+            frozen[text] = self.freeze(vector)
+            self._store(self.key(model, text), frozen[text])
+        if not frozen or self.async_valkey is None:
+            return frozen
+        try:
+            pipe = self.async_valkey().pipeline(transaction=False)
+            for text, vector in frozen.items():
+                pipe.set(self.key(model, text), vector.tobytes(), ex=self.ttl)
+            await pipe.execute()
+        # pylint: disable=broad-except
+        except Exception as error:
+            log.warning("embedding cache write failed: %s", error)
+        return frozen
+
+    def clear(self):
+        """forget the embeddings held in process"""
+        self._entries.clear()
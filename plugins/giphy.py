@@ -5,7 +5,6 @@ from mmpy_bot.plugins.base import PluginManager
 from mmpy_bot.settings import Settings
 from plugins.base import PluginLoader
 from redis_rate_limit import RateLimit, TooManyRequests
-import requests
 from environs import Env
 
 env = Env()
@@ -46,12 +45,12 @@ class Giphy(PluginLoader):
                 ):
                     self.helper.add_reaction(message, "frame_with_picture")
                     # get the gif from giphy api
-                    response = requests.get(url, params=params)
+                    response = await self.helper.fetch(url, params=params)
                     # get the url from the response
                     gif_url = response.json(
                     )["data"][0]["images"]["original"]["url"]
                     # download the gif using the url
-                    filename = self.helper.download_file_to_tmp(gif_url, "gif")
+                    filename = await self.helper.download_file_to_tmp(gif_url, "gif")
                     # format the gif_url as mattermost markdown
                     # gif_url_txt = f"![gif]({gif_url})"
                     gif_url_txt = ""
@@ -1,5 +1,7 @@
 """shared functions and variables for the project"""
 
+import asyncio
+import contextlib
 import inspect
 import ipaddress
 import json
@@ -9,16 +11,23 @@ import os
 import re
 import tempfile
 import urllib
+import weakref
 
-import bs4
-import dns.resolver
+import aiohttp
 import magic
-import requests
 import validators
 import valkey
+import valkey.asyncio
 from googlesearch import search as googlesearch
 from environs import Env
 from mmpy_bot.wrappers import Message
+from multidict import CIMultiDict
+from yarl import URL
+
+from plugins import htmlextract
+from plugins.dnscache import BlockedAddressError, DnsCache, GuardedResolver, url_error
+from plugins.pagecache import PageCache
+from plugins.serializers import Serializer
 
 env = Env()
 
@@ -26,6 +35,104 @@ env = Env()
 log = logging.getLogger(__name__)
 
 
+# connection pools shared by every Helper instance, keyed by (host, db, decode)
+VALKEY_POOLS = {}
+# asyncio pools are bound to the loop they were created on, so one set per loop
+ASYNC_VALKEY_POOLS = weakref.WeakKeyDictionary()
+
+
+def get_valkey_pool(host, db, decode_responses=True):
+    """get the shared blocking connection pool"""
+    key = (host, db, decode_responses)
+    if key not in VALKEY_POOLS:
+        VALKEY_POOLS[key] = valkey.ConnectionPool(
+            host=host, port=6379, db=db, decode_responses=decode_responses, protocol=3
+        )
+    return VALKEY_POOLS[key]
+
+
+def get_async_valkey(host, db, decode_responses=True):
+    """get a client on the shared asyncio connection pool of the running loop"""
+    loop = asyncio.get_running_loop()
+    clients = ASYNC_VALKEY_POOLS.setdefault(loop, {})
+    key = (host, db, decode_responses)
+    if key not in clients:
+        pool = valkey.asyncio.ConnectionPool(
+            host=host, port=6379, db=db, decode_responses=decode_responses, protocol=3
+        )
+        clients[key] = valkey.asyncio.Valkey(connection_pool=pool)
+    return clients[key]
+
+
+# downloads are capped at this many bytes
+MAX_DOWNLOAD_SIZE = 10 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# connect and read timeouts like the requests calls had, total covers slow trickles
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=90, sock_connect=10, sock_read=10)
+# long threads are fetched from mattermost this many posts at a time
+THREAD_PAGE_SIZE = env.int("THREAD_PAGE_SIZE", 200)
+# guarded requests follow at most this many redirects
+MAX_REDIRECTS = 10
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# http sessions are bound to their loop like the asyncio valkey pools
+HTTP_SESSIONS = weakref.WeakKeyDictionary()
+
+
+def get_http_session(guarded: bool = False) -> aiohttp.ClientSession:
+    """get the shared keep-alive http session of the running loop
+
+    guarded sessions resolve hosts through the dns cache and refuse to connect
+    to private, reserved and loopback addresses.
+    """
+    loop = asyncio.get_running_loop()
+    sessions = HTTP_SESSIONS.setdefault(loop, {})
+    session = sessions.get(guarded)
+    if session is None or session.closed:
+        if guarded:
+            # the resolver caches the answers itself
+            connector = aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=10,
+                keepalive_timeout=60,
+                resolver=GuardedResolver(Helper.dns_cache),
+                use_dns_cache=False,
+            )
+        else:
+            connector = aiohttp.TCPConnector(
+                limit=100, limit_per_host=10, ttl_dns_cache=300, keepalive_timeout=60
+            )
+        session = aiohttp.ClientSession(connector=connector)
+        sessions[guarded] = session
+    return session
+
+
+class DownloadTooLargeError(Exception):
+    """the response is larger than the download limit"""
+
+    def __init__(self, max_size: int):
+        super().__init__(f"content size exceeds the maximum limit ({max_size} bytes)")
+        self.max_size = max_size
+
+
+class HttpResponse:
+    """a response read into memory by Helper.fetch"""
+
+    def __init__(self, url: str, status_code: int, headers, content: bytes):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CIMultiDict(headers)
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        """the body as text"""
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        """the body as json"""
+        return json.loads(self.content)
+
+
 # Monkey patch message class to extend it.
 # this is so dirty, i love it.
 def message_from_thread_post(post) -> Message:
@@ -44,10 +151,14 @@ Message.is_from_self = is_from_self
 
 class Helper:
     """helper class for the bot"""
+    # dns answers shared by every helper
+    dns_cache = DnsCache()
     VALKEY_HOST = env.str("VALKEY_HOST", "localhost")
     VALKEY_DB = env.int("VALKEY_DB", 0)
     REDIS_HOST = env.str("REDIS_HOST", "localhost")
     REDIS_DB = env.int("REDIS_DB", 0)
+    # codec for new entries written with valkey_serialize: msgpack or json
+    VALKEY_SERIALIZER = env.str("VALKEY_SERIALIZER", "msgpack")
 
     def __init__(self, driver, log_channel=None):
         self.driver = driver
@@ -55,9 +166,19 @@ class Helper:
         if self.VALKEY_HOST == "localhost" and self.REDIS_HOST != "localhost":
             self.VALKEY_HOST = self.REDIS_HOST
             self.VALKEY_DB = self.REDIS_DB
-        self.valkey = valkey.Valkey(host=self.VALKEY_HOST, port=6379,
-                        db=self.VALKEY_DB, decode_responses=True, protocol=3)
+        self.valkey = valkey.Valkey(
+            connection_pool=get_valkey_pool(self.VALKEY_HOST, self.VALKEY_DB)
+        )
         self.valkey_pool = self.valkey.connection_pool
+        # client for binary values written with valkey_serialize
+        self.valkey_bytes = valkey.Valkey(
+            connection_pool=get_valkey_pool(self.VALKEY_HOST, self.VALKEY_DB, False)
+        )
+        self.serializer = Serializer(self.VALKEY_SERIALIZER)
+        # extracted web pages shared by the download tools, stored compressed
+        self.page_cache = PageCache(
+            lambda: self.avalkey_bytes, self.serializer.encode, self.serializer.decode
+        )
         self.log_channel = log_channel
         env_log_channel = env.str("MM_BOT_LOG_CHANNEL", None)
         if self.log_channel is None and env_log_channel is None:
@@ -82,6 +203,16 @@ class Helper:
             "Pragma": "no-cache",
         }
 
+    @property
+    def avalkey(self):
+        """asyncio valkey client on the shared pool"""
+        return get_async_valkey(self.VALKEY_HOST, self.VALKEY_DB)
+
+    @property
+    def avalkey_bytes(self):
+        """asyncio valkey client for binary values on the shared pool"""
+        return get_async_valkey(self.VALKEY_HOST, self.VALKEY_DB, False)
+
     def valkey_serialize_json(self, msg):
         """serialize a message to json"""
         return json.dumps(msg)
@@ -92,6 +223,16 @@ class Helper:
             return [json.loads(m) for m in msg]
         return json.loads(msg)
 
+    def valkey_serialize(self, msg) -> bytes:
+        """serialize a message to a version tagged entry"""
+        return self.serializer.encode(msg)
+
+    def valkey_deserialize(self, msg):
+        """deserialize a version tagged entry or legacy json"""
+        if isinstance(msg, list):
+            return self.serializer.decode_list(msg)
+        return self.serializer.decode(msg)
+
     def print_to_console(self, message: Message):
         """print to console"""
         log.info("INFO: %s", message)
@@ -174,18 +315,104 @@ class Helper:
             return tempfile.mktemp(suffix="." + extension, prefix=prefix)
         return tempfile.mktemp(suffix="." + extension)
 
-    def download_file(self, url: str, filename: str) -> str:
-        """download file from url using requests and return the filename/location"""
-        request = requests.get(url, allow_redirects=True, timeout=90)
-        with open(filename, "wb") as file:
-            file.write(request.content)
+    @contextlib.asynccontextmanager
+    async def request(
+        self, method: str, url, params=None, headers=None, guarded: bool = False, **kwargs
+    ):
+        """open a url on the shared http session
+
+        guarded requests follow redirects here so every hop is checked before it
+        is requested, the address of each host is checked when connecting.
+        """
+        session = get_http_session(guarded)
+        if not guarded:
+            async with session.request(
+                method, url, params=params, headers=headers, timeout=DOWNLOAD_TIMEOUT, **kwargs
+            ) as response:
+                yield response
+            return
+        history = []
+        for _ in range(MAX_REDIRECTS + 1):
+            error = url_error(url)
+            if error is not None:
+                raise BlockedAddressError(f"{url}: {error}")
+            response = await session.request(
+                method,
+                url,
+                params=params,
+                headers=headers,
+                timeout=DOWNLOAD_TIMEOUT,
+                allow_redirects=False,
+                **kwargs,
+            )
+            location = response.headers.get("Location")
+            if response.status not in REDIRECT_STATUSES or location is None:
+                break
+            response.release()
+            history.append(response)
+            url = response.url.join(URL(location))
+            # the query of the first url is part of the redirect location
+            params = None
+        else:
+            raise aiohttp.TooManyRedirects(history[0].request_info, tuple(history))
+        try:
+            yield response
+        finally:
+            response.release()
+
+    async def fetch(
+        self,
+        url: str,
+        params=None,
+        headers=None,
+        max_size: int = MAX_DOWNLOAD_SIZE,
+        guarded: bool = False,
+    ) -> HttpResponse:
+        """get a url on the shared http session, the body may not exceed max_size"""
+        async with self.request(
+            "GET", url, params=params, headers=headers, guarded=guarded
+        ) as response:
+            # check the content length before downloading
+            if response.content_length is not None and response.content_length > max_size:
+                raise DownloadTooLargeError(max_size)
+            content = bytearray()
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                content += chunk
+                if len(content) > max_size:
+                    raise DownloadTooLargeError(max_size)
+            return HttpResponse(
+                str(response.url), response.status, response.headers, bytes(content)
+            )
+
+    async def download_file(
+        self, url: str, filename: str, max_size: int = MAX_DOWNLOAD_SIZE, guarded: bool = False
+    ) -> str:
+        """stream a file from url to disk and return the filename/location"""
+        async with self.request("GET", url, guarded=guarded) as response:
+            response.raise_for_status()
+            if response.content_length is not None and response.content_length > max_size:
+                raise DownloadTooLargeError(max_size)
+            size = 0
+            try:
+                with open(filename, "wb") as file:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > max_size:
+                            raise DownloadTooLargeError(max_size)
+                        file.write(chunk)
+            except BaseException:
+                # don't leave a partial file behind
+                self.delete_downloaded_file(filename)
+                raise
         return filename
 
-    def download_file_to_tmp(self, url: str, extension: str, prefix: str = None) -> str:
-        """download file using requests and return the filename/location"""
+    async def download_file_to_tmp(
+        self, url: str, extension: str, prefix: str = None, guarded: bool = False
+    ) -> str:
+        """download file to a tmp file and return the filename/location"""
 
         filename = self.create_tmp_filename(extension, prefix=prefix)
-        return self.download_file(url, filename)
+        return await self.download_file(url, filename, guarded=guarded)
 
     def save_content_to_tmp_file(
         self, content, extension: str, prefix: str = None, binary: bool = False
@@ -222,7 +449,30 @@ class Helper:
 
         return message.replace(f"@{self.driver.client.username}", "").strip()
 
-    def validate_input(self, input_val, types=None, allowed_args=None, count=0):
+    async def get_thread_posts(self, thread_id: str, per_page: int = THREAD_PAGE_SIZE) -> list:
+        """get the posts of a thread oldest first, long threads are fetched in pages"""
+        posts = {}
+        params = {"perPage": per_page, "direction": "down"}
+        while True:
+            page = await asyncio.to_thread(
+                self.driver.posts.get_post_thread, thread_id, params
+            )
+            new_posts = [post for post_id, post in page["posts"].items() if post_id not in posts]
+            posts.update(page["posts"])
+            # servers without paging return the whole thread without has_next
+            if not page.get("has_next") or not new_posts:
+                break
+            last = max(new_posts, key=lambda post: int(post["create_at"]))
+            params = {
+                "perPage": per_page,
+                "direction": "down",
+                "fromPost": last["id"],
+                "fromCreateAt": last["create_at"],
+            }
+        # the thread order from mattermost has duplicates and is not sorted
+        return sorted(posts.values(), key=lambda post: int(post["create_at"]))
+
+    async def async_validate_input(self, input_val, types=None, allowed_args=None, count=0):
         """function that takes a string and validates that it matches against one or more of the types given in the list"""
         if allowed_args is None:
             allowed_args = []
@@ -259,72 +509,19 @@ class Helper:
         if "domain" in types:
             if validators.domain(input_val):
                 # verify that the ip returned from a dns lookup is not a private ip
-                try:
-                    answers = dns.resolver.resolve(input_val, "A")
-                except dns.resolver.NoAnswer:
-                    answers = []
-                # pylint: disable=broad-except
-                except Exception as error:
-                    return {"error": f"error resolving domain: {error}"}
-                try:
-                    answers6 = dns.resolver.resolve(input_val, "AAAA")
-                except dns.resolver.NoAnswer:
-                    answers6 = []
-                # pylint: disable=broad-except
-                except Exception as error:
-                    return {"error": f"error resolving domain: {error}"}
-                try:
-                    answersc = dns.resolver.resolve(input_val, "CNAME")
-                except dns.resolver.NoAnswer:
-                    answersc = []
-                # pylint: disable=broad-except
-                except Exception as error:
-                    return {"error": f"error resolving domain: {error}"}
-                if len(answers) == 0 and len(answers6) == 0 and len(answersc) == 0:
-                    return {"error": f"no dns records found for {input_val}"}
-                # loop over answers6 and answers and check if any of them are private ips
-                for answer in [answersc, answers6, answers]:
-                    for rdata in answer:
-                        # if CNAME record then validate the cname
-                        if answer.rdtype == dns.rdatatype.CNAME:
-                            result = self.validate_input(
-                                str(rdata.target).rstrip("."), ["domain"], count=count
-                            )
-                            # check if dict
-                            if isinstance(result, dict):
-                                if "error" in result:
-                                    return {"error": f"cname: {result['error']}"}
-                            continue
-                        ip = ipaddress.ip_address(rdata.address)
-                        if ip.is_private:
-                            return {"error": "private ip (resolved from dns)"}
-                        if ip.is_reserved:
-                            return {"error": "reserved ip (resolved from dns)"}
-                        if ip.is_multicast:
-                            return {"error": "multicast ip (resolved from dns)"}
-                        if ip.is_unspecified:
-                            return {"error": "unspecified ip (resolved from dns)"}
-                        if ip.is_loopback:
-                            return {"error": "loopback ip (resolved from dns)"}
-                        if ip.is_link_local:
-                            return {"error": "link local ip (resolved from dns)"}
-                        # if ipv6
-                        if ip.version == 6:
-                            if ip.sixtofour is not None:
-                                # verify the ipv4 address inside the ipv6 address is not private
-                                sixtofour = ipaddress.ip_address(ip.sixtofour)
-                                if sixtofour.is_private:
-                                    return {"error": "private ip (nice try though)"}
-                                if sixtofour.is_reserved:
-                                    return {"error": "reserved ip (nice try though)"}
-                                if sixtofour.is_multicast:
-                                    return {"error": "multicast ip (nice try though)"}
-                                if sixtofour.is_unspecified:
-                                    return {"error": "unspecified ip (nice try though)"}
-                                if sixtofour.is_loopback:
-                                    return {"error": "loopback ip (nice try though)"}
-                                if sixtofour.is_link_local:
-                                    return {"error": "link local ip (nice try though)"}
+                # A, AAAA and CNAME are looked up at once and cached for their ttl
+                answer = await self.dns_cache.lookup(input_val)
+                if answer.error:
+                    return {"error": answer.error}
+                for cname in answer.cnames:
+                    # if CNAME record then validate the cname
+                    result = await self.async_validate_input(cname, ["domain"], count=count)
+                    # check if dict
+                    if isinstance(result, dict):
+                        if "error" in result:
+                            return {"error": f"cname: {result['error']}"}
+                if answer.address_error:
+                    return {"error": answer.address_error}
                 return True
         if "ipv4" in types or "ip" in types:
             if validators.ipv4(input_val):
@@ -364,39 +561,19 @@ class Helper:
                 return True
         if "url" in types:
             if validators.url(input_val):
-                # fetch the url to verify all urls in the redirect chain
-                try:
-                    # get domain from url and validate it as a domain so we can check if it is a private ip
-                    domain = urllib.parse.urlparse(input_val).netloc
-                    if domain == input_val:
-                        # no domain found in url
-                        return {"error": "no domain found in url (or localhost)"}
-                    # call validateinput again with domain
-                    result = self.validate_input(
-                        domain, ["domain"], count=count)
-                    # check if dict
-                    if isinstance(result, dict):
-                        if "error" in result:
-                            return {"error": f"domain: {result['error']}"}
-                    response = requests.head(
-                        input_val, timeout=10, allow_redirects=True, verify=False
-                    )
-                    urls = []
-                    for r in response.history:
-                        if r.is_redirect:
-                            if r.status_code in [301, 302, 303, 307, 308]:
-                                # call validateinput again with the redirect url
-                                urls.append(r.url)
-                    # uniq the list
-                    urls = list(set(urls))
-                    for url in urls:
-                        result = self.validate_input(url, ["url"], count=count)
-                        # check if dict
-                        if isinstance(result, dict):
-                            if "error" in result:
-                                return {"error": f"redirect: {result['error']}"}
-                except requests.exceptions.RequestException as error:
-                    return {"error": f"error fetching url: {error}"}
+                # the redirect chain is checked hop by hop when the url is fetched
+                # get domain from url and validate it as a domain so we can check if it is a private ip
+                domain = urllib.parse.urlparse(input_val).netloc
+                if domain == input_val:
+                    # no domain found in url
+                    return {"error": "no domain found in url (or localhost)"}
+                # call validateinput again with domain
+                result = await self.async_validate_input(
+                    domain, ["domain"], count=count)
+                # check if dict
+                if isinstance(result, dict):
+                    if "error" in result:
+                        return {"error": f"domain: {result['error']}"}
                 return True
         if "asn" in types:
             if re.match(r"(AS|as)[0-9]+", input_val):
@@ -418,6 +595,20 @@ class Helper:
             "error": f"invalid input: {input_val} (no matches) for types {', '.join(types)}"
         }
 
+    async def validate_redirects(self, url):
+        """follow the redirects of a url with HEAD requests and check every hop
+
+        only for tools that fetch the url themselves, our own downloads are
+        guarded while they are fetched.
+        """
+        try:
+            async with self.request(
+                "HEAD", url, headers=self.headers, guarded=True, ssl=False
+            ):
+                return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            return {"error": f"error fetching url: {error}"}
+
     def get_content_type_and_ext(self, content_type):
         """Find the type and extension of the content using mimetypes and magic"""
         # Get the base content type without parameters
@@ -453,54 +644,71 @@ class Helper:
         return type_mapping.get(main_type, 'unknown'), ext
 
     async def download_webpage(self, url):
-        """download a webpage and return the content"""
+        """download a webpage and return the content, pages are cached in valkey"""
         # pylint: disable=attribute-defined-outside-init
         self.exit_after_loop = False
         # await self.log(f"downloading webpage {url}")
-        validate_result = self.validate_input(url, "url")
+        validate_result = await self.async_validate_input(url, "url")
         if validate_result is not True:
             await self.log(f"Error: {validate_result}")
             return validate_result, None
 
-        max_content_size = 10 * 1024 * 1024  # 10 MB
-        # follow redirects
-        response = requests.get(
-            url,
-            headers=self.headers,
-            timeout=10,
-            verify=True,
-            allow_redirects=True,
-            stream=True,
-        )
-        # check the content length before downloading
-        content_length = response.headers.get("Content-Length")
-        if content_length and int(content_length) > max_content_size:
-            await self.log(
-                f"Error: content size exceeds the maximum limit ({max_content_size} bytes)"
-            )
-            return (
-                f"Error: content size exceeds the maximum limit ({max_content_size} bytes)",
-                None,
+        cached = await self.page_cache.get(url)
+        if cached is not None and self.page_cache.is_fresh(cached):
+            await self.log(f"page cache hit: {url}")
+            return self.page_result(cached)
+        headers = self.headers
+        if cached is not None:
+            # ask the server if the page changed since we cached it
+            headers = {**self.headers, **self.page_cache.conditional_headers(cached)}
+        page = await self.fetch_page(url, headers)
+        if page is None:
+            await self.log(f"page not modified: {url}")
+            page = cached
+        elif page.get("error") and cached is not None and not cached.get("error"):
+            # the stale page is better than an error, try again next time
+            return self.page_result(cached)
+        await self.page_cache.put(url, page)
+        return self.page_result(page)
+
+    def page_result(self, page: dict):
+        """the content of a page and a temp file with the saved text"""
+        if page.get("error") or page.get("saved") is None:
+            return page["content"], None
+        return page["content"], self.save_content_to_tmp_file(page["saved"], page["ext"])
+
+    async def page_error(self, message: str, log_message: str = None) -> dict:
+        """log a download error and return it as a page so it is cached"""
+        await self.log(log_message or message)
+        return {"error": True, "content": message}
+
+    async def fetch_page(self, url, headers) -> dict | None:
+        """download and extract a page, None if the server says it is not modified"""
+        # follow redirects, the body is streamed and capped at MAX_DOWNLOAD_SIZE
+        try:
+            # every redirect hop and resolved address is checked while connecting
+            response = await self.fetch(url, headers=headers, guarded=True)
+        except DownloadTooLargeError as e:
+            return await self.page_error(f"Error: {e}")
+        except asyncio.TimeoutError:
+            return await self.page_error("Error: could not download webpage (Timeout)")
+        except aiohttp.TooManyRedirects:
+            return await self.page_error("Error: could not download webpage (TooManyRedirects)")
+        except aiohttp.ClientError as e:
+            return await self.page_error(
+                "Error: could not download webpage (ClientError) " + str(e)
             )
-
-        # download the content in chunks
-        content = b""
-        total_bytes_read = 0
-        chunk_size = 1024  # adjust the chunk size as needed
-        for chunk in response.iter_content(chunk_size=chunk_size):
-            content += chunk
-            total_bytes_read += len(chunk)
-            if total_bytes_read > max_content_size:
-                await self.log(
-                    f"Error: content size exceeds the maximum limit ({max_content_size} bytes)"
-                )
-                return (
-                    f"Error: content size exceeds the maximum limit ({max_content_size} bytes)",
-                    None,
-                )
-        response_text = content.decode("utf-8")
-        # save response_text to a tmp fil
-        blacklisted_tags = ["script", "style", "noscript"]
+        if response.status_code == 304 and (
+            "If-None-Match" in headers or "If-Modified-Since" in headers
+        ):
+            return None
+        content = response.content
+        response_text = response.text
+        # validators for conditional requests when the page goes stale
+        page = {
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+        }
 
         try:
             if response.status_code == 200:
@@ -515,134 +723,129 @@ class Helper:
                 await self.log(f"content_type: {url} {content_type}")
                 # html
                 if "html" in content_type:
-                    # extract all text from the webpage
-
-                    soup = bs4.BeautifulSoup(response_text, "html.parser")
-                    # check if the soup could parse anything
+                    # extract all text from the webpage in the worker pool
+                    # so big pages don't block the event loop
                     try:
-                        if soup.find():
-                            # soup parsed something lets extract the text
-                            # remove all blacklisted tags
-                            for tag in blacklisted_tags:
-                                for match in soup.find_all(tag):
-                                    match.decompose()
-                            # get all links and links text from the webpage
-                            links = []
-                            for link in soup.find_all("a"):
-                                links.append(f"{link.get('href')} {link.text}")
-                            links = " | ".join(links)
-                            # check if title exists and set it to a variable
-                            title = soup.title.string if soup.title else ""
-                            # extract all text from the body
-                            text = "Error getting body text from webpage"
-                            if soup.body:
-                                text = soup.body.get_text(
-                                    separator=" ", strip=True)
-                            text_full = soup.body.get_text()
-                            # trim all newlines to 2 spaces
-                            text = text.replace("\n", "  ")
-
-                            # remove all newlines and replace them with spaces
-                            # text = text.replace("\n", " ")
-                            # remove all double spaces
-                            # save the text to a file
-                            text_to_return = (
-                                f"links:{links}|title:{title}|body:{text}".strip()
+                        extracted = await htmlextract.extract_async(response_text)
+                        if extracted is None:
+                            return await self.page_error(
+                                "Error: could not parse webpage",
+                                f"Error: could not parse webpage {url}",
                             )
-                            text_to_save = f"Url: {url}\nTitle: {title}\nLinks: {links}\nBody:\n{text_full}".strip(
-                            )
-                            filename = self.save_content_to_tmp_file(
-                                text_to_save, ext)
-                            return text_to_return, filename
+                        links = extracted["links"]
+                        title = extracted["title"]
+                        # trim all newlines to 2 spaces
+                        text = extracted["text"].replace("\n", "  ")
+                        # the text to return and the text to save to a file
+                        page["content"] = (
+                            f"links:{links}|title:{title}|body:{text}".strip()
+                        )
+                        page["saved"] = f"Url: {url}\nTitle: {title}\nLinks: {links}\nBody:\n{extracted['text_full']}".strip(
+                        )
+                        page["ext"] = ext
+                        return page
                     # pylint: disable=broad-except
                     except Exception as e:
-                        await self.log(
+                        return await self.page_error(
                             f"Error: could not parse webpage (Exception) {e}"
                         )
-                        return f"Error: could not parse webpage (Exception) {e}", None
                 elif content_type == "text":
-                    # save the text to a file
-                    filename = self.save_content_to_tmp_file(
-                        response_text, ext)
-                    # text content
-                    return response_text, filename
+                    # text content, saved to a file as is
+                    page["content"] = page["saved"] = response_text
+                    page["ext"] = ext
+                    return page
                 else:
                     # unknown content type
-                    await self.log(
-                        f"Error: unknown content type {content_type} for {url} (status code {response.status_code}) returned: {response_text[:500]}"
-                    )
-                    return (
+                    return await self.page_error(
                         f"Error: unknown content type {content_type} for {url} (status code {response.status_code}) returned: {response_text}",
-                        None,
+                        f"Error: unknown content type {content_type} for {url} (status code {response.status_code}) returned: {response_text[:500]}",
                     )
             else:
-                await self.log(
+                return await self.page_error(
                     f"Error: could not download webpage (status code {response.status_code})"
                 )
-                return (
-                    f"Error: could not download webpage (status code {response.status_code})",
-                    None,
-                )
-        except requests.exceptions.Timeout:
-            await self.log("Error: could not download webpage (Timeout)")
-            return "Error: could not download webpage (Timeout)", None
-        except requests.exceptions.TooManyRedirects:
-            await self.log("Error: could not download webpage (TooManyRedirects)")
-            return "Error: could not download webpage (TooManyRedirects)", None
-        except requests.exceptions.RequestException as e:
-            await self.log(f"Error: could not download webpage (RequestException) {e}")
-            return (
-                "Error: could not download webpage (RequestException) " +
-                str(e),
-                None,
-            )
         # pylint: disable=broad-except
         except Exception as e:  # pylint: disable=broad-except
-            await self.log(f"Error: could not download webpage (Exception) {e}")
-            return "Error: could not download webpage (Exception) " + str(e), None
+            return await self.page_error(
+                "Error: could not download webpage (Exception) " + str(e)
+            )
+
+    @staticmethod
+    def is_download_error(content) -> bool:
+        """check if download_webpage returned an error instead of content"""
+        return not content or not isinstance(content, str) or content.startswith("Error")
 
-    async def web_search_and_download(self, searchterm):
-        """run the search and download top 2 results from duckduckgo"""
+    async def web_search_and_download(
+        self, searchterm, wanted: int = 2, parallel: int = 3, deadline: float = 15
+    ):
+        """run the search and download the first wanted results that work
+
+        parallel downloads run at once and each gets deadline seconds. a failed
+        download starts the next result, the rest are cancelled once enough succeeded.
+        """
         # pylint: disable=attribute-defined-outside-init
         self.exit_after_loop = False
-        downloaded = []
         localfiles = []
         await self.log(f"searching the web for {searchterm}")
         results, results_filename = await self.web_search(searchterm)
         if results_filename:
             localfiles.append(results_filename)
-        i = 0
-        # loop through the results and download the top 2 searches
-        for result in results:
-            # only download 2 results
-            # try all of them in line and stop after 2. zero indexed
-            if i >= 2:
-                break
-            # await self.log(f"downloading webpage {result}")
-            try:
-                # download the webpage and add the content to the result object
-                if "href" not in result:
-                    return "Error: href not in result", None
-                content, localfile = await self.download_webpage(result.get("href"))
-                if localfile:
-                    localfiles.append(localfile)
-                # await self.log(f"webpage content: {content[:500]}")
-                i = i + 1
-            # pylint: disable=broad-except
-            except Exception as e:
-                await self.log(f"Error: {e}")
-                content = None
-            if content:
-                result["content"] = content
-                downloaded.append(result)
-            else:
-                result["content"] = (
-                    f"Error: could not download webpage {result.get('href')}"
-                )
-                downloaded.append(result)
-        # await self.log(f"search results: {results}")
-        # return the downloaded webpages as json
-        return json.dumps(downloaded), localfiles
+        if not isinstance(results, list):
+            return f"Error: {results}", localfiles
+        candidates = iter(
+            [(rank, result) for rank, result in enumerate(results) if result.get("href")]
+        )
+        pending = {}
+
+        def start_next():
+            for rank, result in candidates:
+                download = self.download_webpage(result["href"])
+                task = asyncio.ensure_future(asyncio.wait_for(download, deadline))
+                pending[task] = (rank, result)
+                return
+
+        for _ in range(max(1, parallel)):
+            start_next()
+        downloaded = {}
+        failed = {}
+        try:
+            while pending and len(downloaded) < wanted:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    rank, result = pending.pop(task)
+                    try:
+                        content, localfile = task.result()
+                    except asyncio.TimeoutError:
+                        content = f"Error: download timed out after {deadline:g} seconds"
+                        localfile = None
+                    # pylint: disable=broad-except
+                    except Exception as e:
+                        await self.log(f"Error: {e}")
+                        content, localfile = f"Error: {e}", None
+                    if self.is_download_error(content):
+                        failed[rank] = {
+                            **result,
+                            "content": f"Error: could not download webpage {result['href']}: {content}",
+                        }
+                        start_next()
+                    elif len(downloaded) < wanted:
+                        downloaded[rank] = {**result, "content": content}
+                        if localfile:
+                            localfiles.append(localfile)
+                        continue
+                    # failed or finished together with the last one we needed
+                    if localfile:
+                        self.delete_downloaded_file(localfile)
+        finally:
+            # cancel the slower downloads, files they managed to save are removed
+            for task in pending:
+                task.cancel()
+            for outcome in await asyncio.gather(*pending, return_exceptions=True):
+                if isinstance(outcome, tuple) and outcome[1]:
+                    self.delete_downloaded_file(outcome[1])
+        # keep the search ranking, report the failures if nothing worked
+        downloaded = downloaded or failed
+        return json.dumps([downloaded[rank] for rank in sorted(downloaded)]), localfiles
 
     async def web_search(self, searchterm):
         """search the web using google and return the results"""
@@ -651,7 +854,10 @@ class Helper:
 
         await self.log("searching the web")
         try:
-            results = googlesearch(searchterm, advanced=True, num_results=50)
+            # the search is blocking and lazy, run it to the end in a thread
+            results = await asyncio.to_thread(
+                lambda: list(googlesearch(searchterm, advanced=True, num_results=50))
+            )
 
             # class SearchResult:
             # def __init__(self, url, title, description):
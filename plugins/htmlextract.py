@@ -0,0 +1,226 @@
+"""extract links, title and text from html in one pass, off the event loop"""
+
+import asyncio
+import html.parser
+import importlib.util
+import logging
+import multiprocessing
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from environs import Env
+
+env = Env()
+log = logging.getLogger(__name__)
+
+# html.parser needs nothing, lxml and selectolax are optional and faster
+HTML_PARSER = env.str("HTML_PARSER", "html.parser")
+# process: parse in worker processes, thread: parse in worker threads
+HTML_EXTRACT_POOL = env.str("HTML_EXTRACT_POOL", "process")
+HTML_EXTRACT_WORKERS = env.int("HTML_EXTRACT_WORKERS", 2)
+
+# the content of these tags is never text
+SKIP_TAGS = ("script", "style", "noscript")
+# the pool for each kind, created on first use
+EXECUTORS = {}
+
+
+class PageCollector:
+    """collect the page parts from parser events
+
+    the same start/end/data/close interface is used by lxml parser targets so
+    both the stdlib and the lxml backend feed this without building a tree.
+    """
+
+    def __init__(self):
+        self.elements = 0
+        self.skip = 0
+        self.in_body = False
+        self.has_body = False
+        self.title_parts = None
+        self.title = None
+        # [href, [text parts]] for every link, and the links we are inside of
+        self.links = []
+        self.open_links = []
+        self.body_parts = []
+        self.document_parts = []
+
+    def start(self, tag, attrib):
+        """an opening tag"""
+        self.elements += 1
+        if self.skip or tag in SKIP_TAGS:
+            if tag in SKIP_TAGS:
+                self.skip += 1
+            return
+        if tag == "body":
+            self.in_body = self.has_body = True
+        elif tag == "title" and self.title is None:
+            self.title_parts = []
+        elif tag == "a":
+            link = [attrib.get("href"), []]
+            self.links.append(link)
+            self.open_links.append(link)
+
+    def end(self, tag):
+        """a closing tag"""
+        if tag in SKIP_TAGS:
+            self.skip = max(0, self.skip - 1)
+            return
+        if self.skip:
+            return
+        if tag == "body":
+            self.in_body = False
+        elif tag == "title" and self.title_parts is not None:
+            self.title = "".join(self.title_parts)
+            self.title_parts = None
+        elif tag == "a" and self.open_links:
+            self.open_links.pop()
+
+    def data(self, data):
+        """text between tags"""
+        if self.skip:
+            return
+        if self.title_parts is not None:
+            self.title_parts.append(data)
+        for link in self.open_links:
+            link[1].append(data)
+        if self.in_body:
+            self.body_parts.append(data)
+        self.document_parts.append(data)
+
+    def close(self) -> dict | None:
+        """the extracted page, None if nothing could be parsed"""
+        if not self.elements:
+            return None
+        if self.title is None and self.title_parts is not None:
+            self.title = "".join(self.title_parts)
+        # pages without a body tag still have text
+        parts = self.body_parts if self.has_body else self.document_parts
+        return page(
+            links=[(href, "".join(text)) for href, text in self.links],
+            title=self.title or "",
+            text=" ".join(part.strip() for part in parts if part.strip()),
+            text_full="".join(parts),
+        )
+
+
+class StdlibParser(html.parser.HTMLParser):
+    """feed html.parser events to a collector"""
+
+    def __init__(self, target: PageCollector):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, dict(attrs))
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+
+def page(links: list, title: str, text: str, text_full: str) -> dict:
+    """the result of every backend"""
+    return {
+        "links": " | ".join(f"{href} {text}" for href, text in links),
+        "title": title,
+        "text": text,
+        "text_full": text_full,
+    }
+
+
+def extract_stdlib(content: str) -> dict | None:
+    """single pass with the stdlib parser"""
+    collector = PageCollector()
+    parser = StdlibParser(collector)
+    parser.feed(content)
+    parser.close()
+    return collector.close()
+
+
+def extract_lxml(content: str) -> dict | None:
+    """single pass with the lxml parser calling the collector directly"""
+    # pylint: disable=import-outside-toplevel
+    from lxml import etree
+
+    parser = etree.HTMLParser(target=PageCollector())
+    parser.feed(content)
+    return parser.close()
+
+
+def extract_selectolax(content: str) -> dict | None:
+    """selectolax builds its tree in c, we only walk what we need"""
+    # pylint: disable=import-outside-toplevel
+    from selectolax.parser import HTMLParser
+
+    tree = HTMLParser(content)
+    if tree.root is None:
+        return None
+    tree.strip_tags(list(SKIP_TAGS))
+    title = tree.css_first("title")
+    body = tree.body or tree.root
+    return page(
+        links=[(link.attributes.get("href"), link.text()) for link in tree.css("a")],
+        title=title.text() if title else "",
+        text=body.text(separator=" ", strip=True),
+        text_full=body.text(),
+    )
+
+
+PARSERS = {
+    "html.parser": (extract_stdlib, None),
+    "lxml": (extract_lxml, "lxml"),
+    "selectolax": (extract_selectolax, "selectolax"),
+}
+
+
+def available_parsers() -> list:
+    """the parsers that can be used here"""
+    return [
+        name
+        for name, (_, module) in PARSERS.items()
+        if module is None or importlib.util.find_spec(module) is not None
+    ]
+
+
+def get_parser(name: str):
+    """get the extract function for a parser, falls back to html.parser"""
+    if name not in available_parsers():
+        log.warning("html parser %s is not available, using html.parser", name)
+        name = "html.parser"
+    return PARSERS[name][0]
+
+
+def extract(content: str, parser: str = HTML_PARSER) -> dict | None:
+    """extract links, title, text and full text from a page"""
+    return get_parser(parser)(content)
+
+
+def get_executor(kind: str = HTML_EXTRACT_POOL):
+    """get the shared extraction pool"""
+    if kind not in EXECUTORS:
+        if kind == "thread":
+            EXECUTORS[kind] = ThreadPoolExecutor(
+                HTML_EXTRACT_WORKERS, thread_name_prefix="htmlextract"
+            )
+        else:
+            # spawn, forking a process with running threads is not safe
+            EXECUTORS[kind] = ProcessPoolExecutor(
+                HTML_EXTRACT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+    return EXECUTORS[kind]
+
+
+async def extract_async(
+    content: str, parser: str = HTML_PARSER, kind: str = HTML_EXTRACT_POOL
+) -> dict | None:
+    """extract a page in the worker pool so big pages don't block the event loop"""
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(get_executor(kind), extract, content, parser)
+    except BrokenExecutor:
+        # a worker died, start a new pool next time and parse this page in a thread
+        log.warning("html extraction pool %s broke, restarting it", kind)
+        EXECUTORS.pop(kind, None)
+        return await loop.run_in_executor(get_executor("thread"), extract, content, parser)
@@ -20,6 +20,17 @@ from mmpy_bot.settings import Settings
 from mmpy_bot.wrappers import Message
 
 from plugins.base import PluginLoader
+from plugins.intervalsrefresh import (
+    INTERVALS_MAX_RESPONSE_SIZE,
+    INTERVALS_SYNC_OVERLAP_DAYS,
+    INTERVALS_SYNC_PAGE_DAYS,
+    INTERVALS_SYNC_START,
+    RETRY_STATUSES,
+    RefreshEngine,
+    RetryableError,
+    retry_after,
+)
+from plugins.intervalsstore import IntervalsStore, date_pages
 from plugins.models.intervals_activity import IntervalsActivity
 from plugins.models.intervals_wellness import IntervalsWellness, SportInfo
 
@@ -51,6 +62,8 @@ def bot_command(category: str, description: str, pattern: str = None, admin: boo
 class IntervalsIcu(PluginLoader):
     """IntervalsIcu plugin"""
     _INTERNAL_TIMER_LOOP = 300
+    # the refresh job runs every 270 to 330 seconds so bots started together drift apart
+    _INTERNAL_TIMER_JITTER = 30
     _MINIMUM_REFRESH_INTERVAL_FOR_ATHLETE = 60  # 5 minutes
     ACTIVITY_OVERVIEW_COMMON_FIELDS = [
         "moving_time",
@@ -194,6 +207,17 @@ Parameters:
         self.valkey = self.helper.valkey
         self.intervals_prefix = "INTERVALSICU"
         self.api_url = "https://app.intervals.icu/api/v1"
+        self.activity_store = IntervalsStore(
+            self.valkey, self.intervals_prefix, "activities", IntervalsActivity,
+            date_field="start_date_local", sort_key=lambda activity: activity.start_date,
+        )
+        self.wellness_store = IntervalsStore(
+            self.valkey, self.intervals_prefix, "wellness", IntervalsWellness,
+            date_field="id", sort_key=lambda wellness: wellness.id, merge=True,
+            # icu_sync_date of activities only moves when a device syncs, not when they are edited
+            change_field="updated",
+        )
+        self.refresh_engine = RefreshEngine(self._scrape_athlete)
 
         # get all athletes and opted in athletes
         self.athletes = self.valkey.smembers(f"{self.intervals_prefix}_athletes") or set()
@@ -212,10 +236,17 @@ Parameters:
         else:
             self.announcements_enabled = True
             self.announcement_channel = self.get_announcement_channel()
+        # move athletes still on the old list layout to the hashes
+        for athlete in self.athletes:
+            self.activity_store.migrate(athlete)
+            self.wellness_store.migrate(athlete)
         # jobs
         self.jobs = {}
-        self.jobs['refresh_all_athletes'] = schedule.every(self._INTERNAL_TIMER_LOOP).seconds.do(self.refresh_all_athletes)
-        self.jobs['cleanup_duplicates'] = schedule.every(1).minutes.do(self.cleanup_duplicates_for_all_athletes)
+        self.jobs['refresh_all_athletes'] = (
+            schedule.every(self._INTERNAL_TIMER_LOOP - self._INTERNAL_TIMER_JITTER)
+            .to(self._INTERNAL_TIMER_LOOP + self._INTERNAL_TIMER_JITTER)
+            .seconds.do(self.refresh_all_athletes)
+        )
         self.jobs['cleanup_broken_athletes'] = schedule.every(1).days.do(self.cleanup_broken_athletes)
         # activity announcement job
         self.jobs['announce_added_activities'] = schedule.every(5).seconds.do(self.announce_added_activities)
@@ -230,45 +261,15 @@ Parameters:
         # clear refresh lock
         self.clear_lock("refresh_all_athletes")
 
-        # run the jobs on startup
+        # start the jobs on startup, the bot does not wait for them
         self.refresh_all_athletes(force=True)
-        self.cleanup_duplicates_for_all_athletes()
-        self.cleanup_broken_athletes()
+        self.refresh_engine.submit(asyncio.to_thread(self.cleanup_broken_athletes))
 
     def cleanup_broken_athletes(self):
-        for athlete in self.athletes:
+        for athlete in list(self.athletes):
             if not self.verify_api_key(athlete):
                 self.remove_athlete(athlete)
 
-    def cleanup_duplicates_for_all_athletes(self):
-        for athlete in self.athletes:
-            self.cleanup_duplicates(athlete)
-
-    def cleanup_duplicates(self, uid: str):
-        activities = self.get_activities(uid)
-        wellness = self.get_wellnesses(uid)
-        # get wellnesses directy from the valkey
-        wellnesses = self.valkey.lrange(f"{self.intervals_prefix}_athlete_{uid}_wellness", 0, -1)
-        # sort wellnesses by id
-        wellnesses = sorted(wellnesses, key=lambda x: json.loads(x).get("id"))
-        if activities:
-            activities = sorted(activities, key=lambda x: x.id)
-            for i in range(1, len(activities)):
-                if activities[i].id == activities[i-1].id:
-                    self.helper.console(f"Removing duplicate activity for user {self.users.id2u(uid)} - {activities[i].id} and {activities[i-1].id}")
-                    self.remove_activity(uid, activities[i].to_json())
-        if wellness:
-            # sort by "id" and "updated"
-            wellness = sorted(wellness, key=lambda x: (x.id, x.updated))
-            for i in range(1, len(wellness)):
-                old_wellness = wellness[i-1]
-                new_wellness = wellness[i]
-                if old_wellness.id == new_wellness.id:
-                    # merge the two wellnesses
-                    merged = IntervalsWellness.from_dict({**old_wellness.to_dict(), **new_wellness.to_dict()})
-                    self.helper.console(f"Removing duplicate wellness for user {self.users.id2u(uid)} - {old_wellness.id} and {new_wellness.id}")
-                    self.remove_wellness(uid, json.dumps(wellnesses[i]))
-                    self.add_wellness(uid, merged)
     def return_pretty_activities(self, activities: list[IntervalsActivity]):
         """return pretty activities"""
         activities_str = ""
@@ -318,21 +319,9 @@ Parameters:
 
     def add_activity(self, uid: str, activity: IntervalsActivity) -> str:
         """Add an activity to storage"""
-        activity_id = activity.id
-        activities = self.get_activities(uid)
-        if activities:
-            for i, act in enumerate(activities):
-                if act.id == activity_id:
-                    if act == activity:
-                        return "alreadyexists"
-                    self.remove_activity(uid, act.to_dict())
-                    self.valkey.lpush(f"{self.intervals_prefix}_athlete_{uid}_activities", activity.to_json())
-                    return "changed"
-        if self.valkey.exists(f"{self.intervals_prefix}_athlete_{uid}_activities"):                
-            if activity.to_json() in self.valkey.lrange(f"{self.intervals_prefix}_athlete_{uid}_activities", 0, -1):
-                return "alreadyexists"
-
-        self.valkey.lpush(f"{self.intervals_prefix}_athlete_{uid}_activities", activity.to_json())
+        result = self.activity_store.upsert(uid, activity)
+        if result != "added":
+            return result
         # lets keep track of the added activities so we can announce them to the channel
         if uid in self.opted_in:
             self.valkey.lpush(f"{self.intervals_prefix}_athlete_{uid}_activities_added", activity.to_json())
@@ -360,68 +349,35 @@ Parameters:
         if IntervalsWellness.has_field(metric):
             return "wellness"
 
-    def remove_activity(self, uid: str, activity: dict):
-        self.valkey.lrem(f"{self.intervals_prefix}_athlete_{uid}_activities", 0, json.dumps(activity))
+    def remove_activity(self, uid: str, activity_id: str):
+        """remove an activity"""
+        self.activity_store.remove(uid, activity_id)
 
     def get_activities(self, uid: str, oldest: str | None = None, newest: str | None = None) -> list[IntervalsActivity]:
         """get activities"""
-        activities = self.valkey.lrange(f"{self.intervals_prefix}_athlete_{uid}_activities", 0, -1)
-        if activities:
-            # Convert JSON strings to IntervalsActivity objects
-            activities = [IntervalsActivity.from_dict(json.loads(activity)) for activity in activities]
-            # Sort by start_date
-            activities = sorted(activities, key=lambda x: x.start_date)
-            if oldest and newest:
-                activities = [activity for activity in activities
-                       if parser.parse(oldest) <= parser.parse(activity.start_date_local) <= parser.parse(newest)]
-                return activities
-            return activities
-        return []
+        if oldest and newest:
+            oldest, newest = parser.parse(oldest), parser.parse(newest)
+            # only the days of the window are read, the times are checked here
+            activities = self.activity_store.get_range(uid, oldest.date(), newest.date())
+            return [activity for activity in activities if oldest <= activity.start_datetime_local <= newest]
+        return self.activity_store.get_all(uid)
 
     def add_wellness(self, uid: str, wellness: IntervalsWellness) -> str:
-        """Add a wellness entry to storage"""
-        wellness_id = wellness.id
-        wellnesses = self.get_wellnesses(uid)
-        if wellnesses:
-            for i, well in enumerate(wellnesses):
-                if well.id == wellness_id:
-                    # if the id already exists lets merge the new with the old one and update it
-                    old_wellness = wellnesses[i].to_dict()
-                    new_wellness = wellness.to_dict()
-                    # merge the two dictionaries
-                    wellness = IntervalsWellness.from_dict({**old_wellness, **new_wellness})
-                    # remove the old wellness
-                    self.remove_wellness(uid, well.to_json())
-                    # add the new wellness
-                    self.valkey.lpush(f"{self.intervals_prefix}_athlete_{uid}_wellness", wellness.to_json())
-                    return "changed"
-        if self.valkey.exists(f"{self.intervals_prefix}_athlete_{uid}_wellness"):
-            if wellness.to_json() in self.valkey.lrange(f"{self.intervals_prefix}_athlete_{uid}_wellness", 0, -1):
-                return "alreadyexists"
-        self.valkey.lpush(f"{self.intervals_prefix}_athlete_{uid}_wellness", wellness.to_json())
-        return "added"
+        """Add a wellness entry to storage, an existing entry for the day is merged with it"""
+        return self.wellness_store.upsert(uid, wellness)
 
-    def remove_wellness(self, uid: str, wellness: dict):
+    def remove_wellness(self, uid: str, wellness_id: str):
         """remove wellness"""
-        # check if it is a string or a dict
-        if isinstance(wellness, dict):
-            wellness = json.dumps(wellness)
-        self.valkey.lrem(f"{self.intervals_prefix}_athlete_{uid}_wellness", 0, wellness)
+        self.wellness_store.remove(uid, wellness_id)
 
     def get_wellnesses(self, uid: str, oldest: str | None = None, newest: str | None = None) -> list[IntervalsWellness]:
         """get wellness"""
-        wellnesses = self.valkey.lrange(f"{self.intervals_prefix}_athlete_{uid}_wellness", 0, -1)
-        if wellnesses:
-            # Convert JSON strings to IntervalsWellness objects
-            wellnesses = [IntervalsWellness.from_dict(json.loads(wellness)) for wellness in wellnesses]
-            # Sort by id (date)
-            wellnesses = sorted(wellnesses, key=lambda x: x.id)
-            # self.helper.slog(f"Got wellnesses: {wellnesses[:10]}")
-            if oldest and newest:
-                return [wellness for wellness in wellnesses
-                       if parser.parse(oldest) <= parser.parse(wellness.id) <= parser.parse(newest)]
-            return wellnesses
-        return []
+        if oldest and newest:
+            oldest, newest = parser.parse(oldest), parser.parse(newest)
+            wellnesses = self.wellness_store.get_range(uid, oldest.date(), newest.date())
+            return [wellness for wellness in wellnesses
+                    if oldest <= datetime.datetime.combine(wellness.day, datetime.time()) <= newest]
+        return self.wellness_store.get_all(uid)
     def _headers(self, uid: str):
         """Basic authorization headers"""
         username ="API_KEY"
@@ -457,78 +413,116 @@ Parameters:
                 return False
         return False
 
-    def _scrape_athlete(self, uid: str, force_all: bool = False):
-        """scrape all things from intervals"""
-        today = datetime.datetime.now()
-        newest = (today + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-        activities = self.get_activities(uid)
-        wellness = self.get_wellnesses(uid)
-        wellnesses_added = 0
-        activities_added = 0
-        wellnesses_changed = 0
-        activities_changed = 0
-
-        if activities:
-            oldest_activity = parser.parse(activities[-1].start_date).strftime("%Y-%m-%d")
-            oldest_activity = (parser.parse(oldest_activity) - datetime.timedelta(days=3)).strftime("%Y-%m-%d")
-        else:
-            oldest_activity = (today - datetime.timedelta(days=30)).strftime("%Y-%m-%d")
-
-        if wellness:
-            oldest_wellness = parser.parse(wellness[-1].id).strftime("%Y-%m-%d")
-            oldest_wellness = (parser.parse(oldest_wellness) - datetime.timedelta(days=3)).strftime("%Y-%m-%d")
-        else:
-            oldest_wellness = (today - datetime.timedelta(days=10*365)).strftime("%Y-%m-%d")
-
+    async def _arequest(self, endpoint: str, uid: str, params: dict | None = None, headers: dict | None = None):
+        """get an endpoint of intervals api for an athlete on the shared http session"""
+        response = await self.helper.fetch(
+            self._endpoint(endpoint),
+            params=params,
+            headers={**self._headers(uid), **(headers or {})},
+            max_size=INTERVALS_MAX_RESPONSE_SIZE,
+        )
+        if response.status_code in RETRY_STATUSES:
+            raise RetryableError(response.status_code, retry_after(response.headers))
+        return response
+
+    def _store_records(self, uid: str, store: IntervalsStore, records: list, since: float | None) -> tuple[int, int, float | None]:
+        """store records from the api, returns added, changed and the newest change time"""
+        added = changed = 0
+        newest_change = since
+        for data in records:
+            if data.get("source", "").lower() == "strava":
+                # strava activities not supported via the api for some reason
+                continue
+            change_time = store.change_time(data)
+            if change_time is not None:
+                # records the api says are unchanged since the last sync are not decoded
+                if since is not None and change_time <= since:
+                    continue
+                newest_change = max(newest_change or change_time, change_time)
+            if store is self.activity_store:
+                result = self.add_activity(uid, IntervalsActivity.from_dict(data))
+            else:
+                result = self.add_wellness(uid, IntervalsWellness.from_dict(data))
+            if result == "added":
+                added += 1
+            elif result == "changed":
+                changed += 1
+        return added, changed, newest_change
+
+    def _sync_oldest(self, uid: str, store: IntervalsStore) -> str:
+        """the first day the next sync asks for, records before the newest one are settled"""
+        newest_record = store.newest(uid)
+        newest_day = getattr(newest_record, store.date_field)[:10] if newest_record else datetime.date.today().isoformat()
+        return (datetime.date.fromisoformat(newest_day) - datetime.timedelta(days=INTERVALS_SYNC_OVERLAP_DAYS)).isoformat()
+
+    async def _sync(self, uid: str, store: IntervalsStore, endpoint: str, force_all: bool = False) -> tuple[int, int]:
+        """sync records of an athlete from the cursor on, returns added and changed
+
+        an athlete without a cursor, or with force_all, is resynced from
+        INTERVALS_SYNC_START in pages of INTERVALS_SYNC_PAGE_DAYS, the cursor
+        keeps the next page so an interrupted resync carries on where it
+        stopped. afterwards only the days from the newest record on are asked
+        for, conditionally so an unchanged window comes back as 304.
+        """
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
         if force_all:
-            oldest_activity = "2010-01-01"
-            oldest_wellness = "2010-01-01"
-
-        params_activity = {"oldest": oldest_activity, "newest": newest}
-        params_wellness = {"oldest": oldest_wellness, "newest": newest}
-
+            store.update_cursor(uid, resync=INTERVALS_SYNC_START.isoformat())
+        cursor = store.cursor(uid)
+        if not cursor and store.count(uid):
+            # athletes synced before there were cursors carry on from their newest record
+            cursor = {"oldest": self._sync_oldest(uid, store)}
+        added = changed = 0
+        if "resync" in cursor or "oldest" not in cursor:
+            resync = datetime.date.fromisoformat(cursor.get("resync", INTERVALS_SYNC_START.isoformat()))
+            newest_change = None
+            for oldest, newest in date_pages(resync, tomorrow, INTERVALS_SYNC_PAGE_DAYS):
+                response = await self._arequest(endpoint, uid, {"oldest": oldest.isoformat(), "newest": newest.isoformat()})
+                if response.status_code != 200:
+                    raise Exception(f"Failed to get {endpoint}: {response.status_code}")
+                page_added, page_changed, page_change = self._store_records(uid, store, response.json(), None)
+                added, changed = added + page_added, changed + page_changed
+                newest_change = max(filter(None, (newest_change, page_change)), default=None)
+                store.update_cursor(uid, resync=(newest + datetime.timedelta(days=1)).isoformat())
+            window, validators = None, {}
+        else:
+            window = f"{cursor['oldest']}/{tomorrow.isoformat()}"
+            headers = {}
+            # the validators only hold for the window they were sent for
+            if cursor.get("window") == window:
+                if cursor.get("etag"):
+                    headers["If-None-Match"] = cursor["etag"]
+                if cursor.get("last_modified"):
+                    headers["If-Modified-Since"] = cursor["last_modified"]
+            response = await self._arequest(
+                endpoint, uid, {"oldest": cursor["oldest"], "newest": tomorrow.isoformat()}, headers
+            )
+            if response.status_code == 304:
+                return 0, 0
+            if response.status_code != 200:
+                raise Exception(f"Failed to get {endpoint}: {response.status_code}")
+            since = float(cursor["changed"]) if cursor.get("changed") else None
+            added, changed, newest_change = self._store_records(uid, store, response.json(), since)
+            validators = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+        store.update_cursor(
+            uid,
+            oldest=self._sync_oldest(uid, store),
+            changed=newest_change,
+            window=window,
+            etag=validators.get("etag"),
+            last_modified=validators.get("last_modified"),
+            resync=None,
+        )
+        return added, changed
+
+    async def _scrape_athlete(self, uid: str, force_all: bool = False):
+        """scrape all things from intervals"""
         try:
-            # get activities
-            # self.helper.slog(f"Getting activities from intervals {oldest_activity} to {newest}")
-            response = self._request("activities", "GET", uid=uid, data=params_activity)
-            if response.status_code == 200:
-                activities_data = response.json()
-                for activity_data in activities_data:
-                    # self.helper.slog(f"Got activity: {self.users.id2u(uid)} - {activity_data.get('start_date')} - {activity_data.get('id')}")
-                    if activity_data.get("source","").lower() == "strava":
-                        # strava activities not supported via the api for some reason
-                        continue
-                    activity = IntervalsActivity.from_dict(activity_data)
-                    result = self.add_activity(uid, activity)
-                    if result == "added":
-                        activities_added += 1
-                    elif result == "changed":
-                        activities_changed += 1
-            else:
-                pass
-                # self.helper.slog("Failed to get activities")
-                # self.helper.slog(response.status_code)
-
-            # get wellness
-            # self.helper.slog(f"Getting wellness from intervals {oldest_wellness} to {newest}")
-            response = self._request("wellness", "GET", uid=uid, data=params_wellness)
-            if response.status_code == 200:
-                wellness_data = response.json()
-                for wellness_entry in wellness_data:
-                    # self.helper.slog(f"Got wellness: {self.users.id2u(uid)} - {wellness_entry.get('id')}")
-                    wellness = IntervalsWellness.from_dict(wellness_entry)
-                    result = self.add_wellness(uid, wellness)
-                    if result == "added":
-                        wellnesses_added += 1
-                    elif result == "changed":
-                        wellnesses_changed += 1
-            else:
-                pass
-                # self.helper.slog("Failed to get wellness")
-                # self.helper.slog(response.status_code)
-
+            activities_added, activities_changed = await self._sync(uid, self.activity_store, "activities", force_all)
+            wellnesses_added, wellnesses_changed = await self._sync(uid, self.wellness_store, "wellness", force_all)
             self.valkey.set(f"{self.intervals_prefix}_{uid}_last_refresh", str(int(datetime.datetime.now().timestamp())))
-
+        except RetryableError:
+            # the engine retries these
+            raise
         except Exception as e:
             self.helper.slog(f"Error in _scrape_athlete: {str(e)}")
             raise e
@@ -540,6 +534,12 @@ Parameters:
             "wellnesses_changed": wellnesses_changed
         }
 
+    async def _refresh_athlete(self, uid: str, force_all: bool = False):
+        """refresh an athlete on the engine loop now, even when it is backing off"""
+        return await asyncio.wrap_future(
+            self.refresh_engine.submit(self.refresh_engine.refresh(uid, force_all=force_all, force=True))
+        )
+
     def verify_api_key(self, uid: str):
         """this uses the athlete endpoint to verify the api key"""
         try:
@@ -661,7 +661,7 @@ Parameters:
     )
     async def reset_wellness(self, message: Message):
         uid = message.user_id
-        self.valkey.delete(f"{self.intervals_prefix}_athlete_{uid}_wellness")
+        self.wellness_store.delete(uid)
         self.driver.reply_to(message, "Wellnesses reset")
     @bot_command(
         category="Activity & Wellness Management",
@@ -670,7 +670,7 @@ Parameters:
     )
     async def reset_activities(self, message: Message):
         uid = message.user_id
-        self.valkey.delete(f"{self.intervals_prefix}_athlete_{uid}_activities")
+        self.activity_store.delete(uid)
         self.driver.reply_to(message, "Activities reset")
     @bot_command(
         category="Activity & Wellness Management",
@@ -679,8 +679,8 @@ Parameters:
     )
     async def reset(self, message: Message):
         uid = message.user_id
-        self.valkey.delete(f"{self.intervals_prefix}_athlete_{uid}_activities")
-        self.valkey.delete(f"{self.intervals_prefix}_athlete_{uid}_wellness")
+        self.activity_store.delete(uid)
+        self.wellness_store.delete(uid)
         self.driver.reply_to(message, "Activities & Wellness reset")
 
     # Data Refresh Commands
@@ -692,13 +692,13 @@ Parameters:
     async def refresh_force(self, message: Message):
         uid = message.user_id
         try:
-            result = self._scrape_athlete(uid, force_all=True)
+            result = await self._refresh_athlete(uid, force_all=True)
         except Exception as e:
             self.driver.reply_to(message, f"Error: {str(e)}")
             return
         # count the number of activities and wellness
-        wellness_count_new = len(self.get_wellnesses(uid))
-        activities_count_new = len(self.get_activities(uid))
+        wellness_count_new = self.wellness_store.count(uid)
+        activities_count_new = self.activity_store.count(uid)
         if result:
             self.driver.reply_to(message, f"Refreshed activities newly total:{activities_count_new} new:{result.get('activities_added')} changed:{result.get('activities_changed')} & wellness total:{wellness_count_new} new:{result.get('wellnesses_added')} changed:{result.get('wellnesses_changed')}")
         else:
@@ -720,13 +720,13 @@ Parameters:
                 self.driver.reply_to(message, f"Refresh too recent wait {refresh_interval - (current_time - int(float(last_refresh)))} seconds")
                 return
         try:
-            result = self._scrape_athlete(uid)
+            result = await self._refresh_athlete(uid)
         except Exception as e:
             self.driver.reply_to(message, f"Error: {str(e)}")
             return
         # get counts of activities and wellness
-        wellness_count_new = len(self.get_wellnesses(uid))
-        activities_count_new = len(self.get_activities(uid))
+        wellness_count_new = self.wellness_store.count(uid)
+        activities_count_new = self.activity_store.count(uid)
         if result:
             self.driver.reply_to(message, f"Refreshed activities newly total:{activities_count_new} new:{result.get('activities_added')} changed:{result.get('activities_changed')} & wellness total:{wellness_count_new} new:{result.get('wellnesses_added')} changed:{result.get('wellnesses_changed')}")
         else:
@@ -841,7 +841,8 @@ Parameters:
             self.driver.reply_to(message, "No athletes found")
             return
         # convert to usernames
-        athletes = ["@" + self.users.id2unhl(uid) for uid in athletes]
+        usernames = self.users.ids_to_usernames(athletes)
+        athletes = ["@" + self.users.nohl(usernames.get(uid, uid)) for uid in athletes]
         athletes = "\n".join(athletes)
         self.driver.reply_to(message, athletes)
     @bot_command(
@@ -884,7 +885,8 @@ Parameters:
             self.driver.reply_to(message, "No participants found. ask them to use .intervals opt-in")
             return
         # convert to usernames
-        athletes = ["@" + self.users.id2unhl(uid) for uid in athletes]
+        usernames = self.users.ids_to_usernames(athletes)
+        athletes = ["@" + self.users.nohl(usernames.get(uid, uid)) for uid in athletes]
         athletes = "\n".join(athletes)
         self.driver.reply_to(message, athletes)
 
@@ -915,8 +917,10 @@ Parameters:
         admin=True
     )
     async def refresh_all(self, message: Message):
-        self.refresh_all_athletes(force=True)
-        self.driver.reply_to(message, "Refreshed all activities")
+        if self.refresh_all_athletes(force=True) is None:
+            self.driver.reply_to(message, "A refresh is already running")
+            return
+        self.driver.reply_to(message, "Refreshing all activities in the background")
 
     @bot_command(
         category="Admin",
@@ -925,8 +929,10 @@ Parameters:
         admin=True
     )
     async def refresh_all_force_all(self, message: Message):
-        self.refresh_all_athletes(force=True,force_all=True)
-        self.driver.reply_to(message, "Refreshed all activities")
+        if self.refresh_all_athletes(force=True, force_all=True) is None:
+            self.driver.reply_to(message, "A refresh is already running")
+            return
+        self.driver.reply_to(message, "Refreshing all activities in the background")
 
     # Help Commands
     @bot_command(
@@ -1148,36 +1154,43 @@ Parameters:
             self.clear_lock("refresh_all_athletes")
             return
 
-        try:
-            for athlete in self.athletes:
-                athlete_last_refresh = self.valkey.get(f"{self.intervals_prefix}_{athlete}_last_refresh")
-                if not athlete_last_refresh:
-                    athlete_last_refresh = str(current_time - 7*24*3600)  # 7 days ago
-
-                if not force and current_time - int(float(athlete_last_refresh)) < refresh_interval:
-                    self.helper.slog(f"Skipping {self.users.id2u(athlete)} - refreshed too recently")
-                    continue
+        athletes = []
+        for athlete in list(self.athletes):
+            athlete_last_refresh = self.valkey.get(f"{self.intervals_prefix}_{athlete}_last_refresh")
+            if not athlete_last_refresh:
+                athlete_last_refresh = str(current_time - 7*24*3600)  # 7 days ago
 
-                self.helper.slog(f"Refreshing data for {self.users.id2u(athlete)}")
-                try:
-                    result = self._scrape_athlete(athlete, force_all=force_all)
-                except Exception as e:
-                    self.helper.slog(f"Error in refresh_all_athletes: {str(e)}")
-                    self.clear_lock("refresh_all_athletes")
-                    continue
-                if result:
-                    self.helper.slog(f"Refreshed data for {self.users.id2u(athlete)} total activities:{len(self.get_activities(athlete))} new:{result.get('activities_added')} changed:{result.get('activities_changed')} & wellness total:{len(self.get_wellnesses(athlete))} new:{result.get('wellnesses_added')} changed:{result.get('wellnesses_changed')}")
-                else:
-                    self.helper.slog(f"Failed to refresh activities for {self.users.id2u(athlete)}")
+            if not force and current_time - int(float(athlete_last_refresh)) < refresh_interval:
+                self.helper.slog(f"Skipping {self.users.id2u(athlete)} - refreshed too recently")
+                continue
+            athletes.append(athlete)
 
+        # the athletes are refreshed on the engine loop, this only starts it
+        future = self.refresh_engine.refresh_all_in_background(athletes, force_all=force_all)
+        self.clear_lock("refresh_all_athletes")
+        if future is None:
+            self.helper.console("Refresh of all athletes is still running")
+            return None
+        future.add_done_callback(lambda done: self._refresh_all_athletes_done(done, current_time))
+        return future
+
+    def _refresh_all_athletes_done(self, future, started: int):
+        """log the results of a background refresh of all athletes"""
+        try:
+            results = future.result()
         except Exception as e:
             self.helper.slog(f"Failed to refresh all activities: {str(e)}")
-            self.clear_lock("refresh_all_athletes")
             return
-
-        self.valkey.set(f"{self.intervals_prefix}_last_refresh", str(current_time))
+        for athlete, result in results.items():
+            if isinstance(result, Exception):
+                self.helper.slog(f"Error refreshing {self.users.id2u(athlete)}: {str(result)}")
+            elif result is None:
+                self.helper.console(f"Skipped {self.users.id2u(athlete)} - backing off after failures")
+            else:
+                self.helper.slog(f"Refreshed data for {self.users.id2u(athlete)} total activities:{self.activity_store.count(athlete)} new:{result.get('activities_added')} changed:{result.get('activities_changed')} & wellness total:{self.wellness_store.count(athlete)} new:{result.get('wellnesses_added')} changed:{result.get('wellnesses_changed')}")
+        self.valkey.set(f"{self.intervals_prefix}_last_refresh", str(started))
         self.helper.slog("Refreshed all activities successfully")
-        self.clear_lock("refresh_all_athletes")
+
     @bot_command(
         category="Activity & Wellness Management",
         description="Display your recent wellness entries",
@@ -1197,7 +1210,7 @@ Parameters:
                 wellness_str += f"Wellness: {entry.id}\n"
                 data = []
                 # only print fields that are not None
-                for field in entry.__dict__:
+                for field in entry.to_dict():
                     value = getattr(entry, field)
                     if value is not None:
                         data.append([self.convert_snakecase_and_camelcase_to_ucfirst(field), self.get_metric_to_human_readable(field, value)])
@@ -1234,10 +1247,15 @@ Parameters:
             if not user in self.opted_in:
                 continue
             all_metrics[user] = {}
+            # one range read per table, split into the metrics afterwards
+            tables = {}
             for metric in metrics:
-                metrics_table = self.lookup_metric_table(metric)
+                tables.setdefault(self.lookup_metric_table(metric), []).append(metric)
+            for metrics_table, table_metrics in tables.items():
                 loop = asyncio.get_event_loop()
-                all_metrics[user][metric] = loop.run_until_complete(self.get_athlete_metrics(user, metrics_table, metric, date_from=start_date, date_to=end_date))
+                rows = loop.run_until_complete(self.get_athlete_metrics(user, metrics_table, table_metrics, date_from=start_date, date_to=end_date))
+                for metric in table_metrics:
+                    all_metrics[user][metric] = [{"date": row["date"], metric: row[metric]} for row in rows if metric in row]
         # for each metric get the top 5 and rank them based on the sum of the metric
         leaderboard = {}
         leaderboard_str = f"Leaderboards for the last 7 days {start_date} -> {end_date}\n"
@@ -1253,8 +1271,9 @@ Parameters:
         headers = ["Rank", "Athlete", "Sum"]
         rows = []
         rank = 1
+        usernames = self.users.ids_to_usernames(list(leaderboard["activities"]) + list(all_metrics))
         for user in leaderboard["activities"].keys():
-            rows.append([rank, self.users.id2unhl(user), leaderboard["activities"].get(user)])
+            rows.append([rank, self.users.nohl(usernames.get(user, user)), leaderboard["activities"].get(user)])
             rank += 1
         table = self.generate_markdown_table(headers, rows)
         leaderboard_str += table
@@ -1283,7 +1302,7 @@ Parameters:
             rows = []
             rank = 1
             for user in leaderboard[metric].keys():
-                rows.append([rank, self.users.id2unhl(user), self.get_metric_to_human_readable(metric,leaderboard[metric].get(user))])
+                rows.append([rank, self.users.nohl(usernames.get(user, user)), self.get_metric_to_human_readable(metric,leaderboard[metric].get(user))])
                 rank += 1
             table = self.generate_markdown_table(headers, rows)
             leaderboard_str += table
@@ -1356,7 +1375,8 @@ Parameters:
         # get the headers
         # TODO fix this. it is broken
         headers = ["Date"]
-        headers.extend([self.users.id2unhl(user) for user in all_metrics.keys()])
+        usernames = self.users.ids_to_usernames(all_metrics.keys())
+        headers.extend([self.users.nohl(usernames.get(user, user)) for user in all_metrics.keys()])
         # get the dates
         dates = []
         if metrics_table == "wellness":
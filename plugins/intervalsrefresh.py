@@ -0,0 +1,152 @@
+"""background refresh of intervals.icu athletes"""
+
+import asyncio
+import concurrent.futures
+import datetime
+import logging
+import random
+import threading
+import time
+
+from environs import Env
+
+env = Env()
+
+log = logging.getLogger(__name__)
+
+# athletes refreshed at the same time
+INTERVALS_REFRESH_CONCURRENCY = env.int("INTERVALS_REFRESH_CONCURRENCY", 4)
+# a request answered with 429 or 5xx is tried this many more times
+INTERVALS_REFRESH_RETRIES = env.int("INTERVALS_REFRESH_RETRIES", 3)
+# seconds, doubled for every retry and every failed refresh of an athlete
+INTERVALS_BACKOFF_BASE = env.float("INTERVALS_BACKOFF_BASE", 2.0)
+INTERVALS_BACKOFF_MAX = env.float("INTERVALS_BACKOFF_MAX", 15 * 60)
+# largest page of records read from the api
+INTERVALS_MAX_RESPONSE_SIZE = env.int("INTERVALS_MAX_RESPONSE_SIZE", 20 * 1024 * 1024)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# a full resync reads the history from this day on in pages of this many days
+INTERVALS_SYNC_START = env.date("INTERVALS_SYNC_START", datetime.date(2010, 1, 1))
+INTERVALS_SYNC_PAGE_DAYS = env.int("INTERVALS_SYNC_PAGE_DAYS", 90)
+# days before the newest record a refresh asks for again, recent records still change
+INTERVALS_SYNC_OVERLAP_DAYS = env.int("INTERVALS_SYNC_OVERLAP_DAYS", 3)
+
+
+class RetryableError(Exception):
+    """the api asked us to come back later"""
+
+    def __init__(self, status: int, retry_after: float | None = None):
+        super().__init__(f"intervals.icu answered {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def retry_after(headers) -> float | None:
+    """the seconds of a Retry-After header, None if there is none we understand"""
+    try:
+        return max(float(headers.get("Retry-After")), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int, base: float = INTERVALS_BACKOFF_BASE, maximum: float = INTERVALS_BACKOFF_MAX) -> float:
+    """exponential backoff with jitter so retries don't line up"""
+    return min(maximum, base * 2**attempt) * random.uniform(0.5, 1.0)
+
+
+class RefreshEngine:
+    """refreshes athletes on an event loop of its own
+
+    the scheduler thread, the startup and the chat commands only submit work,
+    the loop keeps one pooled http session for every refresh. at most
+    concurrency athletes are refreshed at once. requests answered with 429 or
+    5xx are retried with backoff, honouring Retry-After, and an athlete whose
+    refresh failed is skipped until its own backoff runs out.
+    """
+
+    def __init__(
+        self,
+        scrape,
+        concurrency: int = INTERVALS_REFRESH_CONCURRENCY,
+        retries: int = INTERVALS_REFRESH_RETRIES,
+        backoff_base: float = INTERVALS_BACKOFF_BASE,
+        backoff_max: float = INTERVALS_BACKOFF_MAX,
+        clock=time.monotonic,
+        sleep=asyncio.sleep,
+    ):
+        # coroutine function (uid, force_all) scraping one athlete
+        self.scrape = scrape
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.clock = clock
+        self.sleep = sleep
+        # uid -> (failed refreshes in a row, clock time of the next try)
+        self.failures = {}
+        self.loop = None
+        self._semaphore = None
+        self._refresh_all = None
+        self._lock = threading.RLock()
+
+    def start(self):
+        """start the loop thread, once"""
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="intervals-refresh", daemon=True).start()
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """run a coroutine on the refresh loop"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def refresh_all_in_background(self, uids: list, force_all: bool = False) -> concurrent.futures.Future | None:
+        """start refreshing athletes, None if the last refresh is still running"""
+        with self._lock:
+            if self._refresh_all is not None and not self._refresh_all.done():
+                return None
+            self._refresh_all = self.submit(self.refresh_all(uids, force_all=force_all))
+            return self._refresh_all
+
+    async def refresh_all(self, uids: list, force_all: bool = False, force: bool = False) -> dict:
+        """refresh athletes concurrently, returns the result or exception per athlete"""
+        uids = list(uids)
+        results = await asyncio.gather(
+            *(self.refresh(uid, force_all=force_all, force=force) for uid in uids), return_exceptions=True
+        )
+        return dict(zip(uids, results))
+
+    async def refresh(self, uid: str, force_all: bool = False, force: bool = False):
+        """refresh one athlete, None if it is backing off"""
+        failures, not_before = self.failures.get(uid, (0, 0.0))
+        if not force and self.clock() < not_before:
+            log.info("skipping %s, backing off after %d failures", uid, failures)
+            return None
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            try:
+                result = await self._scrape_with_retries(uid, force_all)
+            except Exception:
+                self.failures[uid] = (
+                    failures + 1,
+                    self.clock() + backoff(failures + 1, self.backoff_base, self.backoff_max),
+                )
+                raise
+        self.failures.pop(uid, None)
+        return result
+
+    async def _scrape_with_retries(self, uid: str, force_all: bool):
+        """scrape an athlete, retrying when the api asks us to"""
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.scrape(uid, force_all)
+            except RetryableError as error:
+                if attempt == self.retries:
+                    raise
+                delay = error.retry_after
+                if delay is None:
+                    delay = backoff(attempt, self.backoff_base, self.backoff_max)
+                log.info("%s for %s, retrying in %.1fs", error, uid, delay)
+                await self.sleep(min(delay, self.backoff_max))
+        return None
@@ -0,0 +1,183 @@
+"""activities and wellness of intervals.icu athletes stored in valkey"""
+
+import datetime
+import json
+import logging
+
+from dateutil import parser
+
+log = logging.getLogger(__name__)
+
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def epoch_day(date: str) -> int:
+    """days since 1970-01-01 of an iso date or datetime"""
+    return (datetime.date.fromisoformat(date[:10]) - EPOCH).days
+
+
+def date_pages(oldest: datetime.date, newest: datetime.date, days: int):
+    """the windows of at most days days from oldest to newest, both included"""
+    while oldest <= newest:
+        last = min(oldest + datetime.timedelta(days=days - 1), newest)
+        yield oldest, last
+        oldest = last + datetime.timedelta(days=1)
+
+
+class IntervalsStore:
+    """records of one kind for every athlete, keyed by id and indexed by date
+
+    an athlete has a hash of json records by id and a sorted set of the ids
+    scored by the day of the record, so an upsert touches one record and
+    nothing is ever duplicated. wellness entries are merged into the stored
+    entry, activities replace it. a cursor hash remembers how far the athlete
+    has been synced.
+    """
+
+    def __init__(
+        self, valkey, prefix: str, kind: str, model, date_field: str, sort_key,
+        merge: bool = False, change_field: str | None = None,
+    ):
+        self.valkey = valkey
+        self.prefix = prefix
+        self.kind = kind
+        self.model = model
+        # the field holding the date the record is indexed by
+        self.date_field = date_field
+        # the order of records within a day
+        self.sort_key = sort_key
+        self.merge = merge
+        # the field the api bumps whenever a record changes, None if there is none
+        self.change_field = change_field
+
+    def key(self, uid: str) -> str:
+        """the hash of records by id"""
+        return f"{self.prefix}_athlete_{uid}_{self.kind}_by_id"
+
+    def date_key(self, uid: str) -> str:
+        """the sorted set of ids by day"""
+        return f"{self.prefix}_athlete_{uid}_{self.kind}_by_date"
+
+    def legacy_key(self, uid: str) -> str:
+        """the list the records were kept in before"""
+        return f"{self.prefix}_athlete_{uid}_{self.kind}"
+
+    def cursor_key(self, uid: str) -> str:
+        """the hash of the sync cursor"""
+        return f"{self.prefix}_athlete_{uid}_{self.kind}_cursor"
+
+    def cursor(self, uid: str) -> dict:
+        """the sync cursor of an athlete, empty if it was never synced"""
+        return self.valkey.hgetall(self.cursor_key(uid)) or {}
+
+    def update_cursor(self, uid: str, **fields):
+        """set fields of the sync cursor, None removes a field"""
+        pipe = self.valkey.pipeline(transaction=True)
+        values = {name: str(value) for name, value in fields.items() if value is not None}
+        if values:
+            pipe.hset(self.cursor_key(uid), mapping=values)
+        for name in [name for name, value in fields.items() if value is None]:
+            pipe.hdel(self.cursor_key(uid), name)
+        pipe.execute()
+
+    def change_time(self, data: dict) -> float | None:
+        """the epoch seconds a record from the api last changed, None if unknown"""
+        stamp = data.get(self.change_field) if self.change_field else None
+        if not stamp:
+            return None
+        try:
+            changed = parser.isoparse(stamp)
+        except ValueError:
+            return None
+        if changed.tzinfo is None:
+            changed = changed.replace(tzinfo=datetime.timezone.utc)
+        return changed.timestamp()
+
+    def _decode(self, raw: str):
+        """a record from its json"""
+        return self.model.from_dict(json.loads(raw))
+
+    def _updated(self, stored: str | None, record):
+        """the record to store, merged with the stored one if we merge"""
+        if stored is not None and self.merge:
+            return self.model.from_dict({**json.loads(stored), **record.to_dict()})
+        return record
+
+    def upsert(self, uid: str, record) -> str:
+        """store a record, returns added, changed or alreadyexists"""
+        stored = self.valkey.hget(self.key(uid), record.id)
+        record = self._updated(stored, record)
+        raw = record.to_json()
+        if stored == raw:
+            return "alreadyexists"
+        pipe = self.valkey.pipeline(transaction=False)
+        pipe.hset(self.key(uid), record.id, raw)
+        pipe.zadd(self.date_key(uid), {record.id: epoch_day(getattr(record, self.date_field))})
+        pipe.execute()
+        return "added" if stored is None else "changed"
+
+    def remove(self, uid: str, record_id: str):
+        """remove a record"""
+        pipe = self.valkey.pipeline(transaction=False)
+        pipe.hdel(self.key(uid), record_id)
+        pipe.zrem(self.date_key(uid), record_id)
+        pipe.execute()
+
+    def _get_many(self, uid: str, ids: list) -> list:
+        """the records of ids in order of the sort key"""
+        if not ids:
+            return []
+        records = [self._decode(raw) for raw in self.valkey.hmget(self.key(uid), ids) if raw is not None]
+        # the set orders by day, the sort key orders within a day
+        return sorted(records, key=self.sort_key)
+
+    def get_all(self, uid: str) -> list:
+        """every record of an athlete, oldest first"""
+        return self._get_many(uid, self.valkey.zrange(self.date_key(uid), 0, -1))
+
+    def get_range(self, uid: str, oldest: datetime.date, newest: datetime.date) -> list:
+        """the records of the days from oldest to newest, both included, oldest first"""
+        ids = self.valkey.zrangebyscore(self.date_key(uid), (oldest - EPOCH).days, (newest - EPOCH).days)
+        return self._get_many(uid, ids)
+
+    def newest(self, uid: str):
+        """the record on the latest day, None if there are none"""
+        ids = self.valkey.zrange(self.date_key(uid), -1, -1, withscores=True)
+        if not ids:
+            return None
+        day = ids[0][1]
+        records = self._get_many(uid, self.valkey.zrangebyscore(self.date_key(uid), day, day))
+        return records[-1] if records else None
+
+    def count(self, uid: str) -> int:
+        """the number of records of an athlete"""
+        return self.valkey.zcard(self.date_key(uid))
+
+    def delete(self, uid: str):
+        """remove every record of an athlete"""
+        self.valkey.delete(self.key(uid), self.date_key(uid), self.legacy_key(uid), self.cursor_key(uid))
+
+    def migrate(self, uid: str) -> int:
+        """move the records of the old list into the hash, returns how many were moved
+
+        the list was pushed on the left so the newest copy of a record is first,
+        duplicates are merged or replaced in push order like upsert would.
+        """
+        if self.valkey.type(self.legacy_key(uid)) != "list":
+            return 0
+        records = {}
+        for raw in reversed(self.valkey.lrange(self.legacy_key(uid), 0, -1)):
+            record = self._decode(raw)
+            stored = records.get(record.id)
+            records[record.id] = self._updated(None if stored is None else stored.to_json(), record)
+        pipe = self.valkey.pipeline(transaction=True)
+        if records:
+            pipe.hset(self.key(uid), mapping={record_id: record.to_json() for record_id, record in records.items()})
+            pipe.zadd(
+                self.date_key(uid),
+                {record_id: epoch_day(getattr(record, self.date_field)) for record_id, record in records.items()},
+            )
+        pipe.delete(self.legacy_key(uid))
+        pipe.execute()
+        log.info("migrated %d %s of %s", len(records), self.kind, uid)
+        return len(records)
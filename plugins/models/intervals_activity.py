@@ -1,8 +1,10 @@
 import json
-from dataclasses import dataclass, fields
+from dataclasses import dataclass, field, fields
 from datetime import datetime
 from typing import Any, List, Optional
 
+from dateutil import parser
+
 
 @dataclass
 class IntervalsActivity:
@@ -172,6 +174,13 @@ class IntervalsActivity:
     icu_power_spike_threshold: Optional[float] = None
     activity_link: Optional[str] = None
     activity_link_markdown: Optional[str] = None
+    # parsed once when the activity is created, not stored
+    start_datetime_local: datetime = field(init=False, repr=False, compare=False)
+    start_datetime: datetime = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.start_datetime_local = parser.isoparse(self.start_date_local)
+        self.start_datetime = parser.isoparse(self.start_date)
 
     @classmethod
     def from_dict(cls, data: dict) -> 'IntervalsActivity':
@@ -185,7 +194,7 @@ class IntervalsActivity:
             IntervalsActivity: A new instance of IntervalsActivity
         """
         valid_fields = {k: v for k, v in data.items() 
-                       if k in cls.__dataclass_fields__ and not isinstance(v, dict)}
+                       if cls.has_field(k) and not isinstance(v, dict)}
         valid_fields['activity_link'] = f"https://intervals.icu/activities/{valid_fields['id']}"
         valid_fields['activity_link_markdown'] = f"[{valid_fields['name']}](https://intervals.icu/activities/{valid_fields['id']})"
         return cls(**valid_fields)
@@ -197,7 +206,7 @@ class IntervalsActivity:
         Returns:
             dict: Dictionary representation of the activity
         """
-        return {k: v for k, v in self.__dict__.items()}
+        return {f.name: getattr(self, f.name) for f in fields(self) if f.init}
 
     def to_json(self) -> str:
         """
@@ -210,4 +219,4 @@ class IntervalsActivity:
 
     @classmethod
     def has_field(cls, field_name: str) -> bool:
-        return any(field.name == field_name for field in fields(cls))
\ No newline at end of file
+        return any(f.name == field_name for f in fields(cls) if f.init)
\ No newline at end of file
@@ -1,6 +1,6 @@
 import json
-from dataclasses import dataclass, fields
-from datetime import datetime
+from dataclasses import dataclass, field, fields
+from datetime import date, datetime
 from typing import Any, Dict, List, Optional
 
 
@@ -56,6 +56,11 @@ class IntervalsWellness:
     steps: Optional[int] = None
     respiration: Optional[float] = None
     locked: Optional[bool] = None
+    # parsed once when the entry is created, not stored
+    day: date = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.day = date.fromisoformat(self.id[:10])
 
     @classmethod
     def from_dict(cls, data: dict) -> 'IntervalsWellness':
@@ -83,7 +88,7 @@ class IntervalsWellness:
             dict: Dictionary representation of the wellness entry
         """
         #data = {k: v for k, v in self.__dict__.items() if v is not None}
-        data = {k: v for k, v in self.__dict__.items()}
+        data = {f.name: getattr(self, f.name) for f in fields(self) if f.init}
         if self.sportInfo:
             data['sportInfo'] = [vars(sport) for sport in self.sportInfo]
         return data
@@ -93,4 +98,4 @@ class IntervalsWellness:
         return json.dumps(self.to_dict())
     @classmethod
     def has_field(cls,field_name: str) -> bool:
-        return any(field.name == field_name for field in fields(cls))
\ No newline at end of file
+        return any(f.name == field_name for f in fields(cls) if f.init)
\ No newline at end of file
@@ -4,7 +4,7 @@ from mmpy_bot.driver import Driver
 from mmpy_bot.plugins.base import PluginManager
 from mmpy_bot.settings import Settings
 from plugins.base import PluginLoader
-import time
+from plugins.streamrenderer import StreamRenderer, reply_with_files
 import json
 import aiohttp
 import aiohttp.client_exceptions as aiohttp_client_exceptions
@@ -303,8 +303,9 @@ class Ollama(PluginLoader):
             reply_msg_id = self.driver.reply_to(
                 message, f"{self.model} working...")["id"]
             # send async request to openai
-            last_update_time = time.time()
-            stream_update_delay_ms = float(100)
+            renderer = StreamRenderer(
+                self.driver, reply_msg_id, post_prefix, delay_ms=100, helper=self.helper
+            )
             try:
                 data = {
                     "model": self.model,
@@ -341,18 +342,7 @@ class Ollama(PluginLoader):
                                 # if the message has content, add it to the full message
                                 if "content" in chunk_message:
                                     full_message += chunk_message['content']
-                                    # await self.helper.debug((time.time() - last_update_time) * 1000)
-                                    if (
-                                        time.time() - last_update_time
-                                    ) * 1000 > stream_update_delay_ms:
-                                        # await self.helper.debug("updating message")
-                                        # update the message
-                                        self.driver.posts.patch_post(
-                                            reply_msg_id,
-                                            {"message": f"{post_prefix}{full_message}"},
-                                        )
-                                        # update last_update_time
-                                        last_update_time = time.time()
+                                    renderer.append(chunk_message['content'])
 
             except (aiohttp_client_exceptions.ClientConnectorError, aiohttp_client_exceptions.ClientOSError) as error:
                 self.driver.reply_to(message, f"Error: {error}")
@@ -361,10 +351,13 @@ class Ollama(PluginLoader):
                 )
                 self.driver.react_to(message, "x")
                 return
+            finally:
+                # make sure no frame lands after we are done
+                await renderer.stop()
             # update the message a final time to make sure we have the full message
-            self.driver.posts.patch_post(
-                reply_msg_id, {"message": f"{post_prefix}{full_message}"}
-            )
+            files = await renderer.finish()
+            if files:
+                reply_with_files(self.driver, self.helper, message, files)
             # add response to chatlog
             if cache_thread:
                 self.append_chatlog(
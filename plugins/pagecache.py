@@ -0,0 +1,106 @@
+"""valkey cache of downloaded and extracted web pages"""
+
+import hashlib
+import logging
+import time
+from urllib.parse import urldefrag
+
+from environs import Env
+
+env = Env()
+
+log = logging.getLogger(__name__)
+
+# pages are served from the cache without asking the server for this long
+PAGE_CACHE_TTL = env.int("PAGE_CACHE_TTL", 15 * 60)
+# pages with an etag or last-modified are kept this long for conditional requests
+PAGE_CACHE_STALE_TTL = env.int("PAGE_CACHE_STALE_TTL", 24 * 60 * 60)
+# failed downloads are remembered this long
+PAGE_CACHE_NEGATIVE_TTL = env.int("PAGE_CACHE_NEGATIVE_TTL", 2 * 60)
+# encoded (and compressed) pages larger than this are not cached
+PAGE_CACHE_MAX_SIZE = env.int("PAGE_CACHE_MAX_SIZE", 2 * 1024 * 1024)
+PAGE_CACHE_PREFIX = "pagecache:"
+
+
+class PageCache:
+    """cache of extracted pages keyed by url
+
+    a page is a dict with the content returned to the model, the text saved to
+    the temp file and the etag/last-modified validators the server sent. fresh
+    pages are returned as is, stale ones are revalidated with a conditional
+    request. failures are pages with error set and only live for negative_ttl.
+    cache errors are logged and treated as misses so downloads never depend on it.
+    """
+
+    def __init__(
+        self,
+        async_valkey,
+        serialize,
+        deserialize,
+        ttl: int = PAGE_CACHE_TTL,
+        stale_ttl: int = PAGE_CACHE_STALE_TTL,
+        negative_ttl: int = PAGE_CACHE_NEGATIVE_TTL,
+        max_size: int = PAGE_CACHE_MAX_SIZE,
+    ):
+        # callable returning the asyncio client, pools are bound to a loop
+        self.async_valkey = async_valkey
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+
+    @staticmethod
+    def key(url: str) -> str:
+        """valkey key of a url, the fragment is not sent to the server so it is dropped"""
+        return PAGE_CACHE_PREFIX + hashlib.sha256(urldefrag(url).url.encode()).hexdigest()
+
+    async def get(self, url: str) -> dict | None:
+        """get a cached page"""
+        try:
+            data = await self.async_valkey().get(self.key(url))
+            return None if data is None else self.deserialize(data)
+        # pylint: disable=broad-except
+        except Exception as error:
+            log.warning("page cache read failed for %s: %s", url, error)
+            return None
+
+    def is_fresh(self, page: dict) -> bool:
+        """check if a page can be used without asking the server"""
+        if page.get("error"):
+            # negative entries expire on their own
+            return True
+        return time.time() - page.get("fetched_at", 0) < self.ttl
+
+    @staticmethod
+    def conditional_headers(page: dict) -> dict:
+        """headers asking the server if the page changed"""
+        headers = {}
+        if page.get("etag"):
+            headers["If-None-Match"] = page["etag"]
+        if page.get("last_modified"):
+            headers["If-Modified-Since"] = page["last_modified"]
+        return headers
+
+    async def put(self, url: str, page: dict) -> bool:
+        """cache a page, returns False if it was too large"""
+        page["fetched_at"] = time.time()
+        if page.get("error"):
+            expiry = self.negative_ttl
+        elif page.get("etag") or page.get("last_modified"):
+            expiry = self.stale_ttl
+        else:
+            expiry = self.ttl
+        if expiry <= 0:
+            return False
+        try:
+            data = self.serialize(page)
+            if len(data) > self.max_size:
+                return False
+            await self.async_valkey().set(self.key(url), data, ex=expiry)
+        # pylint: disable=broad-except
+        except Exception as error:
+            log.warning("page cache write failed for %s: %s", url, error)
+            return False
+        return True
@@ -0,0 +1,124 @@
+"""codecs used to store messages in valkey
+
+every encoded entry starts with a small header so we know how to decode it:
+
+    MAGIC | FORMAT_VERSION | codec id (+ COMPRESSED flag) | payload
+
+MAGIC is a byte that can never start a json document, so entries written
+before the header existed (plain json from json.dumps or jsonpickle) are
+still decoded as json.
+"""
+
+import jsonpickle
+import msgpack
+import orjson
+import zstandard
+from environs import Env
+
+env = Env()
+
+MAGIC = 0xC1
+FORMAT_VERSION = 1
+COMPRESSED = 0x80
+# payloads bigger than this are zstd compressed (base64 images and the like)
+COMPRESS_THRESHOLD = env.int("VALKEY_COMPRESS_THRESHOLD", 4096)
+COMPRESS_LEVEL = env.int("VALKEY_COMPRESS_LEVEL", 3)
+
+
+def to_builtin(obj):
+    """turn objects the codecs don't know into plain types"""
+    return jsonpickle.Pickler(unpicklable=False).flatten(obj)
+
+
+class JsonCodec:
+    """json using orjson"""
+
+    ID = 1
+    NAME = "json"
+
+    @staticmethod
+    def encode(obj) -> bytes:
+        """encode an object"""
+        return orjson.dumps(obj, default=to_builtin, option=orjson.OPT_NON_STR_KEYS)
+
+    @staticmethod
+    def decode(data: bytes):
+        """decode an object"""
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    """msgpack"""
+
+    ID = 2
+    NAME = "msgpack"
+
+    @staticmethod
+    def encode(obj) -> bytes:
+        """encode an object"""
+        return msgpack.packb(obj, default=to_builtin, use_bin_type=True)
+
+    @staticmethod
+    def decode(data: bytes):
+        """decode an object"""
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+CODECS = {codec.NAME: codec for codec in (JsonCodec, MsgpackCodec)}
+CODECS_BY_ID = {codec.ID: codec for codec in CODECS.values()}
+
+
+class SerializationError(Exception):
+    """raised when an entry can't be decoded"""
+
+
+class Serializer:
+    """encode and decode version tagged entries"""
+
+    def __init__(
+        self,
+        codec: str = "msgpack",
+        compress_threshold: int = COMPRESS_THRESHOLD,
+        compress_level: int = COMPRESS_LEVEL,
+    ):
+        if codec not in CODECS:
+            raise ValueError(f"unknown codec {codec}, use one of {', '.join(CODECS)}")
+        self.codec = CODECS[codec]
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, obj) -> bytes:
+        """encode an object into a tagged entry"""
+        payload = self.codec.encode(obj)
+        flags = self.codec.ID
+        if self.compress_threshold and len(payload) > self.compress_threshold:
+            compressed = zstandard.compress(payload, self.compress_level)
+            # only keep the compressed version if it is actually smaller
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= COMPRESSED
+        return bytes((MAGIC, FORMAT_VERSION, flags)) + payload
+
+    @staticmethod
+    def decode(data):
+        """decode a tagged entry or a legacy json entry"""
+        if isinstance(data, str):
+            # legacy json read through a client that decodes responses
+            return orjson.loads(data)
+        if not data or data[0] != MAGIC:
+            return orjson.loads(data)
+        if data[1] != FORMAT_VERSION:
+            raise SerializationError(f"unsupported format version {data[1]}")
+        flags = data[2]
+        codec = CODECS_BY_ID.get(flags & ~COMPRESSED)
+        if codec is None:
+            raise SerializationError(f"unknown codec id {flags & ~COMPRESSED}")
+        payload = memoryview(data)[3:]
+        if flags & COMPRESSED:
+            payload = zstandard.decompress(payload)
+        return codec.decode(payload)
+
+    def decode_list(self, entries: list) -> list:
+        """decode a list of entries"""
+        decode = self.decode
+        return [decode(entry) for entry in entries]
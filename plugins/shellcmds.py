@@ -3,7 +3,6 @@ from mmpy_bot.wrappers import Message
 from plugins.base import PluginLoader
 import validators
 import re
-import dns.resolver
 import ipaddress
 import urllib.parse
 import subprocess
@@ -90,9 +89,13 @@ class ShellCmds(PluginLoader):
             return False
             # return { "error": f"invalid command. supported commands: {' '.join(list(SHELL_COMMANDS.keys()))}" }
 
-    def validateinput(self, input, types=["domain", "ip"], allowed_args=[]):
+    async def validateinput(self, input, types=["domain", "ip"], allowed_args=[]):
         """function that takes a string and validates that it matches against one or more of the types given in the list"""
-        self.helper.validate_input(input, types, allowed_args)
+        result = await self.helper.async_validate_input(input, types, allowed_args)
+        if result is True and "url" in types and validators.url(input):
+            # curl follows the redirects itself so walk the chain first
+            return await self.helper.validate_redirects(input)
+        return result
 
     @listen_to(r"^!(.*)")
     async def run_command(self, message: Message, command):
@@ -148,7 +151,7 @@ class ShellCmds(PluginLoader):
             if input != "":
                 inputs = input.split(" ")
                 for word in inputs:
-                    valid_input = self.validateinput(
+                    valid_input = await self.validateinput(
                         word, validators, allowed_args)
                     # check if dict
                     if type(valid_input) is dict:
@@ -0,0 +1,169 @@
+"""render streamed model output into a mattermost post"""
+
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# if the reply starts with one of these the prefix needs a newline to render
+MARKDOWN_STARTS = (">", "*", "_", "-", "+", "1", "~", "!", "`", "|", "#", "@", "•")
+# mattermost rejects posts longer than this
+MAX_MESSAGE_LENGTH = 14000
+# mattermost allows 5 files per post
+MAX_FILES_PER_POST = 5
+
+
+class StreamRenderer:
+    """patch a post with the latest streamed text from a background task
+
+    append() only updates the text and wakes the render task, so reading the
+    stream never waits on mattermost. while a patch is in flight or we are
+    waiting for the next frame, updates just replace the pending frame so
+    intermediate frames are dropped. the delay between frames follows the
+    observed patch latency so a slow mattermost gets fewer updates.
+    """
+
+    OVERFLOW_NOTICE = "\n\n# Warning Message too long, i'll attach a file with the full response when done receiving it."
+    OVERFLOW_FINAL = "\nMessage too long, see attached file"
+    # wait this many times the average patch latency between frames
+    LATENCY_FACTOR = 2.0
+    # weight of the newest latency sample in the moving average
+    LATENCY_WEIGHT = 0.3
+
+    def __init__(
+        self,
+        driver,
+        post_id: str,
+        prefix: str = "",
+        delay_ms: float = 200,
+        max_delay_ms: float = 5000,
+        max_length: int = MAX_MESSAGE_LENGTH,
+        helper=None,
+    ):
+        self.driver = driver
+        self.post_id = post_id
+        self.prefix = prefix
+        self.delay = delay_ms / 1000
+        self.max_delay = max(max_delay_ms / 1000, self.delay)
+        self.max_length = max_length
+        # used to save overflowing messages to a file
+        self.helper = helper
+        self.status = []
+        self.latency = None
+        self.frames = 0
+        self._parts = []
+        self._dirty = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._task = None
+
+    @property
+    def text(self) -> str:
+        """the text received so far"""
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def _wake(self):
+        """schedule a frame"""
+        if self._closing.is_set():
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._dirty.set()
+
+    def append(self, chunk: str):
+        """add streamed text"""
+        if chunk:
+            self._parts.append(chunk)
+            self._wake()
+
+    def clear(self):
+        """drop the text, used when a new response starts streaming"""
+        self._parts = []
+        self._wake()
+
+    def set_status(self, status: list):
+        """set the status lines shown above the text"""
+        self.status = list(status)
+        self._wake()
+
+    def render(self, text: str | None = None) -> str:
+        """build the post message"""
+        if text is None:
+            text = self.text
+        prefix = self.prefix
+        if text and not prefix.endswith("\n") and text[0] in MARKDOWN_STARTS:
+            prefix += "\n"
+        header = "```\n" + "\n".join(self.status) + "\n```\n" if self.status else ""
+        return f"{header}{prefix}{text}"
+
+    def next_delay(self) -> float:
+        """delay until the next frame based on the patch latency"""
+        if self.latency is None:
+            return self.delay
+        return min(self.max_delay, max(self.delay, self.latency * self.LATENCY_FACTOR))
+
+    async def patch(self, message: str):
+        """patch the post without blocking the event loop"""
+        started = time.monotonic()
+        try:
+            await asyncio.to_thread(
+                self.driver.posts.patch_post, self.post_id, {"message": message}
+            )
+        # pylint: disable=broad-except
+        except Exception as error:
+            log.warning("could not update post %s: %s", self.post_id, error)
+        latency = time.monotonic() - started
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.LATENCY_WEIGHT * (latency - self.latency)
+        self.frames += 1
+
+    async def _run(self):
+        """render the latest frame whenever there is one"""
+        while not self._closing.is_set():
+            await self._dirty.wait()
+            if self._closing.is_set():
+                break
+            self._dirty.clear()
+            message = self.render()
+            if len(message) > self.max_length:
+                cut = self.max_length - len(self.OVERFLOW_NOTICE)
+                message = message[:cut] + self.OVERFLOW_NOTICE
+            await self.patch(message)
+            try:
+                # wait for the next frame, finish() cuts the wait short
+                await asyncio.wait_for(self._closing.wait(), self.next_delay())
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        """stop rendering, waits for a patch in flight so it can't land later"""
+        self._closing.set()
+        self._dirty.set()
+        if self._task is not None:
+            await self._task
+
+    async def finish(self, text: str | None = None) -> list:
+        """render the final message, returns files holding an overflowing message"""
+        await self.stop()
+        message = self.render(text)
+        files = []
+        if len(message) > self.max_length:
+            if self.helper is not None:
+                # the file holds the reply alone, without the prefix and status
+                files.append(self.helper.save_content_to_tmp_file(text or self.text, "txt"))
+            cut = self.max_length - len(self.OVERFLOW_FINAL)
+            message = message[:cut] + self.OVERFLOW_FINAL
+        await self.patch(message)
+        return files
+
+
+def reply_with_files(driver, helper, message, files: list):
+    """attach files to the thread in batches and delete them afterwards"""
+    for i in range(0, len(files), MAX_FILES_PER_POST):
+        driver.reply_to(message, "Files:", file_paths=files[i : i + MAX_FILES_PER_POST])
+    for file in files:
+        helper.delete_downloaded_file(file)
@@ -0,0 +1,240 @@
+"""in-process cache of decoded thread message lists backed by valkey"""
+
+import hashlib
+import logging
+from collections import OrderedDict
+
+from environs import Env
+
+env = Env()
+
+log = logging.getLogger(__name__)
+
+THREAD_CACHE_MAX_THREADS = env.int("THREAD_CACHE_MAX_THREADS", 256)
+THREAD_CACHE_MAX_BYTES = env.int("THREAD_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+
+
+class ThreadCacheEntry:
+    """decoded messages of a single thread and the list length they reflect"""
+
+    __slots__ = ("messages", "digests", "length", "size")
+
+    def __init__(self):
+        self.messages = []
+        # sha1 of every encoded entry, taken once when it is read or appended
+        self.digests = []
+        # length of the valkey list the messages were read from, used as version
+        self.length = 0
+        # approximate memory use, the size of the encoded entries
+        self.size = 0
+
+
+class ThreadCache:
+    """lru cache of thread message lists
+
+    threads are append only valkey lists so the list length works as a version
+    counter. a lookup on a cached thread asks valkey for the length and only the
+    entries past what we already have, so a hot thread costs O(new messages).
+    if the list got shorter (expired, deleted or rewritten) it is reloaded.
+    anything that rewrites a thread in place must call invalidate().
+    the async_ methods do the same over an asyncio client.
+    """
+
+    def __init__(
+        self,
+        valkey,
+        serialize,
+        deserialize,
+        max_threads: int = THREAD_CACHE_MAX_THREADS,
+        max_bytes: int = THREAD_CACHE_MAX_BYTES,
+        async_valkey=None,
+    ):
+        self.valkey = valkey
+        # callable returning the asyncio client, pools are bound to a loop
+        self.async_valkey = async_valkey
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _copy(messages: list) -> list:
+        """copy the list and the message dicts so callers can't change the cache"""
+        return [dict(m) if isinstance(m, dict) else m for m in messages]
+
+    def _store(self, key: str, entry: ThreadCacheEntry):
+        """put an entry in the cache and evict the least recently used ones"""
+        self.invalidate(key)
+        self._entries[key] = entry
+        self.size += entry.size
+        self._evict()
+
+    def _extend(self, entry: ThreadCacheEntry, raw: list) -> int:
+        """add encoded entries to a thread entry, returns the bytes added"""
+        entry.messages.extend(self.deserialize(item) for item in raw)
+        entry.digests.extend(
+            hashlib.sha1(item if isinstance(item, bytes) else item.encode("utf-8")).hexdigest()
+            for item in raw
+        )
+        entry.length += len(raw)
+        added = sum(len(item) for item in raw)
+        entry.size += added
+        return added
+
+    def _evict(self):
+        """evict threads until we are within the bounds"""
+        while self._entries and (
+            len(self._entries) > self.max_threads or self.size > self.max_bytes
+        ):
+            key, entry = self._entries.popitem(last=False)
+            self.size -= entry.size
+            log.debug("thread cache evicted %s", key)
+
+    def _loaded(self, key: str, raw: list) -> list:
+        """cache a fully loaded thread"""
+        if not raw:
+            self.invalidate(key)
+            return []
+        entry = ThreadCacheEntry()
+        self._extend(entry, raw)
+        self._store(key, entry)
+        return self._copy(entry.messages)
+
+    def _refreshed(self, key: str, entry: ThreadCacheEntry, length: int, raw: list):
+        """apply the tail read for a cached thread, None if it must be reloaded"""
+        if self._entries.get(key) is not entry or length < entry.length + len(raw):
+            # the thread was trimmed or recreated or changed while we waited
+            return None
+        self.size += self._extend(entry, raw)
+        self._entries.move_to_end(key)
+        self._evict()
+        return self._copy(entry.messages)
+
+    def _appended(self, key: str, raw: list, length: int) -> int:
+        """update a cached thread after raw entries were pushed"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.length + len(raw) == length:
+                self.size += self._extend(entry, raw)
+                self._entries.move_to_end(key)
+                self._evict()
+            else:
+                # someone else wrote to the thread, the next get reloads it
+                self.invalidate(key)
+        return length
+
+    def get(self, key: str) -> list:
+        """get the messages of a thread, an empty list if it does not exist"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            pipe = self.valkey.pipeline(transaction=True)
+            pipe.llen(key)
+            pipe.lrange(key, entry.length, -1)
+            length, raw = pipe.execute()
+            messages = self._refreshed(key, entry, length, raw)
+            if messages is not None:
+                return messages
+        return self._loaded(key, self.valkey.lrange(key, 0, -1))
+
+    def append(self, key: str, *messages, expiry: int | None = None) -> int:
+        """append messages to a thread in valkey and the cache, returns the new length"""
+        raw = [self.serialize(message) for message in messages]
+        pipe = self.valkey.pipeline(transaction=True)
+        pipe.rpush(key, *raw)
+        if expiry:
+            pipe.expire(key, expiry)
+        length = pipe.execute()[0]
+        return self._appended(key, raw, length)
+
+    async def async_get(self, key: str) -> list:
+        """awaitable version of get"""
+        client = self.async_valkey()
+        entry = self._entries.get(key)
+        if entry is not None:
+            pipe = client.pipeline(transaction=True)
+            pipe.llen(key)
+            pipe.lrange(key, entry.length, -1)
+            length, raw = await pipe.execute()
+            messages = self._refreshed(key, entry, length, raw)
+            if messages is not None:
+                return messages
+        return self._loaded(key, await client.lrange(key, 0, -1))
+
+    async def async_append(self, key: str, *messages, expiry: int | None = None) -> int:
+        """awaitable version of append"""
+        raw = [self.serialize(message) for message in messages]
+        pipe = self.async_valkey().pipeline(transaction=True)
+        pipe.rpush(key, *raw)
+        if expiry:
+            pipe.expire(key, expiry)
+        length = (await pipe.execute())[0]
+        return self._appended(key, raw, length)
+
+    def batch(self, key: str, expiry: int | None = None) -> "ThreadBatch":
+        """collect appends to a thread and write them in one go"""
+        return ThreadBatch(self, key, expiry)
+
+    def digests(self, key: str, messages: list) -> dict:
+        """digests of the entries of a thread by the id of the message copies get returned
+
+        call it right after get, before anything else can change the thread.
+        messages that don't match the cached thread get no digest.
+        """
+        entry = self._entries.get(key)
+        if entry is None or len(entry.digests) != len(messages):
+            return {}
+        return {id(message): digest for message, digest in zip(messages, entry.digests)}
+
+    def invalidate(self, key: str):
+        """drop a thread from the cache"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ThreadBatch:
+    """appends for one chat turn written as a single MULTI with one EXPIRE
+
+    messages are buffered with append() and written by flush()/async_flush().
+    pending holds what has not been written yet so the turn can build its
+    request from the cached thread plus pending without reading it back.
+    """
+
+    def __init__(self, cache: ThreadCache, key: str, expiry: int | None = None):
+        self.cache = cache
+        self.key = key
+        self.expiry = expiry
+        self.pending = []
+        # length of the thread after the last flush, None until flushed
+        self.length = None
+
+    def append(self, *messages):
+        """buffer messages for the thread"""
+        self.pending.extend(messages)
+
+    def flush(self) -> int | None:
+        """write the buffered messages, returns the new length"""
+        if not self.pending:
+            return self.length
+        messages, self.pending = self.pending, []
+        self.length = self.cache.append(self.key, *messages, expiry=self.expiry)
+        return self.length
+
+    async def async_flush(self) -> int | None:
+        """awaitable version of flush"""
+        if not self.pending:
+            return self.length
+        messages, self.pending = self.pending, []
+        self.length = await self.cache.async_append(self.key, *messages, expiry=self.expiry)
+        return self.length
+
+    def __len__(self) -> int:
+        return len(self.pending)
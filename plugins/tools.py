@@ -18,6 +18,7 @@ class Tool:
         channel_message_only=False,
         returns_files=True,
         needs_self=False,
+        timeout=None,
     ):
         self.validate_tool(
             function, description, parameters, privilege_level, tool_type
@@ -40,6 +41,8 @@ class Tool:
         self.direct_message_only = direct_message_only
         self.channel_message_only = channel_message_only
         self.returns_files = returns_files
+        # seconds the tool may run, None uses the plugin default
+        self.timeout = timeout
 
     def as_dict(self):
         """Return the tool as a dictionary so it can be serialized"""
@@ -31,7 +31,7 @@ class TTS(PluginLoader):
                         f"https://www.dr.dk/tjenester/tts?text={urlencoded_text}"
                     )
                     # download the audio using the url
-                    filename = self.helper.download_file_to_tmp(
+                    filename = await self.helper.download_file_to_tmp(
                         audio_url, "mp3")
                     # format the link in mattermost markdown
                     msg_txt = f"link: [drtts]({audio_url})"
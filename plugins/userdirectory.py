@@ -0,0 +1,99 @@
+"""in-process directory of mattermost users and the admin and user sets"""
+
+import time
+from collections import OrderedDict
+
+from environs import Env
+
+env = Env()
+
+USER_DIRECTORY_SIZE = env.int("USER_DIRECTORY_SIZE", 1024)
+# users are renamed rarely, the valkey copy is kept for an hour
+USER_DIRECTORY_TTL = env.int("USER_DIRECTORY_TTL", 5 * 60)
+# the sets are invalidated when we change them, this covers other processes
+USER_SET_TTL = env.int("USER_SET_TTL", 60)
+
+
+class UserDirectory:
+    """lru of users by id, username to id lookups and the admin and user sets
+
+    every entry expires after its ttl so changes made elsewhere show up.
+    whoever changes a set in valkey must call invalidate_set().
+    """
+
+    def __init__(
+        self,
+        max_users: int = USER_DIRECTORY_SIZE,
+        ttl: int = USER_DIRECTORY_TTL,
+        set_ttl: int = USER_SET_TTL,
+        clock=time.monotonic,
+    ):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.set_ttl = set_ttl
+        self.clock = clock
+        # user id -> (expires, user dict)
+        self._users = OrderedDict()
+        # username -> (expires, user id)
+        self._ids = OrderedDict()
+        # set name -> (expires, frozenset of user ids)
+        self._sets = {}
+
+    def _get(self, entries: OrderedDict, key):
+        """an entry that has not expired"""
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= self.clock():
+            del entries[key]
+            return None
+        entries.move_to_end(key)
+        return value
+
+    def _put(self, entries: OrderedDict, key, value):
+        """store an entry and evict the least recently used ones"""
+        entries[key] = (self.clock() + self.ttl, value)
+        entries.move_to_end(key)
+        while len(entries) > self.max_users:
+            entries.popitem(last=False)
+
+    def get_user(self, user_id: str) -> dict | None:
+        """a cached user by id"""
+        return self._get(self._users, user_id)
+
+    def get_uid(self, username: str) -> str | None:
+        """a cached user id by username"""
+        return self._get(self._ids, username)
+
+    def put_user(self, user: dict):
+        """cache a user by id and username"""
+        self._put(self._users, user["id"], user)
+        self._put(self._ids, user["username"], user["id"])
+
+    def put_uid(self, username: str, user_id: str):
+        """cache the id of a username"""
+        self._put(self._ids, username, user_id)
+
+    def get_set(self, name: str) -> frozenset | None:
+        """a cached set of user ids"""
+        entry = self._sets.get(name)
+        if entry is None or entry[0] <= self.clock():
+            return None
+        return entry[1]
+
+    def put_set(self, name: str, members) -> frozenset:
+        """cache a set of user ids"""
+        members = frozenset(members)
+        self._sets[name] = (self.clock() + self.set_ttl, members)
+        return members
+
+    def invalidate_set(self, name: str):
+        """forget a set after it changed"""
+        self._sets.pop(name, None)
+
+    def clear(self):
+        """forget everything"""
+        self._users.clear()
+        self._ids.clear()
+        self._sets.clear()
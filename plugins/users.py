@@ -1,5 +1,6 @@
 """users plugin"""
 
+import asyncio
 import datetime
 
 from environs import Env
@@ -10,6 +11,7 @@ from mmpy_bot.settings import Settings
 from mmpy_bot.wrappers import Message
 
 from plugins.helper import Helper
+from plugins.userdirectory import UserDirectory
 
 env = Env()
 
@@ -38,6 +40,8 @@ class UserIsSystem(Exception):
 
 class Users(Plugin):
     """manage users"""
+    # users and the admin/user sets shared by every Users instance
+    directory = UserDirectory()
     # pylint: disable=super-init-not-called
     def __init__(self, driver: Driver = None, plugin_manager: PluginManager = None, settings: Settings = None):
         if (driver is not None) and (plugin_manager is not None) and (settings is not None):
@@ -83,6 +87,8 @@ class Users(Plugin):
                 self.valkey.sadd("users", uid)
             else:
                 self.helper.slog(f"User not found: {user}")
+        self.directory.invalidate_set("admins")
+        self.directory.invalidate_set("users")
         self.helper.slog(f"Plugin initialized {self.__class__.__name__}")
         # log admins
         self.helper.slog(f"Admins: {self.valkey.smembers('admins')}")
@@ -131,6 +137,8 @@ class Users(Plugin):
             # replace current ban username with uid in valkey
             self.valkey.delete(key)
             self.valkey.set(f"ban:{self.get_uid(user)}", expire)
+        self.directory.invalidate_set("admins")
+        self.directory.invalidate_set("users")
 
     def on_stop(self):
         """on stop"""
@@ -142,12 +150,36 @@ class Users(Plugin):
             return False
         if NEEDWHITELIST is False:
             return True
-        return True if self.u2id(username) in self.valkey.smembers("users") else False
+        return self.u2id(username) in self.members("users")
 
     def is_admin(self, username):
         """check if user is admin"""
         # convert username to uid
-        return True if self.u2id(username) in self.valkey.smembers("admins") else False
+        return self.u2id(username) in self.members("admins")
+
+    def members(self, name):
+        """the uids in the admins or users set"""
+        members = self.directory.get_set(name)
+        if members is None:
+            members = self.directory.put_set(name, self.valkey.smembers(name))
+        return members
+
+    async def async_members(self, name):
+        """awaitable version of members"""
+        members = self.directory.get_set(name)
+        if members is None:
+            members = self.directory.put_set(name, await self.helper.avalkey.smembers(name))
+        return members
+
+    def add_member(self, name, uid):
+        """add a uid to the admins or users set"""
+        self.valkey.sadd(name, uid)
+        self.directory.invalidate_set(name)
+
+    def remove_member(self, name, uid):
+        """remove a uid from the admins or users set"""
+        self.valkey.srem(name, uid)
+        self.directory.invalidate_set(name)
 
     def u2id(self, username):
         """convert username to uid"""
@@ -187,15 +219,22 @@ class Users(Plugin):
 
     def get_user_by_username(self, username):
         """get user from username"""
+        user = self.cached_user_by_username(username)
+        if user is not None:
+            return user
         # check if user is cached in valkey
-        if self.valkey.exists(f"user:{username}"):
-            return self.helper.valkey_deserialize_json(self.valkey.get(f"user:{username}"))
+        cached = self.valkey.get(f"user:{username}")
+        if cached is not None:
+            user = self.helper.valkey_deserialize_json(cached)
+            self.directory.put_user(user)
+            return user
         users = self.driver.users.get_users_by_usernames([username])
         if len(users) == 1:
             # cache the user in valkey for 1 hour
             self.valkey.set(
                 f"user:{username}", self.helper.valkey_serialize_json(users[0]), ex=60 * 60
             )
+            self.directory.put_user(users[0])
             return users[0]
         if len(users) > 1:
             # throw exception if more than one user is found
@@ -204,17 +243,29 @@ class Users(Plugin):
             )
         return None
 
+    def cached_user_by_username(self, username):
+        """get user from username if the directory has it"""
+        uid = self.directory.get_uid(username)
+        return None if uid is None else self.directory.get_user(uid)
+
     def get_user_by_user_id(self, user_id):
         """get user id from user_id"""
+        user = self.directory.get_user(user_id)
+        if user is not None:
+            return user
         # check if user is cached in valkey
-        if self.valkey.exists(f"user:{user_id}"):
-            return self.helper.valkey_deserialize_json(self.valkey.get(f"user:{user_id}"))
+        cached = self.valkey.get(f"user:{user_id}")
+        if cached is not None:
+            user = self.helper.valkey_deserialize_json(cached)
+            self.directory.put_user(user)
+            return user
         try:
             user = self.driver.users.get_user(user_id)
             # cache the user in valkey for 1 hour
             self.valkey.set(
                 f"user:{user_id}", self.helper.valkey_serialize_json(user), ex=60 * 60
             )
+            self.directory.put_user(user)
             return user
         # pylint: disable=broad-except
         except Exception:
@@ -224,9 +275,15 @@ class Users(Plugin):
         """get uid from username"""
         if username == "System":
             raise UserIsSystem(f"User is system and does not have an id")
-        # check if uid is cached in valkey
-        if not force and self.valkey.exists(f"uid:{username}"):
-            return self.valkey.get(f"uid:{username}")
+        if not force:
+            uid = self.directory.get_uid(username)
+            if uid is not None:
+                return uid
+            # check if uid is cached in valkey
+            uid = self.valkey.get(f"uid:{username}")
+            if uid is not None:
+                self.directory.put_uid(username, uid)
+                return uid
         try:
             uid = self.get_user_by_username(username)["id"]
         # pylint: disable=broad-except
@@ -240,6 +297,178 @@ class Users(Plugin):
             self.valkey.set(f"uid:{username}", uid, ex=10 * 60 * 60)
         return uid
 
+    def _split_cached(self, user_ids):
+        """users the directory has and the uids it is missing"""
+        users = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            user = self.directory.get_user(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                users[user_id] = user
+        return users, missing
+
+    def _add_cached(self, users, missing, cached):
+        """add the users found in valkey, returns the uids still missing"""
+        remaining = []
+        for user_id, data in zip(missing, cached):
+            if data is None:
+                remaining.append(user_id)
+                continue
+            user = self.helper.valkey_deserialize_json(data)
+            self.directory.put_user(user)
+            users[user_id] = user
+        return remaining
+
+    def _add_fetched(self, users, found):
+        """add the users fetched from mattermost"""
+        for user in found:
+            self.directory.put_user(user)
+            users[user["id"]] = user
+
+    def ids_to_usernames(self, user_ids):
+        """convert many uids to usernames with one valkey and one mattermost request at most
+
+        uids that are not found are left out
+        """
+        users, missing = self._split_cached(user_ids)
+        if missing:
+            cached = self.valkey.mget([f"user:{user_id}" for user_id in missing])
+            missing = self._add_cached(users, missing, cached)
+        if missing:
+            try:
+                found = self.driver.users.get_users_by_ids(missing)
+            # pylint: disable=broad-except
+            except Exception as e:
+                self.helper.slog(f"unable to get users by ids: {e}")
+                found = []
+            if found:
+                pipe = self.valkey.pipeline(transaction=False)
+                for user in found:
+                    # cache the user in valkey for 1 hour
+                    pipe.set(f"user:{user['id']}", self.helper.valkey_serialize_json(user), ex=60 * 60)
+                pipe.execute()
+            self._add_fetched(users, found)
+        return {user_id: users[user_id]["username"] for user_id in user_ids if user_id in users}
+
+    async def async_is_user(self, username):
+        """awaitable version of is_user"""
+        uid = await self.async_u2id(username)
+        avalkey = self.helper.avalkey
+        if await avalkey.exists(f"ban:{uid}"):
+            return False
+        if NEEDWHITELIST is False:
+            return True
+        return uid in await self.async_members("users")
+
+    async def async_is_admin(self, username):
+        """awaitable version of is_admin"""
+        uid = await self.async_u2id(username)
+        return uid in await self.async_members("admins")
+
+    async def async_u2id(self, username):
+        """awaitable version of u2id"""
+        return await self.async_get_uid(username)
+
+    async def async_id2u(self, user_id):
+        """awaitable version of id2u"""
+        return (await self.async_get_user_by_user_id(user_id))["username"]
+
+    async def async_get_user_by_username(self, username):
+        """awaitable version of get_user_by_username"""
+        user = self.cached_user_by_username(username)
+        if user is not None:
+            return user
+        cached = await self.helper.avalkey.get(f"user:{username}")
+        if cached is not None:
+            user = self.helper.valkey_deserialize_json(cached)
+            self.directory.put_user(user)
+            return user
+        users = await asyncio.to_thread(
+            self.driver.users.get_users_by_usernames, [username]
+        )
+        if len(users) == 1:
+            # cache the user in valkey for 1 hour
+            await self.helper.avalkey.set(
+                f"user:{username}", self.helper.valkey_serialize_json(users[0]), ex=60 * 60
+            )
+            self.directory.put_user(users[0])
+            return users[0]
+        if len(users) > 1:
+            # throw exception if more than one user is found
+            raise TooManyUsersFound(
+                f"More than one user found: {users} this is undefined behavior"
+            )
+        return None
+
+    async def async_get_user_by_user_id(self, user_id):
+        """awaitable version of get_user_by_user_id"""
+        user = self.directory.get_user(user_id)
+        if user is not None:
+            return user
+        cached = await self.helper.avalkey.get(f"user:{user_id}")
+        if cached is not None:
+            user = self.helper.valkey_deserialize_json(cached)
+            self.directory.put_user(user)
+            return user
+        try:
+            user = await asyncio.to_thread(self.driver.users.get_user, user_id)
+            # cache the user in valkey for 1 hour
+            await self.helper.avalkey.set(
+                f"user:{user_id}", self.helper.valkey_serialize_json(user), ex=60 * 60
+            )
+            self.directory.put_user(user)
+            return user
+        # pylint: disable=broad-except
+        except Exception:
+            return None
+
+    async def async_get_uid(self, username, force=False):
+        """awaitable version of get_uid"""
+        if username == "System":
+            raise UserIsSystem(f"User is system and does not have an id")
+        if not force:
+            uid = self.directory.get_uid(username)
+            if uid is not None:
+                return uid
+            uid = await self.helper.avalkey.get(f"uid:{username}")
+            if uid is not None:
+                self.directory.put_uid(username, uid)
+                return uid
+        try:
+            uid = (await self.async_get_user_by_username(username))["id"]
+        # pylint: disable=broad-except
+        except Exception as e:
+            # throw exception if user is not found
+            raise UserNotFound(f"User not found: {username}") from e
+        # cache the uid in valkey for 10 hours
+        if uid is not None:
+            await self.helper.avalkey.set(f"uid:{username}", uid, ex=10 * 60 * 60)
+        return uid
+
+    async def async_ids_to_usernames(self, user_ids):
+        """awaitable version of ids_to_usernames"""
+        users, missing = self._split_cached(user_ids)
+        if missing:
+            cached = await self.helper.avalkey.mget([f"user:{user_id}" for user_id in missing])
+            missing = self._add_cached(users, missing, cached)
+        if missing:
+            try:
+                found = await asyncio.to_thread(self.driver.users.get_users_by_ids, missing)
+            # pylint: disable=broad-except
+            except Exception as e:
+                self.helper.slog(f"unable to get users by ids: {e}")
+                found = []
+            if found:
+                pipe = self.helper.avalkey.pipeline(transaction=False)
+                for user in found:
+                    # cache the user in valkey for 1 hour
+                    pipe.set(f"user:{user['id']}", self.helper.valkey_serialize_json(user), ex=60 * 60)
+                await pipe.execute()
+            self._add_fetched(users, found)
+        return {user_id: users[user_id]["username"] for user_id in user_ids if user_id in users}
+
     @listen_to(r"\.uid ([a-zA-Z0-9_-]+)")
     async def uid(self, message: Message, username: str):
         """get user id from username"""
@@ -252,10 +481,12 @@ class Users(Plugin):
         if self.is_admin(message.sender_name):
             # list banned users
             bans = ""
-            for key in self.valkey.scan_iter("ban:*"):
+            keys = list(self.valkey.scan_iter("ban:*"))
+            usernames = self.ids_to_usernames([key.split(":")[1] for key in keys])
+            for key in keys:
                 # get time left for ban
                 uid = key.split(":")[1]
-                user = self.id2u(uid)
+                user = usernames.get(uid, uid)
                 time = self.valkey.get(key)
                 timeleft = self.valkey.ttl(key)
                 if timeleft > 0:
@@ -339,7 +570,7 @@ class Users(Plugin):
         if self.is_admin(message.sender_name):
             # convert username to uid
             uid = self.u2id(username)
-            self.valkey.srem("users", uid)
+            self.remove_member("users", uid)
             self.driver.reply_to(message, f"Removed user: {username} ({uid})")
             await self.helper.log(f"Removed user: {username} ({uid})")
 
@@ -351,7 +582,7 @@ class Users(Plugin):
             if self.get_user_by_username(username) is None:
                 self.driver.reply_to(message, f"User not found: {username}")
                 return
-            self.valkey.sadd("users", self.u2id(username))
+            self.add_member("users", self.u2id(username))
             self.driver.reply_to(
                 message, f"Added user: {username} ({self.u2id(username)})"
             )
@@ -362,8 +593,10 @@ class Users(Plugin):
         if self.is_admin(message.sender_name):
             # loop through all users and get their usernames
             users = ""
-            for user in self.valkey.smembers("users"):
-                users += f"{self.nohl(self.id2u(user))} ({user})\n"
+            members = self.valkey.smembers("users")
+            usernames = self.ids_to_usernames(members)
+            for user in members:
+                users += f"{self.nohl(usernames.get(user, user))} ({user})\n"
             self.driver.reply_to(message, f"Allowed users:\n{users}")
 
     @listen_to(r"^\.admins add (.*)")
@@ -376,14 +609,14 @@ class Users(Plugin):
                 return
             # convert username to uid
             uid = self.u2id(username)
-            self.valkey.sadd("admins", uid)
+            self.add_member("admins", uid)
             self.driver.reply_to(message, f"Added admin: {username}")
 
     @listen_to(r"^\.admins remove (.*)")
     async def admins_remove(self, message: Message, username: str):
         """remove admin"""
         if self.is_admin(message.sender_name):
-            self.valkey.srem("admins", self.u2id(username))
+            self.remove_member("admins", self.u2id(username))
             self.driver.reply_to(message, f"Removed admin: {username}")
 
     @listen_to(r"^\.admins list")
@@ -392,6 +625,8 @@ class Users(Plugin):
         if self.is_admin(message.sender_name):
             # get a list of all admins and convert their uids to usernames
             admins = ""
-            for admin in self.valkey.smembers("admins"):
-                admins += f"{self.id2u(admin)} ({admin})\n"
+            members = self.valkey.smembers("admins")
+            usernames = self.ids_to_usernames(members)
+            for admin in members:
+                admins += f"{usernames.get(admin, admin)} ({admin})\n"
             self.driver.reply_to(message, f"Allowed admins:\n{admins}")
@@ -14,7 +14,11 @@ class ValkeyTool(PluginLoader):
             if keytype == "string":
                 value = self.valkey.get(key)
             elif keytype == "list":
-                value = self.valkey.lrange(key, 0, -1)
+                # lists may hold binary entries written with valkey_serialize
+                value = [
+                    self.decode_entry(entry)
+                    for entry in self.helper.valkey_bytes.lrange(key, 0, -1)
+                ]
             elif keytype == "set":
                 value = self.valkey.smembers(key)
             elif keytype == "zset":
@@ -25,6 +29,14 @@ class ValkeyTool(PluginLoader):
                 value = "Unknown key type"
             self.driver.reply_to(message, f"Key: {key}\nValue: {value}")
 
+    def decode_entry(self, entry: bytes):
+        """decode a serialized entry, fall back to plain text"""
+        try:
+            return self.helper.valkey_deserialize(entry)
+        # pylint: disable=broad-except
+        except Exception:
+            return entry.decode("utf-8", errors="replace")
+
     @listen_to(r"^\.valkey set ([\s\S]*) ([\s\S]*)")
     async def valkey_set(self, message: Message, key: str, value: str):
         """set valkey key"""
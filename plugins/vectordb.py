@@ -1,4 +1,8 @@
+import asyncio
+import hashlib
 import json
+import logging
+import time
 
 import numpy as np
 import psycopg
@@ -8,16 +12,93 @@ from mmpy_bot.function import listen_to
 from mmpy_bot.plugins.base import PluginManager
 from mmpy_bot.settings import Settings
 from openai import AsyncOpenAI, OpenAI
-from pgvector.psycopg import register_vector
-from psycopg.sql import SQL, Identifier
+from pgvector.psycopg import register_vector_async
+from psycopg.sql import SQL, Identifier, Literal
 from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
 from plugins.base import PluginLoader
+from plugins.embeddingcache import EmbeddingCache, normalize_text
+from plugins.helper import Helper
 from enum import Enum
 env = Env()
 
+log = logging.getLogger(__name__)
+
 aclient = AsyncOpenAI(api_key=env.str("OPENAI_API_KEY"))
 client = OpenAI(api_key=env.str("OPENAI_API_KEY"))
 
+POSTGRES_POOL_MIN_SIZE = env.int("POSTGRES_POOL_MIN_SIZE", 1)
+POSTGRES_POOL_MAX_SIZE = env.int("POSTGRES_POOL_MAX_SIZE", 10)
+# texts per embeddings request, the api takes at most 2048
+EMBEDDING_BATCH_SIZE = env.int("EMBEDDING_BATCH_SIZE", 512)
+# hnsw build parameters, changing them needs a reindex
+VECTOR_HNSW_M = env.int("VECTOR_HNSW_M", 16)
+VECTOR_HNSW_EF_CONSTRUCTION = env.int("VECTOR_HNSW_EF_CONSTRUCTION", 64)
+# candidates looked at per search, higher is better recall and slower
+VECTOR_EF_SEARCH = env.int("VECTOR_EF_SEARCH", 100)
+# pgvector 0.8+ keeps scanning the index until the filters let enough rows
+# through: off, relaxed_order or strict_order. older servers search filtered
+# queries exactly instead
+VECTOR_ITERATIVE_SCAN = env.str("VECTOR_ITERATIVE_SCAN", "relaxed_order")
+
+
+# keeps two bots starting at once from migrating the same database
+SCHEMA_LOCK_ID = 0x76656374
+CREATE_USAGE_CONTEXT = """
+DO $$ BEGIN
+    CREATE TYPE usage_context AS ENUM ('any', 'direct', 'channel');
+EXCEPTION WHEN duplicate_object THEN NULL;
+END $$"""
+
+
+def connection_kwargs() -> dict:
+    """connection settings from the environment"""
+    return {
+        "dbname": env.str("POSTGRES_DB", "postgres"),
+        "user": env.str("POSTGRES_USER", "postgres"),
+        "password": env.str("POSTGRES_PASSWORD"),
+        "host": env.str("POSTGRES_HOST", "pg"),
+        "port": env.int("POSTGRES_PORT", 5432),
+        "autocommit": True,
+        "row_factory": dict_row,
+    }
+
+
+def index_statements(table: str) -> list:
+    """the indexes of a content table
+
+    searches filter on the owner and context of the memories and skip deleted
+    rows, so both indexes only cover rows that are not deleted.
+    """
+    return [
+        SQL(
+            "CREATE INDEX IF NOT EXISTS {} ON {} USING hnsw (embedding vector_cosine_ops) "
+            "WITH (m = {}, ef_construction = {}) WHERE is_deleted = FALSE"
+        ).format(
+            Identifier(f"{table}_embedding_hnsw_idx"),
+            Identifier(table),
+            Literal(VECTOR_HNSW_M),
+            Literal(VECTOR_HNSW_EF_CONSTRUCTION),
+        ),
+        SQL(
+            "CREATE INDEX IF NOT EXISTS {} ON {} "
+            "(created_by, usage_context, source_type, source) WHERE is_deleted = FALSE"
+        ).format(Identifier(f"{table}_owner_idx"), Identifier(table)),
+    ]
+
+
+def supports_iterative_scan(version: str | None) -> bool:
+    """whether a pgvector version has hnsw.iterative_scan, it came in 0.8"""
+    try:
+        return tuple(int(part) for part in version.split(".")[:2]) >= (0, 8)
+    except (AttributeError, ValueError):
+        return False
+
+
+def to_vector(embedding) -> np.ndarray:
+    """an embedding as float32 so it is sent as a binary vector"""
+    return np.asarray(embedding, dtype=np.float32)
+
 class UsageContext(Enum):
     ANY = "any"
     DIRECT = "direct"
@@ -44,41 +125,152 @@ class VectorDb(PluginLoader):
         "created_at",
         "is_deleted"
     ]
+    # embeddings shared by every VectorDb, valkey is attached on the first __init__
+    embedding_cache = EmbeddingCache()
+    # the instance other plugins use when the bot has none registered
+    _shared = None
+    # the schema version this process migrated to, it is checked once
+    schema_version = None
+    # whether the pooled connections scan the hnsw index iteratively, None until one connected
+    iterative_scan = None
+
     def __init__(self):
         super().__init__()
-        # connect
-        # TODO: change this to async. remember to create a new connection for each async call so move this to a jit connection function for each function that needs a connection
-        self.conn = psycopg.connect(
-            dbname=env.str("POSTGRES_DB","postgres"),
-            user=env.str("POSTGRES_USER","postgres"),
-            password=env.str("POSTGRES_PASSWORD"),
-            host=env.str("POSTGRES_HOST","pg"),
-            port=env.int("POSTGRES_PORT",5432),
-            autocommit=True,
-            row_factory=dict_row
-        )
-        # init pgvector
+        if self.embedding_cache.async_valkey is None:
+            valkey_helper = Helper(None)
+            self.embedding_cache.async_valkey = lambda: valkey_helper.avalkey_bytes
+        # queries run on a pool opened on first use, it is bound to the running loop
+        self._pool = None
+        self._pool_lock = asyncio.Lock()
+        self.conn = None
+        if VectorDb.schema_version is None:
+            # the schema is migrated on a connection of its own before the bot runs
+            with psycopg.connect(**connection_kwargs()) as conn:
+                self.conn = conn
+                VectorDb.schema_version = self.migrate()
+            self.conn = None
+
+    @classmethod
+    def shared(cls) -> "VectorDb":
+        """The VectorDb of the process, created on first use."""
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def migration_initial(self):
+        """Install pgvector and create the content table."""
         self.conn.execute('CREATE EXTENSION IF NOT EXISTS vector')
         self.conn.execute('ALTER EXTENSION vector SET SCHEMA public;')
-        register_vector(self.conn)
+        # replaced by rag_content
         self.drop_table("memories")
-        self.create_table(self.DEFAULT_TABLE)
+        self.create_table(self.DEFAULT_TABLE, indexes=False)
+
+    def migration_search_indexes(self):
+        """Create the search indexes of the content table."""
+        self.create_indexes(self.DEFAULT_TABLE)
+
+    # (version, migration), applied in order and never changed once released
+    MIGRATIONS = [
+        (1, migration_initial),
+        (2, migration_search_indexes),
+    ]
+
+    def migrate(self) -> int:
+        """Apply the migrations the database has not seen, returns the schema version."""
+        with self.conn.transaction():
+            self.conn.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+            self.conn.execute("""
+CREATE TABLE IF NOT EXISTS vectordb_schema (
+    version integer PRIMARY KEY,
+    description text,
+    applied_at timestamp DEFAULT CURRENT_TIMESTAMP
+)""")
+            version = self.conn.execute("SELECT coalesce(max(version), 0) AS version FROM vectordb_schema").fetchone()["version"]
+            for migration_version, migration in self.MIGRATIONS:
+                if migration_version <= version:
+                    continue
+                log.info("migrating vectordb schema to version %d", migration_version)
+                migration(self)
+                self.conn.execute(
+                    "INSERT INTO vectordb_schema (version, description) VALUES (%s, %s)",
+                    (migration_version, migration.__doc__),
+                )
+                version = migration_version
+        return version
 
     def initialize(self, driver: Driver, plugin_manager: PluginManager, settings: Settings):
         super().initialize(driver, plugin_manager, settings)
 
+    async def get_pool(self) -> AsyncConnectionPool:
+        """the connection pool, opened on first use"""
+        if self._pool is not None:
+            return self._pool
+        async with self._pool_lock:
+            if self._pool is None:
+                kwargs = connection_kwargs()
+                # prepare the fixed queries on the server the first time they run
+                kwargs["prepare_threshold"] = 0
+                pool = AsyncConnectionPool(
+                    min_size=POSTGRES_POOL_MIN_SIZE,
+                    max_size=POSTGRES_POOL_MAX_SIZE,
+                    kwargs=kwargs,
+                    configure=self.configure_connection,
+                    open=False,
+                )
+                await pool.open()
+                self._pool = pool
+        return self._pool
+
+    async def configure_connection(self, conn):
+        """Register the vector type and set the search parameters of a pooled connection."""
+        await register_vector_async(conn)
+        await conn.execute(
+            SQL("SET hnsw.ef_search = {}").format(Literal(VECTOR_EF_SEARCH)), prepare=False
+        )
+        cursor = await conn.execute(
+            "SELECT extversion FROM pg_extension WHERE extname = 'vector'", prepare=False
+        )
+        row = await cursor.fetchone()
+        version = row["extversion"] if row else None
+        iterative_scan = VECTOR_ITERATIVE_SCAN not in ("", "off") and supports_iterative_scan(version)
+        if iterative_scan:
+            await conn.execute(
+                SQL("SET hnsw.iterative_scan = {}").format(Literal(VECTOR_ITERATIVE_SCAN)),
+                prepare=False,
+            )
+        elif self.iterative_scan is None:
+            log.info("hnsw iterative scan is off, filtered searches are exact")
+        self.iterative_scan = iterative_scan
+
+    async def close(self):
+        """close the connection pool"""
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def fetch(self, query, params=None) -> list:
+        """run a query on a pooled connection and return the rows"""
+        pool = await self.get_pool()
+        async with pool.connection() as conn:
+            cursor = await conn.execute(query, params, prepare=True)
+            return await cursor.fetchall()
+
+    async def execute(self, query, params=None) -> int:
+        """run a statement on a pooled connection and return the affected row count"""
+        pool = await self.get_pool()
+        async with pool.connection() as conn:
+            cursor = await conn.execute(query, params, prepare=True)
+            return cursor.rowcount
+
     def drop_table(self, table_name: str):
         """Drop a table."""
         self.conn.execute(f"DROP TABLE IF EXISTS {table_name}")
 
-    def create_table(self, table_name: str, vector_dimensions: int | None = None):
+    def create_table(self, table_name: str, vector_dimensions: int | None = None, indexes: bool = True):
         """Create a table."""
         if vector_dimensions is None:
             vector_dimensions = self.VECTOR_DIMENSIONS
-        try:
-            self.conn.execute("CREATE TYPE usage_context AS ENUM ('any', 'direct', 'channel');")
-        except:
-            pass
+        self.conn.execute(CREATE_USAGE_CONTEXT)
         q = f"""
 CREATE TABLE IF NOT EXISTS {table_name} (
     id bigserial PRIMARY KEY,
@@ -95,26 +287,38 @@ CREATE TABLE IF NOT EXISTS {table_name} (
     is_deleted boolean DEFAULT FALSE
 );"""
         self.conn.execute(q)
+        if indexes:
+            self.create_indexes(table_name)
 
-    def tests(self):
-        """Run tests."""
-        # drop table if exists
-        self.drop_table(self.DEFAULT_TABLE)
-        # create table
-        self.create_table(self.DEFAULT_TABLE)
-        # store a memory
-        self.store("rag_content", ["test"], "hello world")
+    def create_indexes(self, table_name: str):
+        """Create the search indexes of a table."""
+        for statement in index_statements(table_name):
+            self.conn.execute(statement)
 
-    async def async_get_embeddings(self, input: str|list, model: str = None):
-        """Get embeddings for a text."""
+    async def embed_many(self, texts: list, model: str = None) -> list:
+        """Get the embeddings of texts, from the cache if we can."""
         if model is None:
             model = self.EMBEDDING_MODEL
+        texts = [normalize_text(text) for text in texts]
+        embeddings = await self.embedding_cache.get_many(model, texts)
+        # each distinct text that is not cached is embedded once
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        fetched = {}
+        for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+            embeddings_response = await aclient.embeddings.create(input=batch, model=model)
+            fetched.update(
+                await self.embedding_cache.put_many(
+                    model, {batch[data.index]: data.embedding for data in embeddings_response.data}
+                )
+            )
+        return [fetched[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
+
+    async def async_get_embeddings(self, input: str|list, model: str = None):
+        """Get embeddings for a text, from the cache if we can."""
         if isinstance(input, str):
             input = [input]
-        embeddings_response = await aclient.embeddings.create(input=input, model=self.EMBEDDING_MODEL)
-        embeddings = []
-        for data in embeddings_response.data:
-            embeddings.append(data.embedding)
+        embeddings = await self.embed_many(input, model)
         if len(embeddings) == 1:
             return embeddings[0]
         return embeddings
@@ -132,10 +336,62 @@ CREATE TABLE IF NOT EXISTS {table_name} (
         if len(embeddings) == 1:
             return embeddings[0]
         return embeddings
-    def store_multiple(self, table: str, contexts: list, tags: list, content: list):
-        """Store multiple memories."""
-        for item in content:
-            self.store(table, contexts, tags, item)
+    async def existing_contents(self, table: str, contents: list, created_by: str, usage_context: UsageContext, source_type: str, source: str) -> set:
+        """The contents that are already stored for an owner and context."""
+        rows = await self.fetch(SQL("SELECT content FROM {} WHERE created_by = %s AND usage_context = %s AND source_type = %s AND source = %s AND is_deleted = FALSE AND content = ANY(%s)").format(Identifier(table)), (created_by, usage_context.value.lower(), source_type, source, contents))
+        return {row["content"] for row in rows}
+
+    async def store_multiple(self, table: str, source_type: str, source: str, usage_context: UsageContext, category: str, tags: list, contents: list, metadata: dict, created_by: str, batch_size: int = EMBEDDING_BATCH_SIZE) -> dict:
+        """Store many contents, embedded and inserted a batch at a time.
+
+        contents repeated in the input or already stored for the owner and
+        context are skipped. the next batch is embedded while the current one
+        is inserted. returns the counts and the throughput.
+        """
+        started = time.monotonic()
+        report = {"received": len(contents), "duplicates": 0, "existing": 0, "stored": 0}
+        # dedupe on the text that is embedded, the first copy is kept
+        unique = {}
+        for content in contents:
+            unique.setdefault(hashlib.sha256(normalize_text(content).encode()).digest(), content)
+        contents = list(unique.values())
+        report["duplicates"] = report["received"] - len(contents)
+        batches = []
+        for start in range(0, len(contents), batch_size):
+            batch = contents[start:start + batch_size]
+            existing = await self.existing_contents(table, batch, created_by, usage_context, source_type, source)
+            report["existing"] += len(existing)
+            batch = [content for content in batch if content not in existing]
+            if batch:
+                batches.append(batch)
+        query = SQL("""
+            INSERT INTO {} (source_type, source, usage_context, category, tags, content, embedding, metadata, created_by)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """).format(Identifier(table))
+        tags = json.dumps(tags)
+        metadata = json.dumps(metadata)
+        pool = await self.get_pool()
+        embedding = asyncio.ensure_future(self.embed_many(batches[0])) if batches else None
+        try:
+            for i, batch in enumerate(batches):
+                embeddings = await embedding
+                embedding = asyncio.ensure_future(self.embed_many(batches[i + 1])) if i + 1 < len(batches) else None
+                rows = [
+                    (source_type, source, usage_context.value.lower(), category, tags, content, to_vector(vector), metadata, created_by)
+                    for content, vector in zip(batch, embeddings)
+                ]
+                async with pool.connection() as conn:
+                    async with conn.transaction():
+                        async with conn.cursor() as cursor:
+                            await cursor.executemany(query, rows)
+                report["stored"] += len(rows)
+        finally:
+            if embedding is not None:
+                embedding.cancel()
+        report["seconds"] = time.monotonic() - started
+        report["per_second"] = report["stored"] / report["seconds"] if report["seconds"] else 0.0
+        log.info("stored %(stored)d of %(received)d contents in %(seconds).1fs, %(per_second).1f/s", report)
+        return report
 
     """
 CREATE TABLE IF NOT EXISTS {table_name} (
@@ -153,59 +409,55 @@ CREATE TABLE IF NOT EXISTS {table_name} (
     is_deleted boolean DEFAULT FALSE
 );
 """
-    def user_has_memories(self, user: str, usage_context: UsageContext, source_type: str, source: str):
-        """Check if a user has memories."""
-        result = self.conn.execute(SQL("SELECT id FROM {} WHERE created_by = %s AND usage_context = %s AND source_type = %s AND source = %s AND is_deleted is FALSE").format(Identifier(self.DEFAULT_TABLE)), (user, usage_context.value.lower(), source_type, source))
-        if len(result.fetchall()) > 0:
-            return True
-        return False
-    def check_if_memory_exists(self, usage_context: UsageContext, content, user: str, source_type: str, source: str):
+    async def check_if_memory_exists(self, usage_context: UsageContext, content, user: str, source_type: str, source: str):
         """Check if a memory exists."""
-        result = self.conn.execute(SQL("SELECT id FROM {} WHERE content = %s AND created_by = %s AND usage_context = %s AND source_type = %s and source = %s AND is_deleted = FALSE").format(Identifier(self.DEFAULT_TABLE)), (content, user, usage_context.value.lower(), source_type, source))
-        if len(result.fetchall()) > 0:
+        result = await self.fetch(SQL("SELECT id FROM {} WHERE content = %s AND created_by = %s AND usage_context = %s AND source_type = %s and source = %s AND is_deleted = FALSE").format(Identifier(self.DEFAULT_TABLE)), (content, user, usage_context.value.lower(), source_type, source))
+        if len(result) > 0:
             return True
         return False
-    def store_memory(self, usage_context: UsageContext, content, user: str, source_type: str, source: str, tags: list | None):
+    async def store_memory(self, usage_context: UsageContext, content, user: str, source_type: str, source: str, tags: list | None):
         """Store a memory."""
         if tags is None:
             tags = []
-        if self.check_if_memory_exists(usage_context, content, user, source_type, source):
+        if await self.check_if_memory_exists(usage_context, content, user, source_type, source):
             return False
         memory_tags = ["memory", user] + tags
-        return self.store(self.DEFAULT_TABLE, source_type, source, usage_context, "memory", memory_tags, content, {}, user)
-    def get_memories(self, query: str, usage_context: UsageContext, user: str, source_type:str, source:str, limit: int = 5, not_ids: list | None = None):
+        return await self.store(self.DEFAULT_TABLE, source_type, source, usage_context, "memory", memory_tags, content, {}, user)
+    async def get_memories(self, query: str, usage_context: UsageContext, user: str, source_type:str, source:str, limit: int = 5, not_ids: list | None = None):
         """Get a memory."""
         if not_ids is None:
             not_ids = []
-        return self.search(self.DEFAULT_TABLE, query=query, usage_context=usage_context, category="memory", user=user, source_type=source_type, source=source, limit=limit, not_ids=not_ids)
-    def get_all_memories_for_user_for_context(self, user: str, usage_context: UsageContext, source_type: str, source: str):
+        return await self.search(self.DEFAULT_TABLE, query=query, usage_context=usage_context, category="memory", user=user, source_type=source_type, source=source, limit=limit, not_ids=not_ids)
+    async def get_new_memories(self, query: str, usage_context: UsageContext, user: str, source_type: str, source: str, loaded_ids: set, limit: int = 5) -> list:
+        """Get the memories that are not loaded yet.
+
+        a user without memories gets an empty result from the same query, so
+        it takes one round trip either way.
+        """
+        return await self.get_memories(query, usage_context, user, source_type, source, limit=limit, not_ids=sorted(loaded_ids))
+    async def get_all_memories_for_user_for_context(self, user: str, usage_context: UsageContext, source_type: str, source: str):
         """Get all memories for a user."""
-        return self.conn.execute(SQL("SELECT id, created_at, tags, content FROM {} WHERE created_by = %s AND usage_context = %s AND source_type = %s AND source = %s AND is_deleted = FALSE").format(Identifier(self.DEFAULT_TABLE)), (user,usage_context.value.lower(), source_type, source)).fetchall()
-    def user_delete_memory_by_id(self, memory_id: int, user: str, usage_context: UsageContext, source_type: str, source: str):
+        return await self.fetch(SQL("SELECT id, created_at, tags, content FROM {} WHERE created_by = %s AND usage_context = %s AND source_type = %s AND source = %s AND is_deleted = FALSE").format(Identifier(self.DEFAULT_TABLE)), (user,usage_context.value.lower(), source_type, source))
+    async def user_delete_memory_by_id(self, memory_id: int, user: str, usage_context: UsageContext, source_type: str, source: str):
         """Delete a memory."""
-        result = self.conn.execute(SQL("UPDATE {} SET is_deleted = TRUE WHERE id = %s AND created_by = %s AND usage_context = %s AND source_type = %s AND source = %s").format(Identifier(self.DEFAULT_TABLE)), (memory_id, user, usage_context.value.lower(), source_type, source))
-        return result
-    def user_delete_all_memories_in_context(self, user: str, usage_context: UsageContext, source_type: str, source: str):
+        return await self.execute(SQL("UPDATE {} SET is_deleted = TRUE WHERE id = %s AND created_by = %s AND usage_context = %s AND source_type = %s AND source = %s").format(Identifier(self.DEFAULT_TABLE)), (memory_id, user, usage_context.value.lower(), source_type, source))
+    async def user_delete_all_memories_in_context(self, user: str, usage_context: UsageContext, source_type: str, source: str):
         """Delete all memories for a user in a context."""
-        result = self.conn.execute(SQL("UPDATE {} SET is_deleted = TRUE WHERE created_by = %s AND usage_context = %s AND source_type = %s AND source = %s").format(Identifier(self.DEFAULT_TABLE)), (user, usage_context.value.lower(), source_type, source))
-        return result
-    def user_delete_all_memories(self, user: str):
+        return await self.execute(SQL("UPDATE {} SET is_deleted = TRUE WHERE created_by = %s AND usage_context = %s AND source_type = %s AND source = %s").format(Identifier(self.DEFAULT_TABLE)), (user, usage_context.value.lower(), source_type, source))
+    async def user_delete_all_memories(self, user: str):
         """Delete all memories for a user."""
-        result = self.conn.execute(SQL("UPDATE {} SET is_deleted = TRUE WHERE created_by = %s").format(Identifier(self.DEFAULT_TABLE)), (user,))
-        return result
-    def store_shared_memory(self, content, user: str, source_type: str, source: str, tags: list = [], metadata: dict = {}):
+        return await self.execute(SQL("UPDATE {} SET is_deleted = TRUE WHERE created_by = %s").format(Identifier(self.DEFAULT_TABLE)), (user,))
+    async def store_shared_memory(self, content, user: str, source_type: str, source: str, tags: list = [], metadata: dict = {}):
         """Store a shared memory."""
         shared_tags = ["shared", user] + tags
-        return self.store(self.DEFAULT_TABLE, source_type, source, UsageContext.ANY, "shared", shared_tags, content, metadata, user)
+        return await self.store(self.DEFAULT_TABLE, source_type, source, UsageContext.ANY, "shared", shared_tags, content, metadata, user)
 
-    def store(self, table: str, source_type: str, source: str, usage_context: UsageContext, category: str, tags: list, content: str, metadata: dict, created_by: str):
+    async def store(self, table: str, source_type: str, source: str, usage_context: UsageContext, category: str, tags: list, content: str, metadata: dict, created_by: str):
         """Store a memory."""
-        # create table if not exists
-        self.create_table(table)
         tags = json.dumps(tags)
         metadata = json.dumps(metadata)
-        embedding = self.get_embeddings(content)
-        result = self.conn.execute(SQL("""
+        embedding = to_vector(await self.async_get_embeddings(content))
+        result = await self.execute(SQL("""
             INSERT INTO {} (source_type, source, usage_context, category, tags, content, embedding, metadata, created_by)
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
         """).format(Identifier(table)), (source_type, source, usage_context.value.lower(), category, tags, content, embedding, metadata, created_by))
@@ -214,7 +466,14 @@ CREATE TABLE IF NOT EXISTS {table_name} (
             return True
 
     def _build_search_query(self, table: str, conditions: list, params: list) -> tuple[SQL, list]:
-        """Build a search query dynamically."""
+        """Build a search query dynamically.
+
+        The hnsw index is global, a plain scan looks at ef_search candidates
+        and filters them afterwards so a filtered search could miss rows. With
+        an iterative scan the index is read until enough rows pass the filters
+        and the relaxed order is sorted again. Without one the filtered rows
+        are found first, through the owner index, and sorted exactly.
+        """
         base_query = """SELECT id, tags, metadata, category, source, source_type, created_at, content, 
                        embedding <=> %s::vector as distance 
                        FROM {}
@@ -222,15 +481,19 @@ CREATE TABLE IF NOT EXISTS {table_name} (
         
         if conditions:
             base_query += " AND " + " AND ".join(conditions)
-            
-        base_query += " ORDER BY distance, created_at"
-        
-        if params and isinstance(params[-1], int):
-            base_query += " LIMIT %s"
-            
+
+        limit = " LIMIT %s" if params and isinstance(params[-1], int) else ""
+        if not conditions:
+            # order by the distance alone so the hnsw index can be used
+            base_query += " ORDER BY distance" + limit
+        elif self.iterative_scan:
+            base_query = f"WITH candidates AS MATERIALIZED ({base_query} ORDER BY distance{limit}) SELECT * FROM candidates ORDER BY distance"
+        else:
+            base_query = f"WITH candidates AS MATERIALIZED ({base_query}) SELECT * FROM candidates ORDER BY distance{limit}"
+
         return SQL(base_query).format(Identifier(table)), params
 
-    def search(self, table: str | None, query: str, user: str, usage_context: UsageContext, 
+    async def search(self, table: str | None, query: str, user: str, usage_context: UsageContext, 
               category: str, source_type: str, source: str, limit: int = 5, 
               max_similarity: float | None = None, not_ids: list | None = None):
         """Search for a memory."""
@@ -239,7 +502,7 @@ CREATE TABLE IF NOT EXISTS {table_name} (
         if max_similarity is None:
             max_similarity = self.DEFAULT_MAX_SIMILARITY
 
-        embedding = self.get_embeddings(query)
+        embedding = to_vector(await self.async_get_embeddings(query))
         conditions = [
             "(embedding <=> %s::vector) < %s",
             "usage_context = %s",
@@ -265,10 +528,9 @@ CREATE TABLE IF NOT EXISTS {table_name} (
         params.append(limit)  # For LIMIT clause
         
         sql_query, final_params = self._build_search_query(table, conditions, params)
-        result = self.conn.execute(sql_query, final_params)
-        return result.fetchall()
+        return await self.fetch(sql_query, final_params)
 
-    def search_shared(self, table: str | None, query: str, limit: int = 5, 
+    async def search_shared(self, table: str | None, query: str, limit: int = 5, 
                      max_similarity: float | None = None):
         """Search for a shared memory."""
         if table is None:
@@ -276,7 +538,7 @@ CREATE TABLE IF NOT EXISTS {table_name} (
         if max_similarity is None:
             max_similarity = self.DEFAULT_MAX_SIMILARITY
 
-        embedding = self.get_embeddings(query)
+        embedding = to_vector(await self.async_get_embeddings(query))
         conditions = [
             "(embedding <-> %s::vector) < %s",
             "usage_context = %s"
@@ -292,5 +554,4 @@ CREATE TABLE IF NOT EXISTS {table_name} (
         params.append(limit)  # For LIMIT clause
         
         sql_query, final_params = self._build_search_query(table, conditions, params)
-        result = self.conn.execute(sql_query, final_params)
-        return result.fetchall()
\ No newline at end of file
+        return await self.fetch(sql_query, final_params)
\ No newline at end of file
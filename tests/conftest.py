@@ -0,0 +1,250 @@
+""" Shared fakes for the tests """
+
+import pytest
+
+
+class SortedSet(dict):
+    """members of a sorted set and their scores"""
+
+
+class FakePipeline:
+    """queues commands and runs them in one round trip on execute"""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        """run the queued commands"""
+        self.client.round_trips += 1
+        self.client.pipelined = True
+        try:
+            return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        finally:
+            self.client.pipelined = False
+            self.commands = []
+
+
+class FakeValkey:
+    """just enough of a valkey client for strings, lists, hashes and sorted sets
+
+    every command is logged in calls as (name, args) and counted as a round
+    trip unless it ran inside a pipeline.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+        self.calls = []
+        self.round_trips = 0
+        self.pipelined = False
+
+    def _call(self, name, *args):
+        self.calls.append((name, args))
+        if not self.pipelined:
+            self.round_trips += 1
+
+    def called(self) -> list:
+        """the names of the commands run so far"""
+        return [name for name, _ in self.calls]
+
+    def called_with(self, name: str) -> list:
+        """the arguments of every call of a command"""
+        return [args for called, args in self.calls if called == name]
+
+    def pipeline(self, transaction=True):
+        """a pipeline, opening it is logged but costs no round trip"""
+        self.calls.append(("pipeline", (transaction,)))
+        return FakePipeline(self)
+
+    def type(self, key):
+        """the type of a key"""
+        self._call("type", key)
+        value = self.data.get(key)
+        if value is None:
+            return "none"
+        return {list: "list", dict: "hash", SortedSet: "zset"}.get(type(value), "string")
+
+    def exists(self, key):
+        """whether a key exists"""
+        self._call("exists", key)
+        return key in self.data
+
+    def delete(self, *keys):
+        """delete keys"""
+        self._call("delete", *keys)
+        for key in keys:
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+
+    def expire(self, key, seconds):
+        """remember the expiry of a key"""
+        self._call("expire", key, seconds)
+        if key not in self.data:
+            return False
+        self.expiry[key] = seconds
+        return True
+
+    def get(self, key):
+        """get a value"""
+        self._call("get", key)
+        return self.data.get(key)
+
+    def mget(self, keys):
+        """get many values"""
+        self._call("mget", list(keys))
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        """set a value"""
+        self._call("set", key, value)
+        self.data[key] = value
+        self.expiry[key] = ex
+        return True
+
+    def rpush(self, key, *values):
+        """append values"""
+        self._call("rpush", key, *values)
+        self.data.setdefault(key, []).extend(values)
+        return len(self.data[key])
+
+    def lpush(self, key, *values):
+        """push on the left"""
+        self._call("lpush", key, *values)
+        self.data.setdefault(key, [])[:0] = reversed(values)
+        return len(self.data[key])
+
+    def llen(self, key):
+        """list length"""
+        self._call("llen", key)
+        return len(self.data.get(key, []))
+
+    def lrange(self, key, start, end):
+        """list range"""
+        self._call("lrange", key, start, end)
+        values = self.data.get(key, [])
+        return list(values[start:] if end == -1 else values[start:end + 1])
+
+    def hget(self, key, field):
+        """get a field"""
+        self._call("hget", key, field)
+        return self.data.get(key, {}).get(field)
+
+    def hmget(self, key, fields):
+        """get fields"""
+        self._call("hmget", key, list(fields))
+        return [self.data.get(key, {}).get(field) for field in fields]
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        """set fields"""
+        self._call("hset", key, field, value, mapping)
+        fields = self.data.setdefault(key, {})
+        if field is not None:
+            fields[field] = value
+        fields.update(mapping or {})
+
+    def hgetall(self, key):
+        """every field"""
+        self._call("hgetall", key)
+        return dict(self.data.get(key, {}))
+
+    def hdel(self, key, field):
+        """delete a field"""
+        self._call("hdel", key, field)
+        self.data.get(key, {}).pop(field, None)
+
+    def _zset(self, key):
+        return self.data.setdefault(key, SortedSet())
+
+    def _sorted(self, key):
+        return sorted(self._zset(key).items(), key=lambda item: (item[1], item[0]))
+
+    def zadd(self, key, mapping):
+        """add scored members"""
+        self._call("zadd", key, mapping)
+        self._zset(key).update(mapping)
+
+    def zrem(self, key, member):
+        """remove a member"""
+        self._call("zrem", key, member)
+        self._zset(key).pop(member, None)
+
+    def zcard(self, key):
+        """the number of members"""
+        self._call("zcard", key)
+        return len(self._zset(key))
+
+    def zrange(self, key, start, end, withscores=False):
+        """members by rank"""
+        self._call("zrange", key, start, end)
+        items = self._sorted(key)
+        items = items[start:] if end == -1 else items[start:end + 1]
+        return [list(item) for item in items] if withscores else [member for member, _ in items]
+
+    def zrangebyscore(self, key, low, high):
+        """members by score"""
+        self._call("zrangebyscore", key, low, high)
+        return [member for member, score in self._sorted(key) if low <= score <= high]
+
+
+class FakeAsyncPipeline(FakePipeline):
+    """awaitable pipeline"""
+
+    async def execute(self):
+        """run the queued commands"""
+        return FakePipeline.execute(self)
+
+
+class FakeAsyncValkey:
+    """awaitable client sharing the data of a fake valkey"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def pipeline(self, transaction=True):
+        """an awaitable pipeline"""
+        self.client.pipeline(transaction)
+        return FakeAsyncPipeline(self.client)
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+
+        async def call(*args, **kwargs):
+            return command(*args, **kwargs)
+
+        return call
+
+
+class Clock:
+    """a clock that only moves when told"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(name="valkey")
+def fixture_valkey():
+    """an empty fake valkey"""
+    return FakeValkey()
+
+
+@pytest.fixture(name="avalkey")
+def fixture_avalkey(valkey):
+    """an awaitable client on the data of the valkey fixture"""
+    return FakeAsyncValkey(valkey)
+
+
+@pytest.fixture(name="clock")
+def fixture_clock():
+    """a stopped clock"""
+    return Clock()
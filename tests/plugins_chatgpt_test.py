@@ -0,0 +1,155 @@
+""" Tests for the chatgpt tool call runner """
+
+import asyncio
+import json
+import os
+import time
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+# pylint: disable=wrong-import-position
+from plugins import helper
+from plugins.chatgpt import VALKEY_PREPEND, ChatGPT
+from plugins.contextwindow import ContextWindow
+from plugins.tools import Tool, ToolsManager
+
+
+async def slow_download(url):
+    """stand in for a web download"""
+    await asyncio.sleep(0.2)
+    return f"content of {url}", None
+
+
+async def hang(url):
+    """a tool that never answers"""
+    await asyncio.sleep(10)
+    return url, None
+
+
+async def broken(url):
+    """a tool that raises"""
+    raise RuntimeError(f"cannot fetch {url}")
+
+
+@pytest.fixture(name="chatgpt")
+def fixture_chatgpt():
+    """a chatgpt plugin with just the tools"""
+    chatgpt = ChatGPT.__new__(ChatGPT)
+    chatgpt.helper = Mock()
+    chatgpt.helper.log = AsyncMock()
+    chatgpt.tools_manager = ToolsManager()
+    for function in (slow_download, broken):
+        chatgpt.tools_manager.add_tool(Tool(function, "a tool", ["url"]))
+    chatgpt.tools_manager.add_tool(Tool(hang, "a tool", ["url"], timeout=0.1))
+    return chatgpt
+
+
+def tool_call(name, url, index):
+    """a streamed tool call"""
+    return {
+        "function_name": name,
+        "tool_call_id": f"call_{index}",
+        "arguments": json.dumps({"url": url}),
+        "tool_call_message": {},
+    }
+
+
+@pytest.mark.asyncio
+async def test_tool_calls_run_concurrently(chatgpt):
+    """Test that three downloads take about as long as one"""
+    calls = {i: tool_call("slow_download", f"https://{i}.example", i) for i in range(3)}
+    status = []
+    start = time.monotonic()
+    results = await chatgpt.run_tool_calls(
+        None, calls, lambda index, msg: status.append((index, msg)), 4, 5
+    )
+    assert time.monotonic() - start < 0.5
+    # results are in tool call order
+    assert [result["tool_call_id"] for result, _ in results] == ["call_0", "call_1", "call_2"]
+    assert results[2][0]["content"] == "content of https://2.example"
+    assert [msg for index, msg in status if index == 1] == [
+        "Running tool: slow_download: url:https://1.example",
+        "Completed: slow_download",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit(chatgpt):
+    """Test that the concurrency setting limits how many tools run at once"""
+    calls = {i: tool_call("slow_download", f"https://{i}.example", i) for i in range(2)}
+    start = time.monotonic()
+    await chatgpt.run_tool_calls(None, calls, lambda index, msg: None, 1, 5)
+    assert time.monotonic() - start >= 0.4
+
+
+@pytest.mark.asyncio
+async def test_tool_timeout_and_errors(chatgpt):
+    """Test that slow and failing tools give an error result instead of failing the turn"""
+    calls = {
+        0: tool_call("hang", "https://slow.example", 0),
+        1: tool_call("broken", "https://broken.example", 1),
+        2: tool_call("missing", "https://missing.example", 2),
+    }
+    results = await chatgpt.run_tool_calls(None, calls, lambda index, msg: None, 4, 5)
+    assert results[0][0]["content"] == "Error: hang timed out after 0.1 seconds"
+    assert results[1][0]["content"] == "Error: cannot fetch https://broken.example"
+    assert results[2] is None
+
+
+@pytest.mark.asyncio
+async def test_thread_hydration_is_batched(chatgpt):
+    """Test that a cold thread is fetched in pages and written with one append"""
+    posts = [
+        {"id": f"p{i}", "user_id": "bot" if i % 2 else f"user{i % 4}", "message": f"post {i}", "create_at": 1000 + i}
+        for i in range(300)
+    ]
+
+    def get_post_thread(_thread_id, params):
+        start = 0
+        if "fromPost" in params:
+            start = next(i for i, post in enumerate(posts) if post["id"] == params["fromPost"]) + 1
+        page = posts[start:start + params["perPage"]]
+        # the root post is in every page
+        return {"posts": {post["id"]: post for post in [posts[0], *page]}, "has_next": start + len(page) < len(posts)}
+
+    driver = Mock()
+    driver.user_id = "bot"
+    driver.client.username = "bot"
+    driver.posts.get_post_thread = Mock(side_effect=get_post_thread)
+    chatgpt.driver = driver
+    chatgpt.helper = helper.Helper(driver)
+    chatgpt.names = []
+    chatgpt.users = Mock()
+    chatgpt.users.async_ids_to_usernames = AsyncMock(return_value={"user0": "alice", "user2": "bob"})
+    chatgpt.thread_cache = Mock()
+    chatgpt.thread_cache.async_append = AsyncMock()
+    messages = await chatgpt.get_thread_messages("p0", force_fetch=True)
+    assert driver.posts.get_post_thread.call_count == 2
+    chatgpt.users.async_ids_to_usernames.assert_awaited_once()
+    chatgpt.thread_cache.async_append.assert_awaited_once_with(VALKEY_PREPEND + "p0", *messages)
+    # the last post is the message being answered
+    assert len(messages) == 299
+    assert messages[0] == {"role": "user", "content": "@alice: post 0"}
+    assert messages[1] == {"role": "assistant", "content": "post 1"}
+    assert messages[298] == {"role": "user", "content": "@bob: post 298"}
+
+
+@pytest.mark.asyncio
+async def test_context_budget_leaves_room_for_output_and_tools(chatgpt):
+    """Test that the thread is fitted to the context window minus the output and the tools"""
+    chatgpt.context_window = ContextWindow(token_counter=lambda text, _model: len(text.split()))
+    chatgpt.helper.avalkey.hget = AsyncMock(return_value=None)
+    assert chatgpt.context_tokens("gpt-4o-mini") == 128000
+    assert chatgpt.context_tokens("gpt-4-32k-0613") == 32768
+    assert chatgpt.context_tokens("unknown") is None
+    chatgpt.ChatGPT_DEFAULTS = {**ChatGPT.ChatGPT_DEFAULTS, "context_output_reserve": 100}
+    messages = [{"role": "user", "content": "word " * 3000} for _ in range(4)]
+    # 8192 tokens of gpt-4 less the reserve fit two of the four messages
+    assert len(await chatgpt.return_last_x_messages(messages, "gpt-4")) == 2
+    # gpt-4o is no longer capped at a few thousand tokens
+    assert len(await chatgpt.return_last_x_messages(messages, "gpt-4o")) == 4
+    tools = [{"type": "function", "function": {"description": "word " * 3000}}]
+    assert len(await chatgpt.return_last_x_messages(messages, "gpt-4", tools=tools)) == 1
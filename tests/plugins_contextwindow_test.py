@@ -0,0 +1,119 @@
+""" Tests for the context window """
+
+import pytest
+
+from plugins.contextwindow import ContextWindow
+
+
+def word_counter(text, _model):
+    """count one token per word"""
+    return len(text.split())
+
+
+@pytest.fixture
+def window():
+    """context window fixture with a predictable counter"""
+    return ContextWindow(cache_size=16, token_counter=word_counter)
+
+
+def user(text):
+    """user message"""
+    return {"role": "user", "content": text}
+
+
+def assistant(text):
+    """assistant message"""
+    return {"role": "assistant", "content": text}
+
+
+# pylint: disable=redefined-outer-name
+def test_fit_keeps_everything_within_budget(window):
+    """Test that nothing is trimmed when the thread fits"""
+    messages = [{"role": "system", "content": "be nice"}, user("hi"), assistant("hello")]
+    assert window.fit(messages, "gpt-4o", 1000) == messages
+
+
+def test_fit_drops_oldest_turns(window):
+    """Test that the oldest history is dropped first"""
+    system = {"role": "system", "content": "be nice"}
+    messages = [system]
+    for i in range(10):
+        messages.append(user(f"question {i} " + "word " * 10))
+        messages.append(assistant(f"answer {i} " + "word " * 10))
+    messages.append(user("latest"))
+    result = window.fit(messages, "gpt-4o", 60)
+    assert result[0] == system
+    assert result[-1] == user("latest")
+    assert len(result) < len(messages)
+    # what is kept is a contiguous tail of the history
+    assert messages[-(len(result) - 1):] == result[1:]
+
+
+def test_fit_always_keeps_system_and_latest_user(window):
+    """Test that the pinned messages survive a tiny budget"""
+    system = {"role": "system", "content": "be nice " * 50}
+    messages = [system, user("old " * 50), assistant("old " * 50), user("latest " * 50)]
+    result = window.fit(messages, "gpt-4o", 10)
+    assert result == [system, messages[-1]]
+
+
+def test_fit_never_splits_tool_calls(window):
+    """Test that tool calls and their results are kept or dropped together"""
+    tool_call = {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [
+            {"id": "call_1", "type": "function", "function": {"name": "web_search", "arguments": "{}"}}
+        ],
+    }
+    tool_result = {"role": "tool", "tool_call_id": "call_1", "name": "web_search", "content": "x " * 40}
+    messages = [user("first"), tool_call, tool_result, assistant("done"), user("latest")]
+    counts, _, _ = window.count_messages(messages, "gpt-4o")
+    # room for the latest turn and the final answer but not the tool result
+    budget = window.REPLY_PRIMING_TOKENS + counts[4] + counts[3] + counts[1]
+    result = window.fit(messages, "gpt-4o", budget, counts)
+    assert tool_call not in result
+    assert tool_result not in result
+    assert result == [assistant("done"), user("latest")]
+
+
+def test_count_messages_uses_known_counts(window):
+    """Test that externally cached counts are used and new ones reported"""
+    messages = [user("one two three"), assistant("four five")]
+    keys = [window.message_key(m, "gpt-4o") for m in messages]
+    counts, _, new_counts = window.count_messages(messages, "gpt-4o", {keys[0]: "42"})
+    assert counts[0] == 42
+    assert list(new_counts) == [keys[1]]
+    # second call is served from the in-process cache
+    _, _, new_counts = window.count_messages(messages, "gpt-4o")
+    assert not new_counts
+
+
+def test_images_are_counted_at_a_fixed_cost(window):
+    """Test that image payloads are not counted as text"""
+    message = {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "what is this"},
+            {"type": "image_url", "image_url": {"url": "data:image/png;base64," + "A" * 10000}},
+        ],
+    }
+    # the role counts as one word, the text as three
+    expected = window.TOKENS_PER_MESSAGE + 1 + 3 + window.IMAGE_TOKENS
+    assert window.count_message(message, "gpt-4o") == expected
+
+
+def test_message_key_uses_stored_digest(window):
+    """Test that a stored digest is used instead of hashing the message"""
+    message = user("one two three")
+    assert window.message_key(message, "gpt-4o", "abc") == f"{window.encoding_name('gpt-4o')}:abc"
+    assert window.message_key(message, "gpt-4o") != window.message_key(message, "gpt-4o", "abc")
+
+
+def test_count_tools(window):
+    """Test that tool definitions are counted once and no tools cost nothing"""
+    tools = [{"type": "function", "function": {"name": "web_search", "description": "search the web"}}]
+    assert window.count_tools(None, "gpt-4o") == 0
+    count = window.count_tools(tools, "gpt-4o")
+    assert count > 0
+    assert window.cached_count(window.message_key({"tools": tools}, "gpt-4o")) == count
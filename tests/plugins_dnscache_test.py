@@ -0,0 +1,200 @@
+""" Tests for the dns cache """
+
+import asyncio
+import socket
+from types import SimpleNamespace
+
+import dns.exception
+import dns.resolver
+import pytest
+
+from plugins import helper
+from plugins.dnscache import BlockedAddressError, DnsCache, GuardedResolver, address_error, url_error
+
+
+class FakeAnswer(list):
+    """a resolver answer, a list of rdata with a ttl"""
+
+    def __init__(self, rdata, ttl):
+        super().__init__(rdata)
+        self.rrset = SimpleNamespace(ttl=ttl)
+
+
+class FakeResolver:
+    """an async resolver answering from a dict of (name, rdtype) -> answer or exception"""
+
+    def __init__(self, records, delay=0.05):
+        self.records = records
+        self.delay = delay
+        self.queries = []
+
+    async def resolve(self, name, rdtype):
+        """answer a query after a delay"""
+        self.queries.append((name, rdtype))
+        await asyncio.sleep(self.delay)
+        result = self.records.get((name, rdtype), dns.resolver.NoAnswer())
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def a(*addresses, ttl=300):
+    """A or AAAA records"""
+    return FakeAnswer([SimpleNamespace(address=address) for address in addresses], ttl)
+
+
+def cname(target, ttl=300):
+    """a CNAME record"""
+    return FakeAnswer([SimpleNamespace(target=target + ".")], ttl)
+
+
+@pytest.mark.asyncio
+async def test_record_types_are_queried_concurrently(clock):
+    """Test that the three queries take as long as one"""
+    resolver = FakeResolver(
+        {("example.com", "A"): a("93.184.215.14"), ("example.com", "AAAA"): a("2606:2800:21f:cb07::1")}
+    )
+    cache = DnsCache(resolver, clock=clock)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    answer = await cache.lookup("Example.com.")
+    assert loop.time() - start < resolver.delay * 2
+    assert answer.addresses == ["2606:2800:21f:cb07::1", "93.184.215.14"]
+    assert answer.error is None and answer.address_error is None
+    assert sorted(rdtype for _, rdtype in resolver.queries) == ["A", "AAAA", "CNAME"]
+
+
+@pytest.mark.asyncio
+async def test_answers_live_for_the_clamped_ttl(clock):
+    """Test that answers are cached for the lowest ttl within min/max ttl"""
+    resolver = FakeResolver({("example.com", "A"): a("93.184.215.14", ttl=5)})
+    cache = DnsCache(resolver, min_ttl=30, max_ttl=3600, clock=clock)
+    first = await cache.lookup("example.com")
+    assert first.expires == clock.now + 30
+    assert await cache.lookup("example.com") is first
+    assert len(resolver.queries) == 3
+    clock.now += 30
+    assert await cache.lookup("example.com") is not first
+    assert len(resolver.queries) == 6
+
+
+@pytest.mark.asyncio
+async def test_missing_names_are_cached(clock):
+    """Test that NXDOMAIN and empty answers are cached for the negative ttl"""
+    resolver = FakeResolver({("nope.example", rdtype): dns.resolver.NXDOMAIN() for rdtype in ("A", "AAAA", "CNAME")})
+    cache = DnsCache(resolver, negative_ttl=60, clock=clock)
+    answer = await cache.lookup("nope.example")
+    assert answer.error.startswith("error resolving domain:")
+    assert answer.expires == clock.now + 60
+    empty = await cache.lookup("empty.example")
+    assert empty.error == "no dns records found for empty.example"
+    await cache.lookup("nope.example")
+    await cache.lookup("empty.example")
+    assert len(resolver.queries) == 6
+
+
+@pytest.mark.asyncio
+async def test_timeouts_are_not_cached(clock):
+    """Test that a timeout is reported but asked again on the next lookup"""
+    resolver = FakeResolver({("slow.example", "A"): dns.exception.Timeout()})
+    cache = DnsCache(resolver, clock=clock)
+    answer = await cache.lookup("slow.example")
+    assert answer.error.startswith("error resolving domain:")
+    await cache.lookup("slow.example")
+    assert len(resolver.queries) == 6
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_share_a_query(clock):
+    """Test that lookups of the same name while one is running wait for it"""
+    resolver = FakeResolver({("example.com", "A"): a("93.184.215.14")})
+    cache = DnsCache(resolver, clock=clock)
+    answers = await asyncio.gather(*(cache.lookup("example.com") for _ in range(10)))
+    assert all(answer is answers[0] for answer in answers)
+    assert len(resolver.queries) == 3
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_are_evicted(clock):
+    """Test that the cache keeps at most max_entries names"""
+    resolver = FakeResolver({(f"{i}.example", "A"): a("93.184.215.14") for i in range(3)}, delay=0)
+    cache = DnsCache(resolver, max_entries=2, clock=clock)
+    await cache.lookup("0.example")
+    await cache.lookup("1.example")
+    await cache.lookup("0.example")
+    await cache.lookup("2.example")
+    assert cache.get("0.example") is not None
+    assert cache.get("1.example") is None
+
+
+@pytest.mark.parametrize(
+    "address, expected",
+    [
+        ("93.184.215.14", None),
+        ("10.0.0.1", "private ip (resolved from dns)"),
+        ("127.0.0.1", "private ip (resolved from dns)"),
+        ("::ffff:10.0.0.1", "private ip (resolved from dns)"),
+        ("2606:2800:21f:cb07::1", None),
+    ],
+)
+def test_address_error(address, expected):
+    """Test the verdict on resolved addresses"""
+    assert address_error(address) == expected
+
+
+@pytest.mark.asyncio
+async def test_validate_input_uses_the_cache(clock, monkeypatch):
+    """Test that validate_input follows cnames and refuses private addresses"""
+    resolver = FakeResolver(
+        {
+            ("www.example.com", "CNAME"): cname("internal.example.com"),
+            ("internal.example.com", "A"): a("10.0.0.1"),
+            ("example.com", "A"): a("93.184.215.14"),
+        },
+        delay=0,
+    )
+    monkeypatch.setattr(helper.Helper, "dns_cache", DnsCache(resolver, clock=clock))
+    instance = helper.Helper(None)
+    assert await instance.async_validate_input("example.com", ["domain"]) is True
+    assert await instance.async_validate_input("www.example.com", ["domain"]) == {
+        "error": "cname: private ip (resolved from dns)"
+    }
+
+
+@pytest.mark.parametrize(
+    "url, expected",
+    [
+        ("https://example.com/page", None),
+        ("http://93.184.215.14/", None),
+        ("http://10.0.0.1/", "private ip"),
+        ("http://[::1]:8080/", "private ip"),
+        ("ftp://example.com/", "unsupported scheme: ftp"),
+    ],
+)
+def test_url_error(url, expected):
+    """Test the checks on a url before its host is resolved"""
+    assert url_error(url) == expected
+
+
+@pytest.mark.asyncio
+async def test_guarded_resolver(clock):
+    """Test that the resolver returns the checked addresses and refuses private ones"""
+    resolver = FakeResolver(
+        {
+            ("example.com", "A"): a("93.184.215.14"),
+            ("example.com", "AAAA"): a("2606:2800:21f:cb07::1"),
+            ("internal.example.com", "A"): a("93.184.215.14", "192.168.1.1"),
+        },
+        delay=0,
+    )
+    guarded = GuardedResolver(DnsCache(resolver, clock=clock))
+    hosts = await guarded.resolve("example.com", 443, socket.AF_UNSPEC)
+    assert [(host["host"], host["family"], host["port"]) for host in hosts] == [
+        ("2606:2800:21f:cb07::1", socket.AF_INET6, 443),
+        ("93.184.215.14", socket.AF_INET, 443),
+    ]
+    assert [host["host"] for host in await guarded.resolve("example.com", 443, socket.AF_INET)] == ["93.184.215.14"]
+    with pytest.raises(BlockedAddressError, match="private ip"):
+        await guarded.resolve("internal.example.com", 443)
+    with pytest.raises(OSError, match="no dns records found"):
+        await guarded.resolve("nothing.example.com", 443)
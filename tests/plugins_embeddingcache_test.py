@@ -0,0 +1,79 @@
+""" Tests for the embedding cache """
+
+import os
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+# pylint: disable=wrong-import-position
+from plugins import vectordb as vectordb_module
+from plugins.embeddingcache import EmbeddingCache, normalize_text
+from plugins.vectordb import VectorDb
+
+MODEL = "text-embedding-3-small"
+
+
+def test_normalize_text():
+    """Test that whitespace and unicode forms don't change the text"""
+    assert normalize_text("  likes\n tea\t") == "likes tea"
+    assert normalize_text("café") == normalize_text("café")
+
+
+@pytest.mark.asyncio
+async def test_embeddings_are_stored_as_float32(valkey, avalkey):
+    """Test that vectors live in process and in valkey as float32 bytes"""
+    cache = EmbeddingCache(lambda: avalkey, ttl=60)
+    stored = await cache.put_many(MODEL, {"likes tea": [0.25, 0.5, 1.0]})
+    assert stored["likes tea"].dtype == np.float32
+    assert not stored["likes tea"].flags.writeable
+    key = cache.key(MODEL, "likes tea")
+    assert valkey.data[key] == np.array([0.25, 0.5, 1.0], dtype=np.float32).tobytes()
+    assert valkey.expiry[key] == 60
+    assert valkey.called_with("pipeline") == [(False,)]
+    assert (await cache.get_many(MODEL, ["likes tea"]))[0] is stored["likes tea"]
+    assert not valkey.called_with("mget")
+    # another process only has valkey
+    other = EmbeddingCache(lambda: avalkey)
+    found, missing = await other.get_many(MODEL, ["likes tea", "likes coffee"])
+    assert found.tolist() == [0.25, 0.5, 1.0]
+    assert missing is None
+    assert valkey.called_with("mget") == [([key, other.key(MODEL, "likes coffee")],)]
+    assert (await other.get_many("another-model", ["likes tea"])) == [None]
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_are_evicted():
+    """Test that the lru keeps at most max_entries vectors"""
+    cache = EmbeddingCache(max_entries=2)
+    await cache.put_many(MODEL, {"a": [1.0], "b": [2.0]})
+    await cache.get_many(MODEL, ["a"])
+    await cache.put_many(MODEL, {"c": [3.0]})
+    a, b, c = await cache.get_many(MODEL, ["a", "b", "c"])
+    assert a is not None and b is None and c is not None
+
+
+@pytest.mark.asyncio
+async def test_repeated_texts_are_embedded_once(avalkey, monkeypatch):
+    """Test that only distinct texts missing from the cache are sent to the api"""
+    monkeypatch.setattr(VectorDb, "embedding_cache", EmbeddingCache(lambda: avalkey))
+    create = AsyncMock(
+        side_effect=lambda input, model: SimpleNamespace(
+            data=[SimpleNamespace(index=i, embedding=[float(len(text))]) for i, text in enumerate(input)]
+        )
+    )
+    monkeypatch.setattr(vectordb_module.aclient.embeddings, "create", create)
+    vectordb = VectorDb.__new__(VectorDb)
+    embeddings = await vectordb.async_get_embeddings(["tea", " tea ", "coffee"])
+    assert [embedding.tolist() for embedding in embeddings] == [[3.0], [3.0], [6.0]]
+    create.assert_awaited_once_with(input=["tea", "coffee"], model=MODEL)
+    assert (await vectordb.async_get_embeddings("coffee")).tolist() == [6.0]
+    assert create.await_count == 1
+    # misses are sent in batches of the api limit
+    monkeypatch.setattr(vectordb_module, "EMBEDDING_BATCH_SIZE", 2)
+    embeddings = await vectordb.embed_many(["a", "bb", "tea", "ccc", "dddd"])
+    assert [embedding.tolist() for embedding in embeddings] == [[1.0], [2.0], [3.0], [3.0], [4.0]]
+    assert [call.kwargs["input"] for call in create.await_args_list[1:]] == [["a", "bb"], ["ccc", "dddd"]]
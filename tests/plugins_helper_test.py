@@ -1,10 +1,15 @@
 """ Tests for the helper plugin """
 
-from unittest.mock import Mock, patch
+import asyncio
+import json
+import os
+from unittest.mock import AsyncMock, Mock, patch
 import pytest
 import pytest_asyncio
 import urllib3
 import certifi
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
 from plugins import helper
 
@@ -16,6 +21,23 @@ def helper_instance():
     return helper.Helper(mock_driver)
 
 # pylint: disable=redefined-outer-name
+def test_valkey_pools_are_shared(helper_instance):
+    """Test that every helper uses the same connection pools"""
+    other = helper.Helper(Mock())
+    assert helper_instance.valkey.connection_pool is other.valkey.connection_pool
+    assert helper_instance.valkey_bytes.connection_pool is other.valkey_bytes.connection_pool
+    assert helper_instance.valkey.connection_pool is not helper_instance.valkey_bytes.connection_pool
+
+
+@pytest.mark.asyncio
+async def test_async_valkey_is_shared(helper_instance):
+    """Test that the asyncio client is shared within a loop"""
+    other = helper.Helper(Mock())
+    assert helper_instance.avalkey is other.avalkey
+    assert helper_instance.avalkey_bytes is other.avalkey_bytes
+    assert helper_instance.avalkey is not helper_instance.avalkey_bytes
+
+
 def test_strip_self_username(helper_instance):
     """Test strip_self_username"""
     helper_instance.driver.client.username = "testuser"
@@ -50,14 +72,15 @@ def test_strip_self_username(helper_instance):
         ),
     ],
 )
+@pytest.mark.asyncio
 @patch("requests.head")
-def test_validate_input(
+async def test_validate_input(
     mock_requests_head, helper_instance, input_val, expected_result, validate_type
 ):
-    """Test validate_input"""
+    """Test async_validate_input"""
     mock_requests_head.return_value.status_code = 200
 
-    result = helper_instance.validate_input(input_val, types=[validate_type])
+    result = await helper_instance.async_validate_input(input_val, types=[validate_type])
     assert result == expected_result
 
 
@@ -155,20 +178,17 @@ def test_get_content_type_and_ext(mock_guess_extension, helper_instance, content
 
 
 @pytest.mark.asyncio
-@patch("requests.get")
-async def test_download_webpage(mock_get, helper_instance):
+async def test_download_webpage(helper_instance):
     """Test download_webpage"""
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     
     url = "https://example.com"
     content = "<html><head><title>Example Domain</title></head><body><h1>Example Domain</h1></body></html>"
-    mock_response = Mock()
-    mock_response.status_code = 200
-    mock_response.headers = {"Content-Type": "text/html"}
-    mock_response.iter_content = Mock(return_value=[content.encode("utf-8")])
-    mock_get.return_value = mock_response
+    mock_response = helper.HttpResponse(
+        url, 200, {"Content-Type": "text/html"}, content.encode("utf-8")
+    )
 
-    with patch("requests.get", return_value=mock_response):
+    with patch.object(helper.Helper, "fetch", AsyncMock(return_value=mock_response)):
         result, filename = await helper_instance.download_webpage(url)
     
     expected_result = "links:|title:Example Domain|body:Example Domain"
@@ -176,3 +196,130 @@ async def test_download_webpage(mock_get, helper_instance):
     assert filename is not None
     assert filename.startswith("/tmp/")
     assert filename.endswith(".txt")
+
+
+@pytest_asyncio.fixture
+async def http_server():
+    """local http server serving a small and a large body and some redirects"""
+    async def small(_request):
+        return web.Response(text="hello")
+
+    async def large(_request):
+        return web.Response(body=b"x" * 4096)
+
+    async def stream(request):
+        # no content length so the cap has to be enforced while reading
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for _ in range(8):
+            await response.write(b"x" * 1024)
+        return response
+
+    async def redirect(request):
+        # without a target it redirects to itself
+        raise web.HTTPFound(request.query.get("to", request.path))
+
+    app = web.Application()
+    app.router.add_get("/redirect", redirect)
+    app.router.add_get("/small", small)
+    app.router.add_get("/large", large)
+    app.router.add_get("/stream", stream)
+    async with TestServer(app) as server:
+        yield server
+
+
+@pytest.mark.asyncio
+async def test_fetch_is_capped(helper_instance, http_server):
+    """Test that fetch reads small bodies and refuses large ones"""
+    response = await helper_instance.fetch(str(http_server.make_url("/small")))
+    assert response.status_code == 200
+    assert response.text == "hello"
+    assert response.headers["content-type"].startswith("text/plain")
+    for path in ("/large", "/stream"):
+        with pytest.raises(helper.DownloadTooLargeError):
+            await helper_instance.fetch(str(http_server.make_url(path)), max_size=2048)
+    # the session is kept for the next request
+    assert helper.get_http_session() is helper.get_http_session()
+
+
+@pytest.mark.asyncio
+async def test_download_file(helper_instance, http_server, tmp_path):
+    """Test that download_file streams to disk and removes partial files"""
+    filename = str(tmp_path / "small.txt")
+    assert await helper_instance.download_file(str(http_server.make_url("/small")), filename) == filename
+    with open(filename, "rb") as file:
+        assert file.read() == b"hello"
+    partial = str(tmp_path / "stream.txt")
+    with pytest.raises(helper.DownloadTooLargeError):
+        await helper_instance.download_file(str(http_server.make_url("/stream")), partial, max_size=2048)
+    assert not os.path.exists(partial)
+
+
+@pytest.mark.asyncio
+async def test_guarded_requests_check_every_hop(helper_instance, http_server, monkeypatch):
+    """Test that guarded requests refuse private addresses on any redirect hop"""
+    small = str(http_server.make_url("/small"))
+    with pytest.raises(helper.BlockedAddressError, match="private ip"):
+        await helper_instance.fetch(small, guarded=True)
+    # let the test server through, everything else is checked as usual
+    url_error = helper.url_error
+    monkeypatch.setattr(
+        helper, "url_error", lambda url: None if helper.URL(str(url)).host == "127.0.0.1" else url_error(url)
+    )
+    redirect = str(http_server.make_url("/redirect"))
+    response = await helper_instance.fetch(redirect, params={"to": "/small"}, guarded=True)
+    assert response.text == "hello"
+    assert response.url == small
+    with pytest.raises(helper.BlockedAddressError, match="private ip"):
+        await helper_instance.fetch(redirect, params={"to": "http://10.0.0.1/"}, guarded=True)
+    with pytest.raises(helper.BlockedAddressError, match="unsupported scheme"):
+        await helper_instance.fetch(redirect, params={"to": "file:///etc/passwd"}, guarded=True)
+    with pytest.raises(helper.aiohttp.TooManyRedirects):
+        await helper_instance.fetch(redirect, guarded=True)
+
+
+@pytest.mark.asyncio
+async def test_web_search_and_download_is_hedged(helper_instance):
+    """Test that downloads run concurrently and the slow ones are cancelled"""
+    results = [{"href": f"https://{name}.example", "title": name} for name in ("dead", "slow", "fast", "ok")]
+    cancelled = []
+
+    async def download_webpage(url):
+        try:
+            if "dead" in url:
+                return "Error: could not download webpage (status code 500)", None
+            await asyncio.sleep({"slow": 5, "fast": 0.05, "ok": 0.1}[url[8:-8]])
+            return f"content of {url}", None
+        except asyncio.CancelledError:
+            cancelled.append(url)
+            raise
+
+    with patch.object(helper.Helper, "web_search", AsyncMock(return_value=(results, None))), patch.object(
+        helper.Helper, "download_webpage", side_effect=download_webpage
+    ), patch.object(helper.Helper, "log", AsyncMock()):
+        start = asyncio.get_running_loop().time()
+        downloaded, _ = await helper_instance.web_search_and_download("test", wanted=2, parallel=3, deadline=1)
+        elapsed = asyncio.get_running_loop().time() - start
+    downloaded = json.loads(downloaded)
+    # the dead site made room for the fourth result, the slow one was cancelled
+    assert [result["content"] for result in downloaded] == [
+        "content of https://fast.example",
+        "content of https://ok.example",
+    ]
+    assert cancelled == ["https://slow.example"]
+    assert elapsed < 1
+
+
+@pytest.mark.asyncio
+async def test_web_search_and_download_deadline(helper_instance):
+    """Test that downloads over the deadline are reported as failures"""
+    results = [{"href": "https://slow.example", "title": "slow"}]
+
+    async def download_webpage(_url):
+        await asyncio.sleep(5)
+
+    with patch.object(helper.Helper, "web_search", AsyncMock(return_value=(results, None))), patch.object(
+        helper.Helper, "download_webpage", side_effect=download_webpage
+    ), patch.object(helper.Helper, "log", AsyncMock()):
+        downloaded, _ = await helper_instance.web_search_and_download("test", deadline=0.05)
+    assert json.loads(downloaded)[0]["content"].endswith("timed out after 0.05 seconds")
@@ -0,0 +1,54 @@
+""" Tests for the html extractor """
+
+import pytest
+
+from plugins import htmlextract
+
+PAGE = """<!DOCTYPE html>
+<html><head><title>Example &amp; Domain</title>
+<style>body { color: red }</style>
+<script>var links = "<a href='/nope'>nope</a>";</script></head>
+<body>
+<h1>Example   Domain</h1>
+<!-- not text -->
+<p>Read <a href="/more">more <b>here</b></a> or <a>nowhere</a>.</p>
+<noscript><a href="/js">enable js</a></noscript>
+</body></html>"""
+
+
+@pytest.mark.parametrize("parser", htmlextract.available_parsers())
+def test_extract(parser):
+    """Test that every available backend extracts the same page"""
+    page = htmlextract.extract(PAGE, parser)
+    assert page["title"] == "Example & Domain"
+    assert page["links"] == "/more more here | None nowhere"
+    assert page["text"] == "Example   Domain Read more here or nowhere ."
+    assert "color" not in page["text_full"]
+    assert "enable js" not in page["text_full"]
+    assert "Read more here or nowhere." in page["text_full"]
+
+
+def test_page_without_body():
+    """Test that fragments without a body still give text"""
+    page = htmlextract.extract("<div><a href='/x'>link</a> text</div>", "html.parser")
+    assert page["text"] == "link text"
+    assert page["links"] == "/x link"
+    assert page["title"] == ""
+
+
+def test_nothing_to_parse():
+    """Test that plain text is not a page"""
+    assert htmlextract.extract("just text", "html.parser") is None
+
+
+def test_unknown_parser_falls_back():
+    """Test that a parser that is not installed falls back to html.parser"""
+    assert htmlextract.get_parser("nope") is htmlextract.extract_stdlib
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("kind", ["thread", "process"])
+async def test_extract_async(kind):
+    """Test that extraction works in both pools"""
+    page = await htmlextract.extract_async(PAGE, "html.parser", kind)
+    assert page == htmlextract.extract(PAGE, "html.parser")
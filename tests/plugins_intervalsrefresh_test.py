@@ -0,0 +1,104 @@
+""" Tests for the intervals.icu refresh engine """
+
+import asyncio
+import threading
+
+import pytest
+
+from plugins.intervalsrefresh import RefreshEngine, RetryableError, backoff, retry_after
+
+
+def test_retry_after_and_backoff():
+    """Test that Retry-After seconds are read and backoff grows within its bounds"""
+    assert retry_after({"Retry-After": "7"}) == 7.0
+    assert retry_after({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) is None
+    assert retry_after({}) is None
+    for attempt in range(10):
+        assert min(60.0, 2.0 * 2**attempt) / 2 <= backoff(attempt, 2.0, 60.0) <= min(60.0, 2.0 * 2**attempt)
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_bounded():
+    """Test that no more than concurrency athletes are scraped at once"""
+    running = []
+    peak = []
+
+    async def scrape(uid, force_all):
+        running.append(uid)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(uid)
+        return {"uid": uid, "force_all": force_all}
+
+    engine = RefreshEngine(scrape, concurrency=3)
+    results = await engine.refresh_all([f"u{i}" for i in range(10)], force_all=True)
+    assert max(peak) == 3
+    assert results["u7"] == {"uid": "u7", "force_all": True}
+
+
+@pytest.mark.asyncio
+async def test_retries_honour_retry_after(clock):
+    """Test that 429 and 5xx are retried after Retry-After or a backoff"""
+    answers = [RetryableError(429, 5.0), RetryableError(503), {"done": True}]
+    sleeps = []
+
+    async def scrape(uid, force_all):
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    async def sleep(delay):
+        sleeps.append(delay)
+
+    engine = RefreshEngine(scrape, retries=3, backoff_base=2.0, backoff_max=60.0, clock=clock, sleep=sleep)
+    assert await engine.refresh("u1") == {"done": True}
+    assert sleeps[0] == 5.0
+    assert 1.0 <= sleeps[1] <= 4.0
+    assert not engine.failures
+
+
+@pytest.mark.asyncio
+async def test_failing_athlete_backs_off(clock):
+    """Test that an athlete whose refresh failed is skipped until its backoff runs out"""
+    calls = []
+
+    async def scrape(uid, force_all):
+        calls.append(uid)
+        raise RetryableError(500)
+
+    async def sleep(delay):
+        pass
+
+    engine = RefreshEngine(scrape, retries=1, backoff_base=10.0, backoff_max=100.0, clock=clock, sleep=sleep)
+    results = await engine.refresh_all(["u1"])
+    assert isinstance(results["u1"], RetryableError)
+    assert len(calls) == 2
+    assert engine.failures["u1"][0] == 1
+    assert await engine.refresh("u1") is None
+    assert len(calls) == 2
+    # a user asking for a refresh is not made to wait
+    with pytest.raises(RetryableError):
+        await engine.refresh("u1", force=True)
+    assert engine.failures["u1"][0] == 2
+    clock.now += 100.0
+    with pytest.raises(RetryableError):
+        await engine.refresh("u1")
+    assert len(calls) == 6
+
+
+def test_refresh_runs_in_the_background():
+    """Test that starting a refresh returns at once and a second one is refused"""
+    release = threading.Event()
+
+    async def scrape(uid, force_all):
+        await asyncio.to_thread(release.wait, 5)
+        return {"uid": uid}
+
+    engine = RefreshEngine(scrape)
+    future = engine.refresh_all_in_background(["u1", "u2"])
+    assert not future.done()
+    assert engine.refresh_all_in_background(["u1"]) is None
+    release.set()
+    assert future.result(timeout=5) == {"u1": {"uid": "u1"}, "u2": {"uid": "u2"}}
+    assert engine.refresh_all_in_background(["u1"]).result(timeout=5) == {"u1": {"uid": "u1"}}
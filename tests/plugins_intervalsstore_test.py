@@ -0,0 +1,251 @@
+""" Tests for the intervals.icu record store """
+
+import datetime
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from plugins import intervalsicu as intervalsicu_module
+from plugins.helper import HttpResponse
+from plugins.intervalsicu import IntervalsIcu
+from plugins.intervalsrefresh import RetryableError
+from plugins.intervalsstore import IntervalsStore, date_pages, epoch_day
+from plugins.models.intervals_activity import IntervalsActivity
+from plugins.models.intervals_wellness import IntervalsWellness
+
+PREFIX = "INTERVALSICU"
+
+
+def activity(activity_id, start, name="Morning run", **fields):
+    """an activity that started at an iso datetime"""
+    return IntervalsActivity.from_dict(
+        {"id": activity_id, "start_date_local": start, "start_date": start + "Z", "type": "Run", "name": name, **fields}
+    )
+
+
+@pytest.fixture(name="activities")
+def fixture_activities(valkey):
+    """the activity store"""
+    return IntervalsStore(
+        valkey, PREFIX, "activities", IntervalsActivity,
+        date_field="start_date_local", sort_key=lambda record: record.start_date,
+    )
+
+
+@pytest.fixture(name="wellness")
+def fixture_wellness(valkey):
+    """the wellness store"""
+    return IntervalsStore(
+        valkey, PREFIX, "wellness", IntervalsWellness, date_field="id", sort_key=lambda record: record.id, merge=True
+    )
+
+
+def test_epoch_day():
+    """Test that dates and datetimes map to days since 1970"""
+    assert epoch_day("1970-01-02") == 1
+    assert epoch_day("2024-03-01T23:59:59") == epoch_day("2024-03-01")
+
+
+def test_upsert_touches_one_record(valkey, activities):
+    """Test that an upsert reads one field and never loads the other records"""
+    for i in range(50):
+        activities.upsert("u1", activity(f"i{i}", f"2024-03-{i % 28 + 1:02d}T08:00:00"))
+    valkey.calls.clear()
+    assert activities.upsert("u1", activity("i3", "2024-03-04T08:00:00")) == "alreadyexists"
+    assert activities.upsert("u1", activity("i3", "2024-03-04T08:00:00", name="Evening run")) == "changed"
+    assert activities.upsert("u1", activity("i50", "2024-03-05T08:00:00")) == "added"
+    assert "lrange" not in valkey.called() and "zrange" not in valkey.called()
+    assert valkey.called().count("hget") == 3
+    assert activities.count("u1") == 51
+
+
+def test_records_are_ordered_by_date(activities):
+    """Test that records come back oldest first and newest returns the latest"""
+    activities.upsert("u1", activity("b", "2024-03-02T18:00:00"))
+    activities.upsert("u1", activity("c", "2024-03-02T07:00:00"))
+    activities.upsert("u1", activity("a", "2024-03-01T12:00:00"))
+    assert [record.id for record in activities.get_all("u1")] == ["a", "c", "b"]
+    assert activities.newest("u1").id == "b"
+    activities.remove("u1", "b")
+    assert activities.newest("u1").id == "c"
+    assert activities.newest("nobody") is None
+
+
+def test_wellness_is_merged(wellness):
+    """Test that a wellness entry for a day is merged into the stored one"""
+    entry = {"id": "2024-03-01", "steps": 1000, "sportInfo": [{"type": "Run", "eftp": 4.2}]}
+    assert wellness.upsert("u1", IntervalsWellness.from_dict(dict(entry))) == "added"
+    assert wellness.upsert("u1", IntervalsWellness.from_dict(dict(entry))) == "alreadyexists"
+    assert wellness.upsert("u1", IntervalsWellness.from_dict({**entry, "weight": 70.5})) == "changed"
+    stored = wellness.get_all("u1")[0]
+    assert (stored.steps, stored.weight, stored.sportInfo[0].eftp) == (1000, 70.5, 4.2)
+    assert wellness.count("u1") == 1
+
+
+def test_migrate_from_lists(valkey, activities, wellness):
+    """Test that the old lists are moved into the hashes once, newest copies win"""
+    legacy = activities.legacy_key("u1")
+    valkey.lpush(legacy, activity("a", "2024-03-01T08:00:00").to_json())
+    valkey.lpush(legacy, activity("b", "2024-03-02T08:00:00").to_json())
+    valkey.lpush(legacy, activity("a", "2024-03-01T08:00:00", name="Renamed").to_json())
+    valkey.lpush(wellness.legacy_key("u1"), json.dumps({"id": "2024-03-01", "steps": 10}))
+    assert activities.migrate("u1") == 2
+    assert wellness.migrate("u1") == 1
+    assert [(record.id, record.name) for record in activities.get_all("u1")] == [("a", "Renamed"), ("b", "Morning run")]
+    assert wellness.get_all("u1")[0].steps == 10
+    assert valkey.type(legacy) == "none"
+    assert activities.migrate("u1") == 0
+
+
+def test_get_range_reads_only_the_window(valkey, activities):
+    """Test that a date range decodes only the records of its days"""
+    for day in range(1, 29):
+        activities.upsert("u1", activity(f"i{day}", f"2024-02-{day:02d}T08:00:00"))
+    valkey.calls.clear()
+    window = activities.get_range("u1", datetime.date(2024, 2, 10), datetime.date(2024, 2, 12))
+    assert [record.id for record in window] == ["i10", "i11", "i12"]
+    assert valkey.called() == ["zrangebyscore", "hmget"]
+    assert window[0].start_datetime_local == datetime.datetime(2024, 2, 10, 8)
+
+
+def test_parsed_dates_are_not_stored():
+    """Test that the parsed datetimes live on the models but not in their json"""
+    parsed = activity("a", "2024-03-01T08:00:00")
+    assert parsed.start_datetime.tzinfo is not None
+    assert "start_datetime_local" not in json.loads(parsed.to_json())
+    assert not IntervalsActivity.has_field("start_datetime")
+    wellness_entry = IntervalsWellness.from_dict({"id": "2024-03-01", "steps": 10})
+    assert wellness_entry.day == datetime.date(2024, 3, 1)
+    assert "day" not in wellness_entry.to_dict()
+    assert not IntervalsWellness.has_field("day")
+    assert IntervalsWellness.from_dict(wellness_entry.to_dict()) == wellness_entry
+
+
+def test_cursor_fields(valkey, activities):
+    """Test that cursor fields are set, removed and go with the records"""
+    assert activities.cursor("u1") == {}
+    activities.update_cursor("u1", oldest="2024-03-01", etag='"v1"')
+    activities.update_cursor("u1", etag=None, changed=1.5)
+    assert activities.cursor("u1") == {"oldest": "2024-03-01", "changed": "1.5"}
+    activities.delete("u1")
+    assert activities.cursor("u1") == {}
+    assert list(date_pages(datetime.date(2024, 1, 1), datetime.date(2024, 1, 10), 4)) == [
+        (datetime.date(2024, 1, 1), datetime.date(2024, 1, 4)),
+        (datetime.date(2024, 1, 5), datetime.date(2024, 1, 8)),
+        (datetime.date(2024, 1, 9), datetime.date(2024, 1, 10)),
+    ]
+
+
+class FakeIntervalsApi:
+    """answers activities and wellness requests from records by day"""
+
+    def __init__(self):
+        self.records = {"activities": [], "wellness": []}
+        self.requests = []
+        self.etag = '"v1"'
+        self.fail_at = None
+
+    async def fetch(self, url, params=None, headers=None, max_size=None):
+        """answer a request for the records of a window"""
+        endpoint = url.rsplit("/", 1)[1]
+        self.requests.append((endpoint, params, headers))
+        if self.fail_at == len(self.requests):
+            raise RetryableError(503)
+        if headers.get("If-None-Match") == self.etag:
+            return HttpResponse(url, 304, {"ETag": self.etag}, b"")
+        day_field = "start_date_local" if endpoint == "activities" else "id"
+        body = [
+            record for record in self.records[endpoint]
+            if params["oldest"] <= record[day_field][:10] <= params["newest"]
+        ]
+        return HttpResponse(url, 200, {"ETag": self.etag}, json.dumps(body).encode())
+
+
+@pytest.fixture(name="api")
+def fixture_api():
+    """an intervals.icu api without records"""
+    return FakeIntervalsApi()
+
+
+@pytest.fixture(name="intervals")
+def fixture_intervals(valkey, api, monkeypatch):
+    """the plugin with fake valkey and api"""
+    monkeypatch.setattr(intervalsicu_module, "INTERVALS_SYNC_START", datetime.date.today() - datetime.timedelta(days=100))
+    monkeypatch.setattr(intervalsicu_module, "INTERVALS_SYNC_PAGE_DAYS", 30)
+    intervals = IntervalsIcu.__new__(IntervalsIcu)
+    intervals.valkey = valkey
+    intervals.intervals_prefix = PREFIX
+    intervals.api_url = "https://app.intervals.icu/api/v1"
+    intervals.opted_in = set()
+    intervals.helper = SimpleNamespace(fetch=api.fetch, slog=lambda message: None)
+    intervals.activity_store = IntervalsStore(
+        valkey, PREFIX, "activities", IntervalsActivity,
+        date_field="start_date_local", sort_key=lambda record: record.start_date,
+    )
+    intervals.wellness_store = IntervalsStore(
+        valkey, PREFIX, "wellness", IntervalsWellness,
+        date_field="id", sort_key=lambda record: record.id, merge=True, change_field="updated",
+    )
+    return intervals
+
+
+def days_ago(days: int) -> str:
+    """the iso date of days ago"""
+    return (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+
+
+@pytest.mark.asyncio
+async def test_full_resync_is_paged_and_resumes(intervals, api):
+    """Test that a first sync reads the history page by page and carries on after a failure"""
+    api.records["activities"] = [
+        {"id": f"i{days}", "start_date_local": f"{days_ago(days)}T08:00:00",
+         "start_date": f"{days_ago(days)}T08:00:00Z", "type": "Run", "name": "Run"}
+        for days in (95, 60, 20, 1)
+    ]
+    api.fail_at = 3
+    with pytest.raises(RetryableError):
+        await intervals._scrape_athlete("u1")
+    assert intervals.activity_store.count("u1") == 2
+    assert intervals.activity_store.cursor("u1")["resync"] == days_ago(40)
+    api.fail_at = None
+    result = await intervals._scrape_athlete("u1")
+    assert result["activities_added"] == 2
+    assert intervals.activity_store.count("u1") == 4
+    pages = [params for endpoint, params, _ in api.requests if endpoint == "activities"]
+    assert [page["oldest"] for page in pages] == [days_ago(100), days_ago(70), days_ago(40), days_ago(40), days_ago(10)]
+    cursor = intervals.activity_store.cursor("u1")
+    assert "resync" not in cursor and cursor["oldest"] == days_ago(4)
+
+
+@pytest.mark.asyncio
+async def test_unchanged_window_is_not_transferred(intervals, api):
+    """Test that a refresh asks for the window conditionally and skips unchanged wellness"""
+    api.records["wellness"] = [
+        {"id": days_ago(2), "steps": 10, "updated": f"{days_ago(2)}T20:00:00.000+00:00"},
+        {"id": days_ago(1), "steps": 20, "updated": f"{days_ago(1)}T20:00:00.000+00:00"},
+    ]
+    decoded = []
+    intervals.add_wellness = lambda uid, wellness: decoded.append(wellness.id) or intervals.wellness_store.upsert(uid, wellness)
+    assert await intervals._sync("u1", intervals.wellness_store, "wellness") == (2, 0)
+    assert await intervals._sync("u1", intervals.wellness_store, "wellness") == (0, 0)
+    assert len(decoded) == 2
+    api.requests.clear()
+    # the same window again comes back as not modified
+    assert await intervals._sync("u1", intervals.wellness_store, "wellness") == (0, 0)
+    assert api.requests[0][2]["If-None-Match"] == '"v1"'
+    # a changed window only decodes the entries updated since the last sync
+    api.etag = '"v2"'
+    api.records["wellness"][1] = {"id": days_ago(1), "steps": 30, "updated": f"{days_ago(0)}T06:00:00.000+00:00"}
+    assert await intervals._sync("u1", intervals.wellness_store, "wellness") == (0, 1)
+    assert decoded[2:] == [days_ago(1)]
+    assert intervals.wellness_store.get_all("u1")[-1].steps == 30
+
+
+@pytest.mark.asyncio
+async def test_existing_athletes_carry_on_from_their_records(intervals, api):
+    """Test that athletes stored before cursors existed are not resynced"""
+    intervals.activity_store.upsert("u1", activity("a", f"{days_ago(10)}T08:00:00"))
+    await intervals._sync("u1", intervals.activity_store, "activities")
+    assert len(api.requests) == 1
+    assert api.requests[0][1]["oldest"] == days_ago(13)
@@ -0,0 +1,114 @@
+""" Tests for the web page cache """
+
+import base64
+import os
+from unittest.mock import AsyncMock, Mock, patch
+
+import pytest
+
+from plugins import helper
+from plugins.pagecache import PageCache
+from plugins.serializers import COMPRESSED, Serializer
+
+PAGE = "<html><head><title>Cached</title></head><body><p>hello</p></body></html>"
+
+
+@pytest.fixture(name="helper_instance")
+def fixture_helper_instance(avalkey):
+    """a helper with the page cache on the fake valkey"""
+    instance = helper.Helper(Mock())
+    serializer = Serializer()
+    instance.page_cache = PageCache(lambda: avalkey, serializer.encode, serializer.decode)
+    instance.log = AsyncMock()
+    return instance
+
+
+def response(status=200, body=PAGE, headers=None):
+    """a fetched response"""
+    headers = {"Content-Type": "text/html", **(headers or {})}
+    return helper.HttpResponse("https://example.com", status, headers, body.encode())
+
+
+async def download(helper_instance, fetch):
+    """download_webpage with the network and validation patched out"""
+    with patch.object(
+        helper.Helper, "async_validate_input", AsyncMock(return_value=True)
+    ), patch.object(
+        helper.Helper, "fetch", fetch
+    ):
+        return await helper_instance.download_webpage("https://example.com/page#section")
+
+
+@pytest.mark.asyncio
+async def test_fresh_pages_skip_the_network(helper_instance):
+    """Test that a second download is served from the cache with a new temp file"""
+    fetch = AsyncMock(return_value=response())
+    first = await download(helper_instance, fetch)
+    second = await download(helper_instance, fetch)
+    assert fetch.await_count == 1
+    assert first[0] == second[0] == "links:|title:Cached|body:hello"
+    assert second[1] != first[1]
+    with open(second[1], encoding="utf-8") as file:
+        assert "Title: Cached" in file.read()
+
+
+@pytest.mark.asyncio
+async def test_stale_pages_are_revalidated(helper_instance, valkey):
+    """Test that stale pages send the validators and a 304 reuses the cached page"""
+    fetch = AsyncMock(return_value=response(headers={"ETag": '"v1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}))
+    await download(helper_instance, fetch)
+    assert list(valkey.expiry.values()) == [helper_instance.page_cache.stale_ttl]
+    helper_instance.page_cache.ttl = 0
+    fetch.return_value = response(status=304, body="")
+    content, _ = await download(helper_instance, fetch)
+    headers = fetch.await_args.kwargs["headers"]
+    assert headers["If-None-Match"] == '"v1"'
+    assert headers["If-Modified-Since"] == "Mon, 01 Jan 2024 00:00:00 GMT"
+    assert content == "links:|title:Cached|body:hello"
+
+
+@pytest.mark.asyncio
+async def test_stale_page_is_used_when_the_server_fails(helper_instance):
+    """Test that an error while revalidating returns the stale page"""
+    fetch = AsyncMock(return_value=response(headers={"ETag": '"v1"'}))
+    await download(helper_instance, fetch)
+    helper_instance.page_cache.ttl = 0
+    fetch.return_value = response(status=500, body="")
+    content, _ = await download(helper_instance, fetch)
+    assert content == "links:|title:Cached|body:hello"
+
+
+@pytest.mark.asyncio
+async def test_failures_are_cached(helper_instance, valkey):
+    """Test that failed downloads are remembered for the negative ttl"""
+    fetch = AsyncMock(return_value=response(status=404, body=""))
+    first = await download(helper_instance, fetch)
+    second = await download(helper_instance, fetch)
+    assert fetch.await_count == 1
+    assert first == second == ("Error: could not download webpage (status code 404)", None)
+    assert list(valkey.expiry.values()) == [helper_instance.page_cache.negative_ttl]
+
+
+@pytest.mark.asyncio
+async def test_large_pages_are_compressed_and_capped(valkey, avalkey):
+    """Test that big pages are stored compressed and pages over the cap are skipped"""
+    serializer = Serializer()
+    cache = PageCache(lambda: avalkey, serializer.encode, serializer.decode, max_size=64 * 1024)
+    assert await cache.put("https://a.example", {"content": "a" * 200_000, "saved": "a" * 200_000})
+    assert next(iter(valkey.data.values()))[2] & COMPRESSED
+    assert (await cache.get("https://a.example"))["content"] == "a" * 200_000
+    incompressible = base64.b64encode(os.urandom(200_000)).decode()
+    assert not await cache.put("https://b.example", {"content": incompressible})
+    assert await cache.get("https://b.example") is None
+
+
+@pytest.mark.asyncio
+async def test_cache_errors_are_misses():
+    """Test that a broken valkey does not break downloads"""
+    broken = Mock()
+    broken.get = AsyncMock(side_effect=ConnectionError("down"))
+    broken.set = AsyncMock(side_effect=ConnectionError("down"))
+    serializer = Serializer()
+    cache = PageCache(lambda: broken, serializer.encode, serializer.decode)
+    assert await cache.get("https://a.example") is None
+    assert not await cache.put("https://a.example", {"content": "a"})
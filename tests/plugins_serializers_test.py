@@ -0,0 +1,79 @@
+""" Tests for the valkey serializers """
+
+import json
+
+import jsonpickle
+import pytest
+
+from plugins.serializers import COMPRESSED, FORMAT_VERSION, MAGIC, SerializationError, Serializer
+
+MESSAGE = {"role": "user", "content": "@someone: hello", "name": None}
+
+
+@pytest.mark.parametrize("codec", ["json", "msgpack"])
+def test_roundtrip(codec):
+    """Test that both codecs round trip a message"""
+    serializer = Serializer(codec)
+    data = serializer.encode(MESSAGE)
+    assert data[0] == MAGIC
+    assert data[1] == FORMAT_VERSION
+    assert serializer.decode(data) == MESSAGE
+
+
+@pytest.mark.parametrize("codec", ["json", "msgpack"])
+def test_large_bodies_are_compressed(codec):
+    """Test that large entries are zstd compressed"""
+    serializer = Serializer(codec, compress_threshold=1024)
+    message = {"role": "user", "content": [{"type": "image_url", "image_url": {"url": "A" * 50_000}}]}
+    data = serializer.encode(message)
+    assert data[2] & COMPRESSED
+    assert len(data) < 50_000
+    assert serializer.decode(data) == message
+    # small entries are left alone
+    assert not serializer.encode(MESSAGE)[2] & COMPRESSED
+
+
+@pytest.mark.parametrize(
+    "legacy",
+    [
+        json.dumps(MESSAGE),
+        json.dumps(MESSAGE).encode(),
+        jsonpickle.encode(MESSAGE, unpicklable=False).encode(),
+    ],
+)
+def test_legacy_entries_decode(legacy):
+    """Test that entries written before the header existed still decode"""
+    assert Serializer().decode(legacy) == MESSAGE
+
+
+def test_decode_list_mixes_formats():
+    """Test that a thread with old and new entries decodes"""
+    serializer = Serializer("msgpack")
+    entries = [json.dumps(MESSAGE).encode(), serializer.encode(MESSAGE), Serializer("json").encode(MESSAGE)]
+    assert serializer.decode_list(entries) == [MESSAGE] * 3
+
+
+def test_unknown_version_and_codec():
+    """Test that unknown headers raise"""
+    with pytest.raises(SerializationError):
+        Serializer.decode(bytes((MAGIC, FORMAT_VERSION + 1, 1)) + b"{}")
+    with pytest.raises(SerializationError):
+        Serializer.decode(bytes((MAGIC, FORMAT_VERSION, 0x0F)) + b"{}")
+    with pytest.raises(ValueError):
+        Serializer("pickle")
+
+
+def test_objects_are_flattened():
+    """Test that objects the codecs don't know are stored as plain data"""
+
+    class Delta:  # pylint: disable=too-few-public-methods
+        """stand in for an sdk object"""
+
+        def __init__(self):
+            self.role = "assistant"
+            self.content = "hi"
+
+    serializer = Serializer("msgpack")
+    assert serializer.decode(serializer.encode({"delta": Delta()})) == {
+        "delta": {"role": "assistant", "content": "hi"}
+    }
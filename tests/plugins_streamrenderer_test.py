@@ -0,0 +1,131 @@
+""" Tests for the stream renderer """
+
+import asyncio
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from plugins.streamrenderer import StreamRenderer, reply_with_files
+
+
+class SlowPosts:
+    """records patches and takes a while to answer like a busy mattermost"""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.messages = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def patch_post(self, post_id, options):
+        """record the message"""
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+            self.messages.append(options["message"])
+        return {"id": post_id}
+
+
+def make_driver(latency=0.05):
+    """a driver with slow posts"""
+    driver = Mock()
+    driver.posts = SlowPosts(latency)
+    return driver
+
+
+@pytest.mark.asyncio
+async def test_intermediate_frames_are_dropped():
+    """Test that a fast stream does not patch once per chunk"""
+    driver = make_driver()
+    renderer = StreamRenderer(driver, "post", "(model) @user: ", delay_ms=10)
+    for i in range(200):
+        renderer.append(f"{i} ")
+        await asyncio.sleep(0.001)
+    await renderer.finish()
+    posts = driver.posts
+    assert len(posts.messages) < 50
+    assert posts.max_in_flight == 1
+    # the last patch has everything
+    assert posts.messages[-1] == "(model) @user: " + "".join(f"{i} " for i in range(200))
+
+
+@pytest.mark.asyncio
+async def test_delay_follows_latency():
+    """Test that slow patches slow down the frame rate"""
+    renderer = StreamRenderer(make_driver(0.2), "post", delay_ms=10, max_delay_ms=300)
+    assert renderer.next_delay() == pytest.approx(0.01)
+    await renderer.patch("hello")
+    assert renderer.next_delay() >= 0.3 - 1e-6
+    assert renderer.next_delay() <= 0.3 + 1e-6
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("hello", "(model) @user: hello"),
+        ("# title", "(model) @user: \n# title"),
+        ("```code```", "(model) @user: \n```code```"),
+    ],
+)
+def test_render_markdown_prefix(text, expected):
+    """Test that markdown at the start of a reply gets its own line"""
+    renderer = StreamRenderer(Mock(), "post", "(model) @user: ")
+    assert renderer.render(text) == expected
+
+
+def test_render_status():
+    """Test that status lines go above the reply"""
+    renderer = StreamRenderer(Mock(), "post", "(model) @user: ")
+    renderer.status = ["searching", "downloading"]
+    assert renderer.render("done") == "```\nsearching\ndownloading\n```\n(model) @user: done"
+
+
+@pytest.mark.asyncio
+async def test_overflow_goes_to_a_file():
+    """Test that a long reply is truncated and saved to a file"""
+    driver = make_driver(0)
+    helper = Mock()
+    helper.save_content_to_tmp_file.return_value = "/tmp/reply.txt"
+    renderer = StreamRenderer(driver, "post", "(model) @user: ", max_length=100, helper=helper)
+    renderer.append("x" * 500)
+    renderer.status = ["searching"]
+    files = await renderer.finish()
+    assert files == ["/tmp/reply.txt"]
+    saved = helper.save_content_to_tmp_file.call_args.args[0]
+    assert saved == "x" * 500
+    final = driver.posts.messages[-1]
+    assert len(final) <= 100
+    assert final.endswith(StreamRenderer.OVERFLOW_FINAL)
+    # frames streamed while overflowing never exceed the limit either
+    assert all(len(message) <= 100 for message in driver.posts.messages)
+
+
+@pytest.mark.asyncio
+async def test_stop_waits_for_patch_in_flight():
+    """Test that no frame lands after stop returns"""
+    driver = make_driver(0.1)
+    renderer = StreamRenderer(driver, "post", delay_ms=0)
+    renderer.append("partial")
+    await asyncio.sleep(0.01)
+    await renderer.stop()
+    assert driver.posts.in_flight == 0
+    count = len(driver.posts.messages)
+    renderer.append(" more")
+    await asyncio.sleep(0.05)
+    assert len(driver.posts.messages) == count
+
+
+def test_reply_with_files_batches():
+    """Test that files are attached five at a time and removed"""
+    driver = Mock()
+    helper = Mock()
+    files = [f"/tmp/{i}.txt" for i in range(7)]
+    reply_with_files(driver, helper, "message", files)
+    assert [c.kwargs["file_paths"] for c in driver.reply_to.call_args_list] == [files[:5], files[5:]]
+    assert helper.delete_downloaded_file.call_count == 7
@@ -0,0 +1,131 @@
+""" Tests for the thread cache """
+
+import hashlib
+import json
+
+import pytest
+
+from plugins.threadcache import ThreadCache
+
+
+@pytest.fixture
+def cache(valkey):
+    """thread cache fixture"""
+    return ThreadCache(valkey, json.dumps, json.loads, max_threads=2, max_bytes=10_000)
+
+
+# pylint: disable=redefined-outer-name
+def test_get_missing_thread(cache):
+    """Test that a missing thread is an empty list"""
+    assert cache.get("thread_x") == []
+    assert "thread_x" not in cache
+
+
+def test_get_only_fetches_new_messages(cache, valkey):
+    """Test that a cached thread only reads the new entries"""
+    valkey.rpush("thread_a", json.dumps({"role": "user", "content": "one"}))
+    assert len(cache.get("thread_a")) == 1
+    # another writer appends behind our back
+    valkey.rpush("thread_a", json.dumps({"role": "assistant", "content": "two"}))
+    messages = cache.get("thread_a")
+    assert [m["content"] for m in messages] == ["one", "two"]
+
+
+def test_append_writes_through(cache, valkey):
+    """Test that appends reach valkey and the cache in one round trip"""
+    cache.get("thread_a")
+    before = valkey.round_trips
+    cache.append("thread_a", {"role": "user", "content": "hi"}, {"role": "assistant", "content": "yo"}, expiry=60)
+    assert valkey.round_trips == before + 1
+    assert len(valkey.data["thread_a"]) == 2
+    assert cache.get("thread_a")[1]["content"] == "yo"
+
+
+def test_shrunk_thread_is_reloaded(cache, valkey):
+    """Test that a trimmed thread is loaded again"""
+    cache.append("thread_a", {"content": "1"}, {"content": "2"})
+    cache.get("thread_a")
+    valkey.data["thread_a"] = [json.dumps({"content": "new"})]
+    assert cache.get("thread_a") == [{"content": "new"}]
+    del valkey.data["thread_a"]
+    assert cache.get("thread_a") == []
+
+
+def test_returned_messages_are_copies(cache):
+    """Test that changing the result does not change the cache"""
+    cache.append("thread_a", {"role": "user", "content": "hi"})
+    messages = cache.get("thread_a")
+    messages[0]["content"] = "changed"
+    messages.insert(0, {"role": "system", "content": "system"})
+    assert cache.get("thread_a") == [{"role": "user", "content": "hi"}]
+
+
+def test_digests_are_taken_once(cache, valkey):
+    """Test that entries are hashed when stored and matched to the returned copies"""
+    valkey.rpush("thread_a", json.dumps({"content": "1"}))
+    messages = cache.get("thread_a")
+    cache.append("thread_a", {"content": "2"})
+    messages = cache.get("thread_a")
+    digests = cache.digests("thread_a", messages)
+    assert digests[id(messages[0])] == hashlib.sha1(json.dumps({"content": "1"}).encode()).hexdigest()
+    assert digests[id(messages[1])] == hashlib.sha1(json.dumps({"content": "2"}).encode()).hexdigest()
+    # a list that does not match the cached thread gets no digests
+    assert cache.digests("thread_a", messages + [{"content": "3"}]) == {}
+    assert cache.digests("thread_x", []) == {}
+
+
+def test_eviction_bounds(cache, valkey):
+    """Test that the cache evicts by thread count and by size"""
+    for key in ("thread_a", "thread_b", "thread_c"):
+        valkey.rpush(key, json.dumps({"content": key}))
+        cache.get(key)
+    assert len(cache) == 2
+    assert "thread_a" not in cache
+    valkey.rpush("thread_big", json.dumps({"content": "x" * 20_000}))
+    cache.get("thread_big")
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+@pytest.mark.asyncio
+async def test_async_get_and_append(valkey, avalkey):
+    """Test that the async methods share the cache with the sync ones"""
+    cache = ThreadCache(valkey, json.dumps, json.loads, async_valkey=lambda: avalkey)
+    assert await cache.async_append("thread_a", {"content": "1"}, expiry=60) == 1
+    assert await cache.async_get("thread_a") == [{"content": "1"}]
+    valkey.rpush("thread_a", json.dumps({"content": "2"}))
+    before = valkey.round_trips
+    assert await cache.async_get("thread_a") == [{"content": "1"}, {"content": "2"}]
+    assert valkey.round_trips == before + 1
+    assert cache.get("thread_a") == [{"content": "1"}, {"content": "2"}]
+
+
+def test_batch_writes_once(cache, valkey):
+    """Test that a batch writes all appends in one round trip"""
+    cache.append("thread_a", {"content": "old"})
+    cache.get("thread_a")
+    batch = cache.batch("thread_a", expiry=60)
+    batch.append({"content": "user"})
+    batch.append({"content": "call"}, {"content": "result"})
+    assert len(batch) == 3
+    assert cache.get("thread_a") + batch.pending == [
+        {"content": "old"}, {"content": "user"}, {"content": "call"}, {"content": "result"}
+    ]
+    before = valkey.round_trips
+    assert batch.flush() == 4
+    assert valkey.round_trips == before + 1
+    # nothing left to write
+    assert batch.flush() == 4
+    assert valkey.round_trips == before + 1
+    assert [m["content"] for m in cache.get("thread_a")] == ["old", "user", "call", "result"]
+
+
+@pytest.mark.asyncio
+async def test_batch_async_flush(valkey, avalkey):
+    """Test the awaitable flush"""
+    cache = ThreadCache(valkey, json.dumps, json.loads, async_valkey=lambda: avalkey)
+    batch = cache.batch("thread_a")
+    assert await batch.async_flush() is None
+    batch.append({"content": "1"}, {"content": "2"})
+    assert await batch.async_flush() == 2
+    assert len(valkey.data["thread_a"]) == 2
@@ -0,0 +1,96 @@
+""" Tests for the users plugin and its directory """
+
+import json
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+
+from plugins.userdirectory import UserDirectory
+from plugins.users import Users
+
+ALICE = {"id": "uid-alice", "username": "alice"}
+BOB = {"id": "uid-bob", "username": "bob"}
+CAROL = {"id": "uid-carol", "username": "carol"}
+
+
+@pytest.fixture(name="users")
+def fixture_users(clock):
+    """a users plugin with its own directory, alice is in valkey and bob in mattermost"""
+    users = Users()
+    users.directory = UserDirectory(clock=clock)
+    users.helper = Mock()
+    users.helper.valkey_serialize_json = json.dumps
+    users.helper.valkey_deserialize_json = json.loads
+    stored = {"user:uid-alice": json.dumps(ALICE)}
+    users.valkey = Mock()
+    users.valkey.mget.side_effect = lambda keys: [stored.get(key) for key in keys]
+    users.valkey.smembers.return_value = {"uid-alice"}
+    users.valkey.get.return_value = None
+    users.helper.avalkey = Mock()
+    users.helper.avalkey.mget = AsyncMock(side_effect=lambda keys: [stored.get(key) for key in keys])
+    users.helper.avalkey.pipeline.return_value.execute = AsyncMock()
+    users.driver = Mock()
+    users.driver.users.get_users_by_ids.side_effect = lambda ids: [
+        user for user in (ALICE, BOB) if user["id"] in ids
+    ]
+    return users
+
+
+def test_directory_expires_and_evicts(clock):
+    """Test that entries expire after the ttl and the least recently used are evicted"""
+    directory = UserDirectory(max_users=2, ttl=60, clock=clock)
+    directory.put_user(ALICE)
+    directory.put_user(BOB)
+    assert directory.get_uid("alice") == "uid-alice"
+    directory.get_user("uid-alice")
+    directory.put_user(CAROL)
+    assert directory.get_user("uid-alice") == ALICE
+    assert directory.get_user("uid-bob") is None
+    clock.now += 60
+    assert directory.get_user("uid-alice") is None
+
+
+def test_directory_sets(clock):
+    """Test that the sets are cached until they expire or are invalidated"""
+    directory = UserDirectory(set_ttl=60, clock=clock)
+    directory.put_set("admins", ["uid-alice"])
+    assert directory.get_set("admins") == frozenset({"uid-alice"})
+    directory.invalidate_set("admins")
+    assert directory.get_set("admins") is None
+    directory.put_set("admins", ["uid-alice"])
+    clock.now += 60
+    assert directory.get_set("admins") is None
+
+
+def test_ids_to_usernames_batches(users):
+    """Test that the directory, valkey and mattermost are each asked once for all misses"""
+    users.directory.put_user(CAROL)
+    usernames = users.ids_to_usernames(["uid-alice", "uid-bob", "uid-carol", "uid-bob", "uid-gone"])
+    assert usernames == {"uid-alice": "alice", "uid-bob": "bob", "uid-carol": "carol"}
+    users.valkey.mget.assert_called_once_with(["user:uid-alice", "user:uid-bob", "user:uid-gone"])
+    users.driver.users.get_users_by_ids.assert_called_once_with(["uid-bob", "uid-gone"])
+    # everything found is in the directory now
+    users.ids_to_usernames(["uid-alice", "uid-bob"])
+    assert users.valkey.mget.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_async_ids_to_usernames(users):
+    """Test that the async version fetches the misses in one request"""
+    usernames = await users.async_ids_to_usernames(["uid-bob", "uid-alice"])
+    assert usernames == {"uid-bob": "bob", "uid-alice": "alice"}
+    users.driver.users.get_users_by_ids.assert_called_once_with(["uid-bob"])
+    users.helper.avalkey.pipeline.return_value.execute.assert_awaited_once()
+
+
+def test_admin_set_is_cached_until_changed(users):
+    """Test that is_admin reads the set once and sees changes made through the plugin"""
+    users.directory.put_user(ALICE)
+    users.directory.put_user(BOB)
+    assert users.is_admin("alice")
+    assert not users.is_admin("bob")
+    assert users.valkey.smembers.call_count == 1
+    users.add_member("admins", "uid-bob")
+    users.valkey.smembers.return_value = {"uid-alice", "uid-bob"}
+    assert users.is_admin("bob")
+    assert users.valkey.smembers.call_count == 2
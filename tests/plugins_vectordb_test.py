@@ -0,0 +1,167 @@
+""" Tests for the vector database queries """
+
+import contextlib
+import os
+from unittest.mock import AsyncMock, Mock
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+# pylint: disable=wrong-import-position
+from plugins import vectordb as vectordb_module
+from plugins.vectordb import UsageContext, VectorDb, index_statements
+
+
+class FakePool:
+    """a connection pool handing out one fake connection"""
+
+    def __init__(self, rows=None):
+        self.cursor = Mock()
+        self.cursor.fetchall = AsyncMock(return_value=rows or [])
+        self.cursor.rowcount = len(rows or [])
+        self.conn = Mock()
+        self.conn.execute = AsyncMock(return_value=self.cursor)
+        self.conn.transaction = contextlib.nullcontext
+        self.cursor.executemany = AsyncMock()
+        self.conn.cursor = lambda: contextlib.nullcontext(self.cursor)
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        """lend the connection"""
+        yield self.conn
+
+
+@pytest.fixture(name="vectordb")
+def fixture_vectordb():
+    """a vectordb on a fake pool without connecting to postgres"""
+    vectordb = VectorDb.__new__(VectorDb)
+    vectordb._pool = FakePool([{"id": 1, "content": "likes tea"}])
+    vectordb.async_get_embeddings = AsyncMock(return_value=[0.5] * VectorDb.VECTOR_DIMENSIONS)
+    return vectordb
+
+
+@pytest.mark.asyncio
+async def test_queries_are_prepared(vectordb):
+    """Test that queries run on the pool as prepared statements"""
+    vectordb._pool.cursor.fetchall = AsyncMock(return_value=[{"id": 1}])
+    assert await vectordb.check_if_memory_exists(UsageContext.DIRECT, "likes tea", "u1", "direct", "u1")
+    _, params = vectordb._pool.conn.execute.await_args.args
+    assert params == ("likes tea", "u1", "direct", "direct", "u1")
+    assert vectordb._pool.conn.execute.await_args.kwargs == {"prepare": True}
+
+
+@pytest.mark.asyncio
+async def test_search_sends_float32_vectors(vectordb):
+    """Test that the embedding is sent as a float32 array"""
+    memories = await vectordb.get_memories("tea?", UsageContext.DIRECT, "u1", "direct", "u1", not_ids=[3])
+    assert memories == [{"id": 1, "content": "likes tea"}]
+    _, params = vectordb._pool.conn.execute.await_args.args
+    assert isinstance(params[0], np.ndarray) and params[0].dtype == np.float32
+    assert params[-2:] == [[3], 5]
+
+
+@pytest.mark.asyncio
+async def test_new_memories_exclude_loaded_ids_in_sql(vectordb):
+    """Test that loaded memories are excluded by the query"""
+    memories = await vectordb.get_new_memories("tea?", UsageContext.DIRECT, "u1", "direct", "u1", {7, 3})
+    assert memories == [{"id": 1, "content": "likes tea"}]
+    query, params = vectordb._pool.conn.execute.await_args.args
+    assert "NOT id = ANY(%s)" in query.as_string(None)
+    assert params[-2:] == [[3, 7], 5]
+    assert vectordb._pool.conn.execute.await_count == 1
+
+
+def test_indexes_skip_deleted_rows():
+    """Test that the hnsw and owner indexes are partial on rows that are not deleted"""
+    hnsw, owner = (statement.as_string(None) for statement in index_statements("rag_content"))
+    assert 'USING hnsw (embedding vector_cosine_ops)' in hnsw
+    assert "(created_by, usage_context, source_type, source)" in owner
+    assert all(statement.endswith("WHERE is_deleted = FALSE") for statement in (hnsw, owner))
+
+
+def test_search_orders_by_distance_only(vectordb):
+    """Test that an unfiltered search can be answered from the cosine index"""
+    query, _ = vectordb._build_search_query("rag_content", [], ["embedding", 5])
+    assert query.as_string(None).split("ORDER BY")[1].strip() == "distance LIMIT %s"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("iterative_scan", [True, False])
+async def test_filtered_search_keeps_recall(vectordb, iterative_scan):
+    """Test that owner filtered searches read the index iteratively or search the owner's rows exactly"""
+    vectordb.iterative_scan = iterative_scan
+    await vectordb.search(None, "tea?", "u1", UsageContext.DIRECT, "memory", "direct", "u1")
+    query, params = vectordb._pool.conn.execute.await_args.args
+    query = query.as_string(None)
+    assert query.startswith("WITH candidates AS MATERIALIZED (")
+    assert query.endswith("SELECT * FROM candidates ORDER BY distance" + ("" if iterative_scan else " LIMIT %s"))
+    assert ("ORDER BY distance LIMIT %s)" in query) is iterative_scan
+    assert params[-1] == 5
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("version, iterative_scan", [("0.8.0", True), ("0.10.1", True), ("0.7.4", False)])
+async def test_iterative_scan_needs_pgvector_0_8(vectordb, monkeypatch, version, iterative_scan):
+    """Test that hnsw.iterative_scan is only set where pgvector has it"""
+    monkeypatch.setattr(vectordb_module, "register_vector_async", AsyncMock())
+    conn = Mock()
+    cursor = Mock()
+    cursor.fetchone = AsyncMock(return_value={"extversion": version})
+    conn.execute = AsyncMock(return_value=cursor)
+    await vectordb.configure_connection(conn)
+    statements = [call.args[0] for call in conn.execute.await_args_list]
+    statements = [statement if isinstance(statement, str) else statement.as_string(None) for statement in statements]
+    assert statements[0] == "SET hnsw.ef_search = 100"
+    assert ("SET hnsw.iterative_scan = 'relaxed_order'" in statements) is iterative_scan
+    assert vectordb.iterative_scan is iterative_scan
+
+
+@pytest.mark.asyncio
+async def test_store_multiple_batches(vectordb):
+    """Test that contents are deduped, embedded a batch per request and inserted a batch at a time"""
+    vectordb._pool.cursor.fetchall = AsyncMock(side_effect=[[{"content": "b"}], []])
+    vectordb.embed_many = AsyncMock(side_effect=lambda texts: [[0.5] * 3 for _ in texts])
+    report = await vectordb.store_multiple(
+        "rag_content", "user", "u1", UsageContext.DIRECT, "memory", ["note"], ["a", "b", " a", "c", "d"], {}, "u1", batch_size=2
+    )
+    assert {key: report[key] for key in ("received", "duplicates", "existing", "stored")} == {
+        "received": 5, "duplicates": 1, "existing": 1, "stored": 3
+    }
+    assert [call.args[0] for call in vectordb.embed_many.await_args_list] == [["a"], ["c", "d"]]
+    inserts = vectordb._pool.cursor.executemany.await_args_list
+    assert [[row[5] for row in call.args[1]] for call in inserts] == [["a"], ["c", "d"]]
+    assert inserts[0].args[1][0][6].dtype == np.float32
+
+
+class FakeConnection:
+    """a blocking connection that records statements, the schema is at version"""
+
+    def __init__(self, version):
+        self.version = version
+        self.statements = []
+
+    def transaction(self):
+        """a transaction"""
+        return contextlib.nullcontext()
+
+    def execute(self, query, params=None):
+        """record a statement"""
+        statement = query if isinstance(query, str) else query.as_string(None)
+        self.statements.append((" ".join(statement.split()), params))
+        return Mock(fetchone=Mock(return_value={"version": self.version}))
+
+
+@pytest.mark.parametrize("version, applied", [(0, [1, 2]), (1, [2]), (2, [])])
+def test_migrations_run_once(version, applied):
+    """Test that only the migrations newer than the stored version run"""
+    vectordb = VectorDb.__new__(VectorDb)
+    vectordb.conn = FakeConnection(version)
+    assert vectordb.migrate() == 2
+    statements = vectordb.conn.statements
+    assert statements[0] == ("SELECT pg_advisory_xact_lock(%s)", (0x76656374,))
+    recorded = [params[0] for statement, params in statements if statement.startswith("INSERT INTO vectordb_schema")]
+    assert recorded == applied
+    assert any("hnsw" in statement for statement, _ in statements) == (2 in applied)
+    assert any(statement.startswith("DROP TABLE") for statement, _ in statements) == (1 in applied)
@@ -0,0 +1,51 @@
+""" Tests for the xai plugin """
+
+import os
+from unittest.mock import AsyncMock, Mock
+
+import httpx
+import pytest
+from openai import APIConnectionError
+
+os.environ.setdefault("XAI_API_KEY", "test")
+
+# pylint: disable=wrong-import-position
+from plugins import helper
+from plugins import xai as xai_module
+from plugins.xai import Xai
+
+
+@pytest.fixture(name="xai")
+def fixture_xai():
+    """an xai plugin with a real helper for its temp files"""
+    xai = Xai.__new__(Xai)
+    xai.helper = helper.Helper(Mock())
+    xai.helper.debug = AsyncMock()
+    xai.helper.log = AsyncMock()
+    xai.async_get_xai_setting = AsyncMock(return_value=0)
+    xai.users = Mock()
+    xai.users.async_is_user = AsyncMock(return_value=True)
+    xai.get_thread_messages = AsyncMock(return_value=[{"role": "user", "content": "hi"}])
+    xai.driver = Mock()
+    xai.driver.reply_to.return_value = {"id": "reply"}
+    return xai
+
+
+@pytest.mark.asyncio
+async def test_long_error_leaves_no_file_behind(xai, monkeypatch):
+    """Test that the file of an overflowing error message is posted and deleted"""
+    saved = []
+    save = xai.helper.save_content_to_tmp_file
+
+    def save_and_remember(*args, **kwargs):
+        saved.append(save(*args, **kwargs))
+        return saved[-1]
+
+    xai.helper.save_content_to_tmp_file = save_and_remember
+    error = APIConnectionError(message="x" * 20000, request=httpx.Request("POST", "https://api.x.ai/v1"))
+    monkeypatch.setattr(xai_module.aclient.chat.completions, "create", AsyncMock(side_effect=error))
+    message = Mock(text="hello", sender_name="user", reply_id="thread", id="post")
+    await Xai.chat.function(xai, message, "grok-2")
+    assert len(saved) == 1
+    assert not os.path.exists(saved[0])
+    xai.driver.reply_to.assert_called_with(message, "Files:", file_paths=saved)